@@ -1,2 +1,10 @@
 # To ensure that the core entry types are registered
 import entrytypes.core
+
+
+def warmup(*args, **kwargs):
+    """Initialise everything expensive ahead of the first request - see
+    :func:`mumblr.startup.warmup`.
+    """
+    from mumblr.startup import warmup
+    return warmup(*args, **kwargs)
@@ -0,0 +1,162 @@
+"""A per-month histogram of published entries, used for archive navigation.
+
+Rather than aggregating over the whole entries collection, an
+:class:`ArchiveMonth` counter is kept for each month and adjusted whenever an
+entry is published, unpublished, moved to a different month or deleted. Each
+entry records which month (if any) it is currently counted against in its
+``archive_month`` field, so transitions can be detected without re-reading
+the entry from the database.
+
+Entries are counted while they are published, due and haven't expired,
+matching :meth:`EntryType.live_entries`. As entries expire, or their publish
+date arrives, without being saved, :func:`refresh_histogram` needs running
+periodically to move them out of or into the histogram - the
+``refresharchive`` command and the cold storage pass both do.
+"""
+from mongoengine import *
+
+from datetime import datetime
+
+
+class ArchiveMonth(Document):
+    """The number of published entries with a publish date in the given
+    month.
+    """
+    year = IntField(required=True)
+    month = IntField(required=True)
+    count = IntField(default=0)
+
+    meta = {
+        'collection': 'archive_month',
+        'indexes': [('-year', '-month')],
+    }
+
+    @property
+    def date(self):
+        return datetime(self.year, self.month, 1)
+
+
+def month_key(entry):
+    """The histogram key an entry should be counted against, or None if it
+    shouldn't be counted.
+    """
+    if not entry.published or not entry.publish_date:
+        return None
+    now = datetime.now()
+    if entry.publish_date > now.replace(hour=23, minute=59, second=59):
+        return None
+    if entry.expiry_date and entry.expiry_date <= now:
+        return None
+    return entry.publish_date.strftime('%Y-%m')
+
+
+def _adjust(key, amount):
+    year, month = [int(part) for part in key.split('-')]
+    ArchiveMonth.objects(year=year, month=month).update_one(
+        inc__count=amount, upsert=True)
+
+
+def update_histogram(entry):
+    """Set ``entry``'s ``archive_month`` for its published state and publish
+    month, before it is saved. Returns the move between buckets as an
+    (old, new) pair for :func:`apply_move` once the save has succeeded, or
+    None if the entry stays where it is.
+    """
+    key = month_key(entry)
+    if key == entry.archive_month:
+        return None
+    move = (entry.archive_month, key)
+    entry.archive_month = key
+    return move
+
+
+def apply_move(move):
+    """Adjust the histogram for a move returned by :func:`update_histogram`.
+    """
+    if move is None:
+        return
+    old, new = move
+    if old:
+        _adjust(old, -1)
+    if new:
+        _adjust(new, 1)
+
+
+def remove_from_histogram(entry):
+    if entry.archive_month:
+        _adjust(entry.archive_month, -1)
+
+
+def recount_months(keys):
+    """Recount the given histogram buckets from the archive_month fields of
+    the entries, e.g. after a bulk update.
+    """
+    from mumblr.entrytypes import EntryType
+    for key in set(keys):
+        if not key:
+            continue
+        year, month = [int(part) for part in key.split('-')]
+        count = EntryType.objects(archive_month=key).count()
+        ArchiveMonth.objects(year=year, month=month).update_one(
+            set__count=count, upsert=True)
+
+
+def refresh_histogram():
+    """Move entries that have expired since they were saved out of the
+    histogram, and entries whose publish date has since arrived into it.
+    Returns the number of entries moved.
+    """
+    from mumblr.entrytypes import EntryType
+
+    now = datetime.now()
+    cutoff = now.replace(hour=23, minute=59, second=59)
+    expired = EntryType.objects(archive_month__ne=None, expiry_date__lte=now)
+    due = EntryType.objects(Q(expiry_date__gt=now) | Q(expiry_date=None),
+                            archive_month=None, published=True,
+                            publish_date__lte=cutoff)
+    collection = EntryType.objects._collection
+    moved = 0
+    for entries in (expired, due):
+        entries = entries.only('id', 'published', 'publish_date',
+                               'expiry_date', 'archive_month')
+        for entry in list(entries):
+            move = (entry.archive_month, month_key(entry))
+            if move[0] == move[1]:
+                continue
+            # Only move the entry if a save hasn't already done so. The
+            # version is bumped so that a save of a copy loaded before this
+            # notices the move, rather than adjusting the histogram again.
+            result = collection.update(
+                {'_id': entry.id, 'archive_month': move[0]},
+                {'$set': {'archive_month': move[1]}, '$inc': {'version': 1}},
+                safe=True)
+            if result and result.get('n'):
+                apply_move(move)
+                moved += 1
+    return moved
+
+
+def get_months():
+    """Return the non-empty histogram buckets, most recent first.
+    """
+    return list(ArchiveMonth.objects(count__gt=0).order_by('-year', '-month'))
+
+
+def rebuild_histogram():
+    """Recount every entry from scratch.
+    """
+    from mumblr.entrytypes import EntryType
+
+    counts = {}
+    entries = EntryType.objects.only('id', 'published', 'publish_date',
+                                     'expiry_date')
+    for entry in entries:
+        key = month_key(entry)
+        if key:
+            counts[key] = counts.get(key, 0) + 1
+        EntryType.objects(id=entry.id).update_one(set__archive_month=key)
+
+    ArchiveMonth.objects.delete()
+    for key, count in counts.iteritems():
+        year, month = [int(part) for part in key.split('-')]
+        ArchiveMonth(year=year, month=month, count=count).save()
@@ -0,0 +1,172 @@
+"""Bundling of theme CSS and JavaScript.
+
+Each theme's stylesheets and scripts may be concatenated and minified into a
+single bundle per type by the ``buildassets`` management command. Bundles are
+written next to the first file they contain (so relative ``url()``
+references in CSS keep working) with a hash of their content in the
+filename, so they can be served with far-future expiry headers. A
+``bundles.json`` manifest in the theme's static directory records the
+current bundle for each type.
+
+The ``theme_assets`` template tag links to the bundles, or to the individual
+source files when ``DEBUG`` is on or no bundle has been built.
+"""
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from django.utils.importlib import import_module
+
+import os
+import re
+
+
+DEFAULT_BUNDLES = {
+    'default': {
+        'css': ['css/reset.css', 'css/pygments.css', 'css/grey-theme.css'],
+        'js': ['js/jquery.js', 'js/jquery.scrollfollow.js', 'js/mumblr.js'],
+    },
+}
+
+BUNDLES = getattr(settings, 'MUMBLR_THEME_BUNDLES', DEFAULT_BUNDLES)
+
+MANIFEST_NAME = 'bundles.json'
+
+_manifests = {}
+_manifest_mtimes = {}
+_theme_dirs = {}
+
+_bundle_re = re.compile(r'^bundle-[0-9a-f]+\.\w+$')
+
+
+def theme_dir(theme):
+    """Find the directory containing a theme's static files - either under
+    MEDIA_ROOT or in an installed app's ``static`` directory.
+    """
+    if theme in _theme_dirs:
+        return _theme_dirs[theme]
+    dirs = [os.path.join(settings.MEDIA_ROOT or '', 'mumblr', 'themes', theme)]
+    for app in settings.INSTALLED_APPS:
+        try:
+            module = import_module(app)
+        except ImportError:
+            continue
+        app_dir = os.path.dirname(module.__file__)
+        dirs.append(os.path.join(app_dir, 'static', 'mumblr', 'themes', theme))
+    for path in dirs:
+        if os.path.isdir(path):
+            _theme_dirs[theme] = path
+            return path
+    return None
+
+
+def theme_url(theme, path):
+    return '%smumblr/themes/%s/%s' % (settings.MEDIA_URL, theme, path)
+
+
+def minify_css(css):
+    css = re.sub(r'(?s)/\*.*?\*/', '', css)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+def minify_js(js):
+    try:
+        from jsmin import jsmin
+    except ImportError:
+        return js
+    return jsmin(js)
+
+
+_minifiers = {
+    'css': minify_css,
+    'js': minify_js,
+}
+
+
+def _prune_bundles(base_dir, keep):
+    """Remove built bundles other than those in ``keep``.
+    """
+    dirs = set(os.path.dirname(path) for path in keep)
+    for dir in dirs:
+        for name in os.listdir(os.path.join(base_dir, dir)):
+            path = '%s/%s' % (dir, name) if dir else name
+            if _bundle_re.match(name) and path not in keep:
+                os.remove(os.path.join(base_dir, path))
+
+
+def build_bundles(theme):
+    """Build the bundles for a theme. The bundles from the previous build are
+    kept, as processes that haven't noticed the new manifest yet and cached
+    pages still link to them; any older ones are removed. Returns the new
+    manifest.
+    """
+    base_dir = theme_dir(theme)
+    if base_dir is None:
+        return {}
+
+    old_manifest = load_manifest(theme, reload=True)
+    manifest = {}
+    for type, files in BUNDLES.get(theme, {}).items():
+        minify = _minifiers.get(type, lambda content: content)
+        parts = [minify(open(os.path.join(base_dir, f)).read()) for f in files]
+        separator = ';\n' if type == 'js' else '\n'
+        content = separator.join(parts)
+
+        digest = md5_constructor(content).hexdigest()[:12]
+        path = '%s/bundle-%s.%s' % (os.path.dirname(files[0]), digest, type)
+        f = open(os.path.join(base_dir, path), 'w')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        manifest[type] = path
+
+    # Write the manifest atomically, so that it's never seen half written
+    manifest_path = os.path.join(base_dir, MANIFEST_NAME)
+    f = open(manifest_path + '.tmp', 'w')
+    try:
+        simplejson.dump(manifest, f)
+    finally:
+        f.close()
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+    _prune_bundles(base_dir, set(manifest.values() + old_manifest.values()))
+    load_manifest(theme, reload=True)
+    return manifest
+
+
+def load_manifest(theme, reload=False):
+    """Load a theme's bundle manifest, caching it in memory until the
+    manifest file changes.
+    """
+    path = None
+    base_dir = theme_dir(theme)
+    if base_dir is not None:
+        path = os.path.join(base_dir, MANIFEST_NAME)
+    try:
+        mtime = os.stat(path).st_mtime
+    except (OSError, TypeError):
+        mtime = None
+
+    # A manifest set without a modification time is kept as it is
+    cached_mtime = _manifest_mtimes.get(theme, mtime)
+    if reload or theme not in _manifests or cached_mtime != mtime:
+        manifest = {}
+        if mtime is not None:
+            manifest = simplejson.load(open(path))
+        _manifests[theme] = manifest
+        _manifest_mtimes[theme] = mtime
+    return _manifests[theme]
+
+
+def asset_urls(theme, type):
+    """The URLs that should be linked to for a theme's assets of the given
+    type.
+    """
+    if not settings.DEBUG:
+        bundle = load_manifest(theme).get(type)
+        if bundle:
+            return [theme_url(theme, bundle)]
+    return [theme_url(theme, f) for f in BUNDLES.get(theme, {}).get(type, [])]
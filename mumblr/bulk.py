@@ -0,0 +1,169 @@
+"""Actions applied to many entries at once from the admin.
+
+Each action is carried out with a single multi-document update (or remove)
+rather than by saving entries one at a time, and the caches, search index,
+related entries and archive histogram are brought up to date once for the
+whole batch.
+"""
+from django import forms
+from django.forms.extras.widgets import SelectDateWidget
+
+from datetime import datetime, timedelta
+from pymongo.errors import InvalidId
+from pymongo.objectid import ObjectId
+
+from mumblr.entrytypes import EntryType, normalize_tag
+
+
+ACTION_CHOICES = (
+    ('publish', 'Publish'),
+    ('unpublish', 'Unpublish'),
+    ('delete', 'Delete'),
+    ('add_tag', 'Add tag'),
+    ('remove_tag', 'Remove tag'),
+    ('set_expiry', 'Set expiry date'),
+    ('clear_expiry', 'Clear expiry date'),
+    ('enable_comments', 'Enable comments'),
+    ('disable_comments', 'Disable comments'),
+)
+
+
+class BulkActionForm(forms.Form):
+    action = forms.ChoiceField(choices=ACTION_CHOICES)
+    tag_value = forms.CharField(required=False, label='Tag')
+    expiry_date = forms.DateTimeField(widget=SelectDateWidget(required=False),
+                                      required=False)
+
+    # Entries may be selected individually, or by a query
+    entry_ids = forms.Field(required=False, widget=forms.MultipleHiddenInput)
+    tag = forms.CharField(required=False)
+    entry_type = forms.CharField(required=False)
+    start_date = forms.DateTimeField(required=False)
+    end_date = forms.DateTimeField(required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(BulkActionForm, self).__init__(*args, **kwargs)
+        choices = [('', 'Any')]
+        choices += [(name, cls.type) for name, cls in EntryType._types.items()]
+        self.fields['entry_type'] = forms.ChoiceField(choices=choices,
+                                                      required=False)
+
+    def clean_entry_ids(self):
+        entry_ids = self.cleaned_data['entry_ids'] or []
+        try:
+            return [ObjectId(entry_id) for entry_id in entry_ids]
+        except (InvalidId, TypeError):
+            raise forms.ValidationError('Invalid entry selected.')
+
+    def clean_tag_value(self):
+        return normalize_tag(self.cleaned_data['tag_value'])
+
+    def clean(self):
+        data = self.cleaned_data
+        if not self._errors:
+            action = data['action']
+            if action in ('add_tag', 'remove_tag') and not data['tag_value']:
+                raise forms.ValidationError('A tag is required.')
+            if action == 'set_expiry' and not data['expiry_date']:
+                raise forms.ValidationError('An expiry date is required.')
+            if not (data['entry_ids'] or data['tag'] or data['entry_type'] or
+                    data['start_date'] or data['end_date']):
+                raise forms.ValidationError('No entries were selected.')
+        return data
+
+
+def select_entries(entry_ids=None, tag=None, entry_type=None,
+                   start_date=None, end_date=None):
+    """Get a queryset for the entries matching a selection.
+    """
+    document = EntryType
+    if entry_type:
+        document = EntryType._types[entry_type.lower()]
+    query = {}
+    if entry_ids:
+        query['id__in'] = entry_ids
+    if tag:
+        query['tags'] = normalize_tag(tag)
+    if start_date:
+        query['publish_date__gte'] = start_date
+    if end_date:
+        query['publish_date__lt'] = end_date + timedelta(days=1)
+    return document.objects(**query)
+
+
+def _update(queryset, update):
+    """Apply a raw update to every document matched by a queryset, bumping
+    their versions so that concurrent edits notice the change.
+    """
+    update.setdefault('$set', {})['modified_date'] = datetime.now()
+    update['$inc'] = {'version': 1}
+    queryset._collection.update(queryset._query, update, multi=True,
+                                safe=True)
+
+
+def apply_action(queryset, action, tag=None, expiry_date=None):
+    """Apply a bulk action to the entries matched by a queryset. Returns the
+    number of entries affected.
+    """
+    from mumblr import archive, caching, related, search
+
+    entries = list(queryset.only('id', 'tags', 'publish_date',
+                                 'archive_month'))
+    if not entries:
+        return 0
+    ids = [entry.id for entry in entries]
+    months = [entry.archive_month for entry in entries]
+    # Operate on exactly the entries found, even if others match the query
+    # by the time the update runs
+    queryset = EntryType.objects(id__in=ids)
+
+    if action == 'publish':
+        _update(queryset, {'$set': {'published': True}})
+        # Entries are counted against the month they are published in
+        by_month = {}
+        for entry in entries:
+            key = entry.publish_date.strftime('%Y-%m')
+            by_month.setdefault(key, []).append(entry.id)
+        for key, month_ids in by_month.items():
+            month_query = EntryType.objects(id__in=month_ids)
+            month_query._collection.update(month_query._query,
+                                           {'$set': {'archive_month': key}},
+                                           multi=True, safe=True)
+        archive.recount_months(months + by_month.keys())
+    elif action == 'unpublish':
+        _update(queryset, {'$set': {'published': False,
+                                    'archive_month': None}})
+        archive.recount_months(months)
+    elif action == 'delete':
+        search.SearchPosting.objects(entry__in=ids).delete()
+        related.remove_many(ids)
+        queryset._collection.remove(queryset._query, safe=True)
+        archive.recount_months(months)
+    elif action in ('add_tag', 'remove_tag'):
+        tag = normalize_tag(tag)
+        if action == 'add_tag':
+            _update(queryset, {'$addToSet': {'tags': tag}})
+        else:
+            _update(queryset, {'$pull': {'tags': tag}})
+        # Tags feed into the search index and related entries
+        changed = list(EntryType.objects(id__in=ids))
+        search.index_many(changed)
+        related.update_related_many(changed)
+    elif action == 'set_expiry':
+        _update(queryset, {'$set': {'expiry_date': expiry_date}})
+    elif action == 'clear_expiry':
+        _update(queryset, {'$set': {'expiry_date': None}})
+    elif action == 'enable_comments':
+        _update(queryset, {'$set': {'comments_enabled': True}})
+    elif action == 'disable_comments':
+        _update(queryset, {'$set': {'comments_enabled': False}})
+    else:
+        raise ValueError('Unknown bulk action "%s"' % action)
+
+    if action in ('publish', 'unpublish', 'set_expiry', 'clear_expiry'):
+        # Whether the entries may appear in related lists has changed
+        related.update_related_many(EntryType.objects(id__in=ids).only(
+            'id', 'tags', 'published', 'expiry_date'))
+
+    caching.invalidate()
+    return len(entries)
@@ -0,0 +1,309 @@
+"""Caching of rendered pages.
+
+Views decorated with :func:`cached_page` render their templates with
+:func:`render_shared`, which leaves out anything specific to the current
+user (see :mod:`mumblr.fragments`). This shared content is cached and used
+for every visitor, with the per-user fragments filled in for each request.
+
+For visitors without a session, the finished pages are also cached along
+with precompressed gzip (and, if the ``brotli`` module is installed, brotli)
+variants of their content, so the cost of compression is paid once when the
+cache is filled rather than on every request. The variant sent is chosen
+from the request's ``Accept-Encoding`` header.
+
+All cached pages are invalidated together whenever an entry changes, by
+bumping a generation number that is stored with every cached page.
+
+To stop a burst of requests for an expired or invalidated page all
+rendering it at once, only the request that takes the page's lock renders
+it. Meanwhile other requests are given the old copy, if it is less than
+``MUMBLR_CACHE_STALE_TIMEOUT`` seconds past its expiry, or wait for the new
+one. Pages that have merely expired are served stale to every request
+while one of them refreshes the page in a background thread.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+from django.utils.hashcompat import md5_constructor
+
+from cStringIO import StringIO
+import gzip
+import re
+import threading
+import time
+
+from mumblr.fragments import render_late
+from mumblr.utils import has_session
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+CACHE_TIMEOUT = getattr(settings, 'MUMBLR_CACHE_TIMEOUT', 60 * 5)
+
+# How long after expiry a page may still be served while it is re-rendered
+STALE_TIMEOUT = getattr(settings, 'MUMBLR_CACHE_STALE_TIMEOUT', 60)
+
+# Whether expired pages are refreshed in a background thread
+BACKGROUND_REFRESH = getattr(settings, 'MUMBLR_CACHE_BACKGROUND_REFRESH', True)
+
+# How long a request waits for another to render a page before giving up and
+# rendering it itself, and how long a page's lock is held at most
+LOCK_WAIT = getattr(settings, 'MUMBLR_CACHE_LOCK_WAIT', 5)
+LOCK_TIMEOUT = 30
+
+# Responses smaller than this aren't worth compressing
+MIN_COMPRESS_LENGTH = 200
+
+GENERATION_KEY = 'mumblr:generation'
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def compress_gzip(content):
+    buffer = StringIO()
+    f = gzip.GzipFile(mode='wb', compresslevel=9, fileobj=buffer)
+    try:
+        f.write(content)
+    finally:
+        f.close()
+    return buffer.getvalue()
+
+
+def compress_variants(content):
+    """Return a dict mapping content-codings to encoded versions of
+    ``content``, always including the 'identity' coding.
+    """
+    variants = {'identity': content}
+    if len(content) >= MIN_COMPRESS_LENGTH:
+        variants['gzip'] = compress_gzip(content)
+        if brotli is not None:
+            variants['br'] = brotli.compress(content)
+    return variants
+
+
+def _accepted_encodings(request):
+    """Parse the Accept-Encoding header into a set of acceptable codings.
+    """
+    accepted = set()
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    for part in header.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            match = re.match(r'\s*q\s*=\s*([0-9.]+)', param)
+            if match:
+                try:
+                    q = float(match.group(1))
+                except ValueError:
+                    pass
+        if coding and q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+def choose_encoding(request, variants):
+    """Pick the best of ``variants`` that the client will accept.
+    """
+    accepted = _accepted_encodings(request)
+    for coding in ('br', 'gzip'):
+        if coding in variants and (coding in accepted or '*' in accepted):
+            return coding
+    return 'identity'
+
+
+def variant_response(request, cached):
+    """Build a response from a cached entry, as produced by
+    :func:`cache_response`.
+    """
+    variants = cached['variants']
+    coding = choose_encoding(request, variants)
+    response = HttpResponse(variants[coding],
+                            content_type=cached['content_type'])
+    if coding != 'identity':
+        response['Content-Encoding'] = coding
+    response['Content-Length'] = str(len(variants[coding]))
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = str(time.time())
+        cache.set(GENERATION_KEY, generation, GENERATION_TIMEOUT)
+    return generation
+
+
+def invalidate():
+    """Invalidate all cached pages, e.g. after an entry has changed.
+    """
+    cache.set(GENERATION_KEY, str(time.time()), GENERATION_TIMEOUT)
+
+
+def page_key(request, kind):
+    path = md5_constructor(request.get_full_path()).hexdigest()
+    return 'mumblr:%s:%s' % (kind, path)
+
+
+def is_fresh(cached):
+    """Whether a cached page is neither expired nor invalidated.
+    """
+    return (cached.get('generation') == get_generation() and
+            time.time() < cached.get('expires', 0))
+
+
+def is_anonymous(request):
+    """Whether the visitor has no session, and so will see exactly the same
+    page as every other such visitor.
+    """
+    return not has_session(request)
+
+
+def render_shared(request, template_name, context):
+    """Render a template for sharing between all users - per-user fragments
+    are left as markers, and the user is always treated as anonymous.
+    """
+    from django.contrib.auth.models import AnonymousUser
+    context = dict(context, user=AnonymousUser(), mumblr_shared=True)
+    return render_to_response(template_name, context,
+                              context_instance=RequestContext(request))
+
+
+def _render(key, request, view, args, kwargs):
+    """Render a view's shared content and cache it. Returns the cached data,
+    or the view's response if it can't be cached.
+    """
+    # Taken first, so a page rendered while entries change counts as stale
+    generation = get_generation()
+    response = view(request, *args, **kwargs)
+    if response.status_code != 200 or response.cookies:
+        return response
+    shared = {
+        'content_type': response['Content-Type'],
+        'content': response.content,
+        'generation': generation,
+        'expires': time.time() + CACHE_TIMEOUT,
+    }
+    cache.set(key, shared, CACHE_TIMEOUT + STALE_TIMEOUT)
+    return shared
+
+
+def _detached_request(request):
+    """A copy of ``request`` for rendering a page in another thread, as an
+    anonymous GET with no cookies or body, so that nothing the view does to
+    it can affect the original request. Returns None if the request can't be
+    copied.
+    """
+    from django.core.handlers.wsgi import WSGIRequest
+    if not isinstance(request, WSGIRequest):
+        return None
+    environ = dict((name, value) for name, value in request.META.items()
+                   if name not in ('HTTP_COOKIE', 'CSRF_COOKIE',
+                                   'CSRF_COOKIE_USED'))
+    environ.update({
+        'REQUEST_METHOD': 'GET',
+        'CONTENT_LENGTH': '0',
+        'wsgi.input': StringIO(''),
+    })
+    return WSGIRequest(environ)
+
+
+def _refresh(key, lock, request, view, args, kwargs):
+    """Re-render a page in a background thread, using a detached copy of the
+    request. Returns False if the request couldn't be copied.
+    """
+    request = _detached_request(request)
+    if request is None:
+        return False
+
+    def run():
+        try:
+            _render(key, request, view, args, kwargs)
+        finally:
+            cache.delete(lock)
+    thread = threading.Thread(target=run, name='mumblr-refresh')
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def get_shared(request, view, args, kwargs):
+    """Get a view's shared content, rendering it if necessary. Only one
+    request renders a page at once; the others get the stale copy if there
+    is one, or wait for the new one.
+    """
+    key = page_key(request, 'shared')
+    shared = cache.get(key)
+    if shared is not None and is_fresh(shared):
+        return shared
+
+    lock = key + ':lock'
+    if cache.add(lock, 1, LOCK_TIMEOUT):
+        if (shared is not None and BACKGROUND_REFRESH and
+            shared.get('generation') == get_generation()):
+            # The page has only expired, so there's no hurry
+            if _refresh(key, lock, request, view, args, kwargs):
+                return shared
+        try:
+            return _render(key, request, view, args, kwargs)
+        finally:
+            cache.delete(lock)
+
+    # Someone else is rendering the page
+    if shared is not None:
+        return shared
+    deadline = time.time() + LOCK_WAIT
+    while time.time() < deadline and cache.get(lock) is not None:
+        time.sleep(0.05)
+        shared = cache.get(key)
+        if shared is not None:
+            return shared
+    return _render(key, request, view, args, kwargs)
+
+
+def cached_page(view):
+    """Decorator that caches a view's shared content, filling in per-user
+    fragments on each request. Finished pages for anonymous visitors are
+    cached too, along with their compressed variants.
+    """
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view(request, *args, **kwargs)
+
+        anonymous = is_anonymous(request)
+        if anonymous:
+            cached = cache.get(page_key(request, 'anonymous'))
+            if cached is not None:
+                if is_fresh(cached):
+                    return variant_response(request, cached)
+                # Keep serving the old page while it is being refreshed
+                lock = page_key(request, 'shared') + ':lock'
+                if cache.get(lock) is not None:
+                    return variant_response(request, cached)
+
+        shared = get_shared(request, view, args, kwargs)
+        if isinstance(shared, HttpResponse):
+            return shared
+        content = render_late(request, shared['content'])
+
+        # Pages containing a CSRF token can't be shared, even between
+        # anonymous visitors
+        if anonymous and not request.META.get('CSRF_COOKIE_USED'):
+            cached = {
+                'content_type': shared['content_type'],
+                'variants': compress_variants(content),
+                'generation': shared['generation'],
+                'expires': shared['expires'],
+            }
+            cache.set(page_key(request, 'anonymous'), cached,
+                      CACHE_TIMEOUT + STALE_TIMEOUT)
+            return variant_response(request, cached)
+        return HttpResponse(content, content_type=shared['content_type'])
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
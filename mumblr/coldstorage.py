@@ -0,0 +1,148 @@
+"""Moving dead entries out of the main entries collection.
+
+Expired entries (and optionally old unpublished drafts) are never listed, but
+left in place they still grow the collection and its indexes that every
+listing query uses. :func:`archive_entries` moves them, in batches, into a
+separate ``entry_archive`` collection, unchanged, so they can be moved back
+with :func:`restore_entry`.
+
+An :class:`ArchivedPermalink` is kept for each archived entry so that its
+permalink still resolves - :func:`get_archived_entry` loads the entry from
+the archive for display.
+"""
+from mongoengine import *
+from pymongo.objectid import ObjectId
+
+from datetime import datetime, timedelta
+
+
+ARCHIVE_COLLECTION = 'entry_archive'
+
+
+class ArchivedPermalink(Document):
+    """Maps the publish day and slug of an archived entry (the parts of its
+    permalink) to its id in the archive collection.
+    """
+    day = DateTimeField(required=True)
+    slug = StringField(required=True)
+    entry = ObjectIdField(required=True)
+
+    meta = {
+        'collection': 'archived_permalink',
+        'indexes': [('day', 'slug'), 'entry'],
+    }
+
+
+def _entries():
+    from mumblr.entrytypes import EntryType
+    return EntryType.objects._collection
+
+
+def _archive():
+    return _entries().database[ARCHIVE_COLLECTION]
+
+
+def _day(date):
+    return datetime(date.year, date.month, date.day)
+
+
+def archive_entries(batch_size=100, drafts_days=None):
+    """Move expired entries, and unpublished entries that haven't been
+    modified for ``drafts_days`` days if it is given, to the archive. Returns
+    the number of entries moved.
+    """
+    from mumblr import archive, caching, related, search
+
+    # Also bring the month histogram up to date with entries that have
+    # expired or become due since they were saved
+    refreshed = archive.refresh_histogram()
+
+    now = datetime.now()
+    specs = [{'expiry_date': {'$lt': now}}]
+    if drafts_days is not None:
+        cutoff = now - timedelta(days=drafts_days)
+        specs.append({'published': False, 'modified_date': {'$lt': cutoff}})
+
+    entries, store = _entries(), _archive()
+    months = set()
+    moved = 0
+    for spec in specs:
+        while True:
+            batch = list(entries.find(spec).limit(batch_size))
+            if not batch:
+                break
+            ids = [doc['_id'] for doc in batch]
+
+            # Copy to the archive before removing, so that an interruption
+            # can at worst leave an entry in both places
+            for doc in batch:
+                store.save(doc, safe=True)
+                ArchivedPermalink.objects(entry=doc['_id']).delete()
+                ArchivedPermalink(day=_day(doc['publish_date']),
+                                  slug=doc['slug'], entry=doc['_id']).save()
+                months.add(doc.get('archive_month'))
+            entries.remove({'_id': {'$in': ids}}, safe=True)
+
+            search.SearchPosting.objects(entry__in=ids).delete()
+            related.remove_many(ids)
+            moved += len(batch)
+
+    if moved:
+        archive.recount_months(months)
+    if moved or refreshed:
+        caching.invalidate()
+    return moved
+
+
+def get_archived_entry(day, slug):
+    """Get the archived entry published on ``day`` with the given slug, or
+    None.
+    """
+    from mumblr.entrytypes import EntryType
+
+    permalink = ArchivedPermalink.objects(day=_day(day), slug=slug).first()
+    if permalink is None:
+        return None
+    doc = _archive().find_one({'_id': permalink.entry})
+    if doc is None:
+        return None
+    return EntryType._from_son(doc)
+
+
+def archived_entries(limit=None):
+    """The archived entries, most recently published first.
+    """
+    from mumblr.entrytypes import EntryType
+
+    cursor = _archive().find().sort('publish_date', -1)
+    if limit:
+        cursor = cursor.limit(limit)
+    return [EntryType._from_son(doc) for doc in cursor]
+
+
+def restore_entry(entry_id, clear_expiry=True):
+    """Move an entry back from the archive. Its expiry date is cleared unless
+    ``clear_expiry`` is False, as it would otherwise be archived again.
+    Returns the restored entry, or None if it wasn't archived.
+    """
+    from mumblr.entrytypes import EntryType
+    from mumblr import archive, caching, related, search
+
+    if isinstance(entry_id, basestring):
+        entry_id = ObjectId(entry_id)
+    store = _archive()
+    doc = store.find_one({'_id': entry_id})
+    if doc is None:
+        return None
+    if clear_expiry:
+        doc['expiry_date'] = None
+    _entries().save(doc, safe=True)
+    store.remove({'_id': entry_id}, safe=True)
+    ArchivedPermalink.objects(entry=entry_id).delete()
+
+    entry = EntryType.objects.with_id(entry_id)
+    search.index_entry(entry)
+    related.update_related(entry, force=True)
+    archive.recount_months([entry.archive_month])
+    caching.invalidate()
+    return entry
@@ -1,9 +1,11 @@
 from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from mumblr.utils import get_user
 
 def auth(request):
-    if hasattr(request, 'user'):
-        return {'user': request.user}
-    return {}
+    # The user is only looked up if a template actually uses it
+    return {'user': SimpleLazyObject(lambda: get_user(request))}
 
 def site_info(context):
     title = getattr(settings, 'SITE_INFO_TITLE', 'Mumblr')
@@ -7,8 +7,14 @@ import fields
 from datetime import datetime, date, timedelta
 import re
 from uuid import uuid4
-from mongoengine import *
+from mongoengine import (Document, EmbeddedDocument, StringField,
+                         DateTimeField, BooleanField, IntField, ListField,
+                         EmbeddedDocumentField, ReferenceField, Q,
+                         queryset_manager)
 from mongoengine.django.auth import User
+from pymongo.dbref import DBRef
+
+from mumblr import sandbox
 
 
 MARKUP_LANGUAGE = getattr(settings, 'MUMBLR_MARKUP_LANGUAGE', None)
@@ -17,29 +23,110 @@ def markup(text, small_headings=False, no_follow=True, escape=False,
            scale_headings=True):
     """Markup text using the markup language specified in the settings.
     """
+    return markup_many([text], small_headings, no_follow, escape,
+                       scale_headings)[0]
+
+
+def markup_many(texts, small_headings=False, no_follow=True, escape=False,
+                scale_headings=True):
+    """Markup each of a list of texts like :func:`markup`, using the same
+    Markdown instance for all of them.
+    """
     if MARKUP_LANGUAGE == 'markdown':
         import markdown
         safe_mode = 'escape' if escape else None
         try:
             import pygments
+            from mumblr import highlight
+            highlight.install()
             options = ['codehilite', 'extra', 'toc']
             if scale_headings:
                 options.append('headerid(level=3, forceid=False)')
-            text = markdown.markdown(text, options, safe_mode=safe_mode)
+            md = markdown.Markdown(extensions=options, safe_mode=safe_mode)
 
         except ImportError:
             options = ['extra', 'toc']
             if scale_headings:
                 options.append('headerid(level=3, forceid=False)')
-            text = markdown.markdown(text, options, safe_mode=safe_mode)
-    
+            md = markdown.Markdown(extensions=options, safe_mode=safe_mode)
+
+        converted = []
+        for text in texts:
+            converted.append(md.convert(text))
+            md.reset()
+        texts = converted
+
     if small_headings:
-        text = re.sub('<(/?h)[1-6]', '<\g<1>5', text)
+        texts = [re.sub('<(/?h)[1-6]', '<\g<1>5', text) for text in texts]
 
     if no_follow:
-        text = re.sub('<a (?![^>]*nofollow)', '<a rel="nofollow" ', text)
+        texts = [re.sub('<a (?![^>]*nofollow)', '<a rel="nofollow" ', text)
+                 for text in texts]
+
+    return texts
+
+
+# Fields that may be overwritten by a save even if they were changed by
+# another save after the entry was loaded. archive_month isn't one, as the
+# histogram is adjusted according to the value it is changed from.
+MERGEABLE_FIELDS = ('modified_date', 'author_name')
+
 
-    return text
+class EntryConflict(Exception):
+    """Raised when an entry can't be saved because it was changed by
+    someone else after it was loaded.
+    """
+    pass
+
+
+def normalize_tag(tag):
+    """Convert a tag to the form it is stored in, e.g. 'Django Tips' becomes
+    'django-tips'.
+    """
+    tag = tag.strip().lower().replace(' ', '-')
+    return re.sub('[^a-z0-9_-]', '', tag)
+
+
+def author_display_name(user):
+    """The name shown for the author of an entry.
+    """
+    return user.get_full_name().strip() or user.username
+
+
+def prefetch_authors(entries):
+    """Dereference the authors of a list of entries (or :class:`EntryView`
+    objects) with a single query, rather than one query per entry when each
+    author is first accessed. Returns the entries as a list.
+    """
+    def get_ref(entry):
+        if isinstance(entry, EntryView):
+            return entry._author
+        return entry._data.get('author')
+
+    def set_author(entry, user):
+        if isinstance(entry, EntryView):
+            entry._author = user
+        else:
+            entry._data['author'] = user
+
+    entries = list(entries)
+    refs = [get_ref(entry) for entry in entries]
+    ids = set(ref.id for ref in refs if isinstance(ref, DBRef))
+    if ids:
+        users = User.objects(id__in=list(ids))
+        users = dict((str(user.id), user) for user in users)
+        for entry, ref in zip(entries, refs):
+            if isinstance(ref, DBRef) and str(ref.id) in users:
+                set_author(entry, users[str(ref.id)])
+    return entries
+
+
+def update_author_name(user):
+    """Update the denormalised author name on all of a user's entries, e.g.
+    after the user has been renamed.
+    """
+    EntryType.objects(author=user).update(
+        set__author_name=author_display_name(user))
 
 
 class Comment(EmbeddedDocument):
@@ -54,7 +141,8 @@ class Comment(EmbeddedDocument):
     class CommentForm(forms.Form):
 
         author = forms.CharField()
-        body = forms.CharField(widget=forms.Textarea)
+        body = forms.CharField(widget=forms.Textarea,
+                               max_length=sandbox.MAX_LENGTH)
 
         def __init__(self, user, *args, **kwargs):
             super(Comment.CommentForm, self).__init__(*args, **kwargs)
@@ -83,7 +171,9 @@ class EntryType(Document):
     title = StringField(required=True)
     slug = StringField(required=True, regex='[A-z0-9_-]+')
     author = ReferenceField(User)
+    author_name = StringField()
     creation_date = DateTimeField(required=True, default=datetime.now)
+    modified_date = DateTimeField(required=False, default=datetime.now)
     tags = ListField(StringField(max_length=50))
     comments = ListField(EmbeddedDocumentField(Comment))
     comments_enabled = BooleanField(default=True)
@@ -93,9 +183,12 @@ class EntryType(Document):
     publish_date = DateTimeField(required=True, default=datetime.now)
     expiry_date = DateTimeField(required=False, default=None)
     link_url = StringField()
+    archive_month = StringField(required=False, default=None)
+    version = IntField(default=0)
 
     meta = {
-        'indexes': [('publish_date', 'slug'), '-publish_date', 'tags'],
+        'indexes': [('publish_date', 'slug'), '-publish_date', 'tags',
+                    'expiry_date', ('archive_month', 'publish_date')],
     }
 
     _types = {}
@@ -112,18 +205,163 @@ class EntryType(Document):
         date = self.publish_date.strftime('%Y/%b/%d').lower()
         return ('entry-detail', (date, self.slug))
 
+    @property
+    def num_comments(self):
+        return len(self.comments)
+
     def rendered_content(self):
         raise NotImplementedError()
 
     def save(self):
-        def convert_tag(tag):
-            tag = tag.strip().lower().replace(' ', '-')
-            return re.sub('[^a-z0-9_-]', '', tag)
-        self.tags = [convert_tag(tag) for tag in self.tags]
+        self.tags = [normalize_tag(tag) for tag in self.tags]
         self.tags = [tag for tag in self.tags if tag.strip()]
-        super(EntryType, self).save()
+
+        self.modified_date = datetime.now()
+        if self.author:
+            self.author_name = author_display_name(self.author)
+
+        from mumblr import archive
+        move = archive.update_histogram(self)
+        try:
+            if self._loaded_values() is None:
+                super(EntryType, self).save()
+            else:
+                self._save_changes()
+        except:
+            # Leave the histogram and the entry's bucket as they were
+            if move is not None:
+                self.archive_month = move[0]
+            raise
+        original = getattr(self, '_original', None) or {}
+        if move is not None and original.get('archive_month') == move[1]:
+            # Someone else had already moved it, e.g. refresh_histogram
+            move = None
+        archive.apply_move(move)
+        self._original = self._mongo_values()
+
+        from mumblr import search, related, caching
+        search.index_entry(self)
+        related.update_related(self)
+        caching.invalidate()
+
+    @classmethod
+    def _from_son(cls, son):
+        entry = super(EntryType, cls)._from_son(son)
+        # Keep the document as loaded so that only changed fields are written
+        # when the entry is saved. It is only converted if the entry is saved,
+        # so entries that are just displayed don't pay for it.
+        entry._son = son
+        entry._original = None
+        return entry
+
+    def reload(self):
+        super(EntryType, self).reload()
+        self._son = None
+        self._original = self._mongo_values()
+
+    def _loaded_values(self):
+        """The values of the fields as they were loaded from the database,
+        in the form given by :meth:`_mongo_values`, or None for a new entry.
+        """
+        son = getattr(self, '_son', None)
+        if son is not None:
+            self._original = self._mongo_values(son)
+            self._son = None
+        return getattr(self, '_original', None)
+
+    def _mongo_values(self, son=None):
+        """The value of each field as stored in the database - the current
+        values, or those in the raw document ``son`` if it is given.
+        """
+        values = {}
+        for name, field in self._fields.items():
+            if name == 'id':
+                continue
+            db_name = getattr(field, 'db_field', None) or name
+            if son is not None:
+                # Converted both ways, so that values compare equal to
+                # those of the current fields
+                value = son.get(db_name)
+                if value is not None:
+                    value = field.to_python(value)
+            else:
+                # Read the raw value so compressed fields aren't decompressed
+                value = self._data.get(name)
+                if value is None:
+                    value = getattr(self, name)
+            if value is not None:
+                value = field.to_mongo(value)
+            values[db_name] = value
+        return values
+
+    def _changes(self):
+        """The fields (by database name) that have changed since the entry
+        was loaded, with their new values.
+        """
+        original = self._loaded_values()
+        return dict((name, value) for name, value
+                    in self._mongo_values().items()
+                    if name != 'version' and value != original.get(name))
+
+    def _save_changes(self, retries=3):
+        """Update only the fields that have changed since the entry was
+        loaded, using $set and $unset, rather than rewriting the whole
+        document. This also avoids overwriting comments that have been
+        added in the meantime.
+
+        The update only succeeds if the entry's version is unchanged. If
+        another save got in first, the update is retried as long as none of
+        the fields it changed are ones being saved here - otherwise
+        :class:`EntryConflict` is raised.
+        """
+        self.validate()
+        changes = self._changes()
+        if not changes:
+            return
+
+        collection = self.__class__.objects._collection
+        object_id = self._fields['id'].to_mongo(self.id)
+        for attempt in range(retries + 1):
+            version = self._original.get('version') or 0
+            updates = {'$inc': {'version': 1}}
+            for name, value in changes.items():
+                if value is None:
+                    updates.setdefault('$unset', {})[name] = 1
+                else:
+                    updates.setdefault('$set', {})[name] = value
+
+            # Entries saved before versioning was added have no version
+            spec = {'_id': object_id, 'version': version or {'$in': [0, None]}}
+            result = collection.update(spec, updates, safe=True)
+            if result and result.get('n'):
+                self.version = version + 1
+                return
+
+            current = collection.find_one({'_id': object_id})
+            if current is None:
+                raise EntryConflict('The entry has been deleted')
+            for name, value in changes.items():
+                if name in MERGEABLE_FIELDS:
+                    continue
+                # Both saves changing a field to the same value is fine
+                if current.get(name) not in (self._original.get(name), value):
+                    raise EntryConflict('The "%s" field has been changed '
+                                        'by someone else' % name)
+            self._original = dict((name, current.get(name))
+                                  for name in self._original)
+        raise EntryConflict('The entry is being changed too frequently')
+
+    def delete(self):
+        from mumblr import search, related, archive, caching
+        search.unindex_entry(self)
+        related.remove_related(self)
+        archive.remove_from_histogram(self)
+        super(EntryType, self).delete()
+        caching.invalidate()
 
     class AdminForm(forms.Form):
+        version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+        original = forms.CharField(widget=forms.HiddenInput, required=False)
         title = forms.CharField()
         slug = forms.CharField()
         tags = forms.CharField(required=False)
@@ -208,4 +446,123 @@ class EntryType(Document):
         """
         cls._types[entry_type.type.lower()] = entry_type
 
+
+class EntryView(object):
+    """A lightweight, read-only view of an entry, built directly from the raw
+    data returned by the database. This avoids the cost of building full
+    :class:`EntryType` documents (and their embedded comments) on list pages
+    and in feeds.
+
+    Only the attributes used to display entries in lists are available
+    directly. Accessing anything else loads the full document, which is then
+    used for all other attribute lookups.
+    """
+    _fields = ('title', 'slug', 'tags', 'publish_date', 'expiry_date',
+               'published', 'comments_enabled', 'comments_expiry_date',
+               'link_url', 'image_url', 'video_url', 'description',
+               'author_name')
+    __slots__ = _fields + ('id', 'num_comments', '_class', '_author',
+                           '_rendered_content', '_document')
+
+    # The fields fetched for a view - of the comments, only their ids are
+    # fetched, to count them
+    _projection = dict.fromkeys(_fields + ('_cls', 'author',
+                                           'rendered_content', 'comments.id'),
+                                1)
+
+    _classes = {}
+
+    @classmethod
+    def from_son(cls, son):
+        view = cls()
+        for name in cls._fields:
+            setattr(view, name, son.get(name))
+        view.description = fields.decompress(view.description)
+        view.id = son['_id']
+        view.num_comments = len(son.get('comments') or [])
+        view._author = son.get('author')
+        view._rendered_content = son.get('rendered_content')
+        view._class = cls._get_class(son.get('_cls'))
+        view._document = None
+        return view
+
+    @classmethod
+    def _get_class(cls, class_name):
+        if not cls._classes:
+            for entry_type in EntryType._types.values():
+                cls._classes[entry_type._class_name] = entry_type
+        return cls._classes.get(class_name, EntryType)
+
+    get_absolute_url = EntryType.__dict__['get_absolute_url']
+
+    @property
+    def type(self):
+        return self._class.type
+
+    @property
+    def author(self):
+        if isinstance(self._author, DBRef):
+            self._author = User.objects.with_id(self._author.id)
+        return self._author
+
+    def rendered_content(self):
+        if self._rendered_content is not None:
+            self._rendered_content = fields.decompress(self._rendered_content)
+            return self._rendered_content
+        # The entry type's method only relies on simple fields
+        return self._class.rendered_content.im_func(self)
+
+    def get_document(self):
+        """Get the full document for this entry.
+        """
+        if self._document is None:
+            self._document = self._class.objects.with_id(self.id)
+        return self._document
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get_document(), name)
+
+
+class EntryViews(object):
+    """A lazily-loaded list of :class:`EntryView` objects for the entries
+    matched by a queryset, most recently published first. Entries are only
+    fetched when a slice is requested, and then only the fields the views
+    use, so this may be passed straight to a
+    :class:`~django.core.paginator.Paginator`.
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def count(self):
+        return self.queryset.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start = key.start or 0
+        if key.stop is not None and key.stop <= start:
+            return []
+        # The projection can only be given when the cursor is created
+        cursor = self.queryset._collection.find(self.queryset._query,
+                                                fields=EntryView._projection)
+        cursor = cursor.sort('publish_date', -1).skip(start)
+        if key.stop is not None:
+            cursor = cursor.limit(key.stop - start)
+        return [EntryView.from_son(son) for son in cursor]
+
+
+def entry_views(queryset):
+    """Get a list of :class:`EntryView` objects for all the entries matched
+    by a queryset, most recently published first, bypassing document
+    construction. To get a slice of them, slice :class:`EntryViews` rather
+    than the queryset.
+    """
+    return EntryViews(queryset)[:]
+
 import core
@@ -4,6 +4,7 @@ from django import forms
 from mongoengine import *
 
 from mumblr.entrytypes import EntryType, Comment, markup
+from mumblr.entrytypes.fields import CompressedStringField
 
 
 class HtmlComment(Comment):
@@ -17,15 +18,17 @@ class TextEntry(EntryType):
     """An HTML-based entry, which will be converted from the markup language
     specified in the settings.
     """
-    content = StringField(required=True)
-    rendered_content = StringField(required=True)
+    content = CompressedStringField(required=True)
+    rendered_content = CompressedStringField(required=True)
 
     type = 'Text'
 
     def save(self):
-        """Convert any markup to HTML before saving.
+        """Convert any markup to HTML before saving, only rendering the
+        blocks that have changed.
         """
-        self.rendered_content = markup(self.content)
+        from mumblr import incremental
+        self.rendered_content = incremental.render(self.content)
         super(TextEntry, self).save()
 
     class AdminForm(EntryType.AdminForm):
@@ -37,7 +40,7 @@ class LinkEntry(EntryType):
     content is the optional description.
     """
     link_url = StringField(required=True)
-    description = StringField()
+    description = CompressedStringField()
 
     type = 'Link'
 
@@ -57,7 +60,7 @@ class ImageEntry(EntryType):
     the optional description.
     """
     image_url = StringField(required=True)
-    description = StringField()
+    description = CompressedStringField()
 
     type = 'Image'
 
@@ -78,7 +81,7 @@ class VideoEntry(EntryType):
     and known type e.g. YouTube
     """
     video_url = StringField(required=True)
-    description = StringField()
+    description = CompressedStringField()
 
     type = 'Video'
 
@@ -6,13 +6,47 @@ from django.utils.translation import ugettext_lazy as _
 from django.forms.widgets import Widget, Select, TextInput
 from django.forms.extras.widgets import SelectDateWidget
 
-import captcha
+from mongoengine import StringField
+from pymongo.binary import Binary
+import zlib
+
+
+# Strings at least this many bytes long are compressed when stored by a
+# CompressedStringField. None disables compression (compressed values are
+# still read).
+COMPRESS_THRESHOLD = getattr(settings, 'MUMBLR_COMPRESS_THRESHOLD', None)
+COMPRESSION = getattr(settings, 'MUMBLR_COMPRESSION', 'zlib')
+
+# Binary subtype used to mark compressed strings
+COMPRESSED_SUBTYPE = 0x80
+
+# Compressors and decompressors, keyed by the marker byte stored before the
+# compressed data
+_codecs = {
+    'z': (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+_markers = {'zlib': 'z', 'lzma': 'x'}
+
+
+def _get_codec(marker):
+    # lzma is only imported once it is needed
+    if marker == 'x' and marker not in _codecs:
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                return None
+        _codecs['x'] = (lzma.compress, lzma.decompress)
+    return _codecs.get(marker)
 
 
 class ReCaptcha(forms.widgets.Widget):
     """Renders the proper ReCaptcha widget
     """
     def render(self, name, value, attrs=None):
+        import captcha
         html = captcha.displayhtml(settings.RECAPTCHA_PUBLIC_KEY)
         return mark_safe(u'%s' % html)
 
@@ -34,6 +68,8 @@ class ReCaptchaField(forms.CharField):
         super(ReCaptchaField, self).__init__(*args, **kwargs)
 
     def clean(self, values):
+        # Only loaded if captchas are used, as it pulls in urllib2
+        import captcha
         super(ReCaptchaField, self).clean(values[1])
         recaptcha_challenge_value = smart_unicode(values[0])
         recaptcha_response_value = smart_unicode(values[1])
@@ -44,3 +80,72 @@ class ReCaptchaField(forms.CharField):
                     self.error_messages['captcha_invalid'])
         return values[0]
 
+
+
+class Compressed(object):
+    """A compressed string loaded from the database, which is only
+    decompressed when it is used.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def decompress(self):
+        marker, data = self.data[:1], self.data[1:]
+        return _get_codec(marker)[1](data).decode('utf-8')
+
+
+def decompress(value):
+    """Decompress a value stored by a :class:`CompressedStringField`, or
+    return it unchanged if it isn't compressed.
+    """
+    if isinstance(value, Binary) and value.subtype == COMPRESSED_SUBTYPE:
+        value = Compressed(value)
+    if isinstance(value, Compressed):
+        return value.decompress()
+    return value
+
+
+def compress(value):
+    """Compress a string for storage if it is large enough.
+    """
+    if COMPRESS_THRESHOLD is None:
+        return value
+    data = value.encode('utf-8')
+    if len(data) < COMPRESS_THRESHOLD:
+        return value
+    marker = _markers.get(COMPRESSION, 'z')
+    if _get_codec(marker) is None:
+        marker = 'z'
+    data = marker + _codecs[marker][0](data)
+    return Binary(data, COMPRESSED_SUBTYPE)
+
+
+class CompressedStringField(StringField):
+    """A string field that is stored compressed once it is longer than
+    ``MUMBLR_COMPRESS_THRESHOLD`` bytes. Values are decompressed the first
+    time they are accessed rather than when the document is loaded.
+    """
+
+    def __get__(self, instance, owner):
+        if instance is not None:
+            value = instance._data.get(self.name)
+            if isinstance(value, Compressed):
+                instance._data[self.name] = value.decompress()
+        return super(CompressedStringField, self).__get__(instance, owner)
+
+    def to_python(self, value):
+        if isinstance(value, Binary) and value.subtype == COMPRESSED_SUBTYPE:
+            return Compressed(value)
+        return super(CompressedStringField, self).to_python(value)
+
+    def to_mongo(self, value):
+        if isinstance(value, Compressed):
+            # Never accessed, so store it as it was loaded
+            return value.data
+        return compress(value)
+
+    def validate(self, value):
+        if not isinstance(value, Compressed):
+            super(CompressedStringField, self).validate(value)
@@ -0,0 +1,48 @@
+"""The site's RSS and Atom feeds, served by :func:`mumblr.views.core.feed`.
+"""
+from django.conf import settings
+from django.contrib.syndication.feeds import Feed
+from django.core.urlresolvers import reverse
+from django.utils.feedgenerator import Atom1Feed
+from django.utils.functional import lazy
+
+from mumblr.entrytypes import EntryType, EntryViews, prefetch_authors
+from mumblr.popular import popular_entries
+
+
+_lazy_reverse = lazy(reverse, str)
+
+class RssFeed(Feed):
+    title = getattr(settings, 'SITE_INFO_TITLE', 'Mumblr Recent Entries')
+    link = _lazy_reverse('recent-entries')
+    description = ""
+    title_template = 'mumblr/feeds/rss_title.html'
+    description_template = 'mumblr/feeds/rss_description.html'
+
+    def items(self):
+        return prefetch_authors(EntryViews(EntryType.live_entries)[:30])
+
+    def item_pubdate(self, item):
+        return item.publish_date
+
+
+class AtomFeed(RssFeed):
+    feed_type = Atom1Feed
+    subtitle = RssFeed.description
+    title_template = 'mumblr/feeds/atom_title.html'
+    description_template = 'mumblr/feeds/atom_description.html'
+
+
+class PopularFeed(RssFeed):
+    title = getattr(settings, 'SITE_INFO_TITLE', 'Mumblr') + ' Popular Entries'
+    description = "The most read entries this week"
+
+    def items(self):
+        return popular_entries('week')
+
+
+FEEDS = {
+    'rss': RssFeed,
+    'atom': AtomFeed,
+    'popular': PopularFeed,
+}
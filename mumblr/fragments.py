@@ -0,0 +1,93 @@
+"""Late-bound, per-user page fragments.
+
+Parts of a page that depend on who is viewing it - admin controls, the
+comment form with its CSRF token, the logged in user's details - are
+included in templates with the ``{% late %}`` tag rather than inline::
+
+    {% late "entry_admin" entry.id %}
+
+Normally this renders the fragment template in place, just like
+``{% include %}``. When a page is rendered for sharing between users (see
+:func:`mumblr.caching.render_shared`), the tag instead leaves a marker in the
+output, and :func:`render_late` fills the markers in separately for each
+request. The expensive, shared part of the page can then be cached once for
+all visitors.
+
+Fragment templates live in ``mumblr/themes/<theme>/fragments/<name>.html``,
+falling back to the default theme's.
+"""
+from django.conf import settings
+from django.template import RequestContext
+from django.template.loader import render_to_string, select_template
+from django.utils.safestring import mark_safe
+
+import re
+
+from mumblr.utils import get_user
+
+
+THEME = getattr(settings, 'MUMBLR_THEME', 'default')
+
+_marker_re = re.compile(r'<!--mumblr:late ([\w-]+)((?: [^ >]+)*)-->')
+
+
+def fragment_templates(name):
+    names = ['mumblr/themes/%s/fragments/%s.html' % (THEME, name)]
+    if THEME != 'default':
+        names.append('mumblr/themes/default/fragments/%s.html' % name)
+    return names
+
+
+def _comment_form(request, context):
+    # A form with errors may have been passed in from the view
+    if 'form' not in context and request is not None:
+        from mumblr.entrytypes import Comment
+        return {'form': Comment.CommentForm(get_user(request))}
+    return {}
+
+# Functions that provide extra context for particular fragments. Each takes
+# the request and the current context and returns a dict.
+FRAGMENT_CONTEXTS = {
+    'comment_form': _comment_form,
+}
+
+# Names given to the positional arguments of particular fragments
+FRAGMENT_ARGS = {
+    'entry_admin': ('entry_id',),
+    'comment_admin': ('comment_id',),
+}
+
+
+def make_marker(name, args):
+    args = ''.join(' %s' % arg for arg in args)
+    return mark_safe('<!--mumblr:late %s%s-->' % (name, args))
+
+
+def render_fragment(name, args, context):
+    """Render a fragment within the given context, which must have been
+    created with a request (i.e. a RequestContext).
+    """
+    request = context.get('request')
+    extra = dict(zip(FRAGMENT_ARGS.get(name, ()), args))
+    if name in FRAGMENT_CONTEXTS:
+        extra.update(FRAGMENT_CONTEXTS[name](request, context))
+
+    context.update(extra)
+    try:
+        template = select_template(fragment_templates(name))
+        return template.render(context)
+    finally:
+        context.pop()
+
+
+def render_late(request, content):
+    """Fill in the late-bound fragment markers in some rendered content.
+    """
+    if '<!--mumblr:late ' not in content:
+        return content
+
+    context = RequestContext(request, {'request': request})
+    def replace(match):
+        name, args = match.groups()
+        return render_fragment(name, args.split(), context).encode('utf-8')
+    return _marker_re.sub(replace, content)
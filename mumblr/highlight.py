@@ -0,0 +1,135 @@
+"""Caching the output of pygments for code blocks.
+
+Highlighting is usually most of the cost of rendering a post with code in
+it, and the same code blocks are highlighted again whenever the post,
+a comment or a link description is rendered. With pygments installed,
+:func:`mumblr.entrytypes.markup` calls :func:`install`, which makes the
+``codehilite`` Markdown extension look each block up here first.
+
+Blocks are keyed by a hash of their source (which includes any ``:::lang``
+or shebang line that picks the lexer) and the extension's options. The
+highlighted HTML is kept in memory by each process, evicting the least
+recently used blocks once ``MUMBLR_HIGHLIGHT_CACHE_SIZE`` bytes are held.
+If ``MUMBLR_HIGHLIGHT_PERSIST`` is set, blocks are also stored in Django's
+cache, so that they survive restarts and are shared between processes.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+import threading
+
+
+# Bytes of highlighted HTML kept in memory by each process
+CACHE_SIZE = getattr(settings, 'MUMBLR_HIGHLIGHT_CACHE_SIZE', 4 << 20)
+
+# Whether to also keep highlighted blocks in Django's cache
+PERSIST = getattr(settings, 'MUMBLR_HIGHLIGHT_PERSIST', False)
+
+PERSIST_TIMEOUT = 60 * 60 * 24 * 7
+
+_lock = threading.Lock()
+_blocks = {}
+_size = 0
+_tick = 0
+
+# Lookups and misses since the process started
+stats = {'hits': 0, 'misses': 0}
+
+
+def highlight_key(src, options):
+    """The cache key for a code block highlighted with the given options.
+    """
+    options = sorted((k, v) for k, v in options.items() if k != 'src')
+    digest = md5_constructor(smart_str(src))
+    digest.update(repr(options))
+    return 'mumblr:highlight:%s' % digest.hexdigest()
+
+
+def get(key):
+    global _tick
+    with _lock:
+        if key in _blocks:
+            _tick += 1
+            html = _blocks[key][0]
+            _blocks[key] = (html, _tick)
+            stats['hits'] += 1
+            return html
+    if PERSIST:
+        html = cache.get(key)
+        if html is not None:
+            _remember(key, html)
+            stats['hits'] += 1
+            return html
+    stats['misses'] += 1
+    return None
+
+
+def _remember(key, html):
+    global _size, _tick
+    if len(html) > CACHE_SIZE:
+        return
+    with _lock:
+        if key in _blocks:
+            _size -= len(_blocks[key][0])
+        _tick += 1
+        _blocks[key] = (html, _tick)
+        _size += len(html)
+        if _size > CACHE_SIZE:
+            # Evict the least recently used blocks down to three quarters of
+            # the limit, so that eviction doesn't happen on every insert
+            by_age = sorted(_blocks.items(), key=lambda item: item[1][1])
+            for old_key, (old_html, used) in by_age:
+                if _size <= CACHE_SIZE * 3 // 4:
+                    break
+                del _blocks[old_key]
+                _size -= len(old_html)
+
+
+def put(key, html):
+    _remember(key, html)
+    if PERSIST:
+        cache.set(key, html, PERSIST_TIMEOUT)
+
+
+def clear():
+    """Empty this process's cache of highlighted blocks.
+    """
+    global _size
+    with _lock:
+        _blocks.clear()
+        _size = 0
+        stats['hits'] = stats['misses'] = 0
+
+
+_installed = False
+
+
+def install():
+    """Make the ``codehilite`` Markdown extension use the cache. Safe to
+    call more than once.
+    """
+    global _installed
+    if _installed:
+        return
+    from markdown.extensions import codehilite
+    with _lock:
+        if _installed:
+            return
+        base = codehilite.CodeHilite
+
+        # Older versions of Markdown define CodeHilite as an old-style class,
+        # so super() can't be used
+        class CachedCodeHilite(base):
+            def hilite(self):
+                key = highlight_key(self.src, self.__dict__)
+                html = get(key)
+                if html is None:
+                    html = base.hilite(self)
+                    put(key, html)
+                return html
+
+        # The extension's tree processor looks the class up in its module
+        codehilite.CodeHilite = CachedCodeHilite
+        _installed = True
@@ -0,0 +1,145 @@
+"""Rendering long Markdown documents a block at a time.
+
+Editing a long post usually changes only a paragraph or two, but rendering
+it with :func:`mumblr.entrytypes.markup` processes the whole document.
+:func:`render` splits the text into its top-level blocks (paragraphs, lists,
+code blocks, block quotes, raw HTML blocks...) and renders each one
+separately, keeping the HTML for each block in the cache keyed by a hash of
+its source. Only blocks that have changed since they were last rendered are
+passed to Markdown, which makes rendering on save and the live preview in
+the admin cheap. The blocks that do need rendering share one Markdown
+instance, so that a cold cache costs little more than rendering the whole
+document.
+
+Reference link and abbreviation definitions can be used from any block, so
+they are collected from the whole document and rendered along with every
+block (and included in its cache key). Footnotes are numbered across the
+whole document and ``[TOC]`` lists every heading, so text using either is
+rendered in one go. Header ids are made unique across blocks afterwards, as
+Markdown would have done.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+import re
+
+
+BLOCK_TIMEOUT = getattr(settings, 'MUMBLR_BLOCK_CACHE_TIMEOUT', 60 * 60 * 24)
+
+_fence_re = re.compile(r'^(~{3,}|`{3,})')
+_list_re = re.compile(r'^ {0,3}([*+-]|\d+\.)\s')
+# Reference links and abbreviations
+_definition_re = re.compile(r'^ {0,3}\[[^\]^][^\]]*\]:\s*\S|^\*\[[^\]]+\]:')
+_footnote_re = re.compile(r'^ {0,3}\[\^[^\]]+\]:', re.M)
+_html_re = re.compile(r'^<(p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|'
+                      r'script|noscript|form|fieldset|iframe|math|ins|del|'
+                      r'style)\b', re.I)
+_header_id_re = re.compile(r'(<h[1-6][^>]* id=")([^"]+)(")')
+
+
+def _continues(lines, line):
+    """Whether ``line``, which follows a blank line, belongs to the same
+    top-level block as ``lines``.
+    """
+    first = lines[0]
+    if line[:1] in (' ', '\t'):
+        # Code, or a paragraph in a list item
+        return True
+    if _list_re.match(line) and _list_re.match(first):
+        return True
+    if line.startswith('>') and first.startswith('>'):
+        return True
+    match = _html_re.match(first)
+    if match:
+        # Raw HTML blocks run until their closing tag
+        closing = re.compile('</%s>' % match.group(1), re.I)
+        return not closing.search('\n'.join(lines))
+    return False
+
+
+def split_blocks(text):
+    """Split Markdown text into its top-level blocks. Returns a list of the
+    blocks and a list of the definition lines removed from them.
+    """
+    blocks, definitions = [], []
+    lines = []
+    blank = 0
+    fence = None
+    for line in text.splitlines():
+        if fence is not None:
+            lines.append(line)
+            if line.strip().startswith(fence):
+                fence = None
+            continue
+        if not line.strip():
+            if lines:
+                blank += 1
+            continue
+        if _definition_re.match(line):
+            definitions.append(line)
+            continue
+        if blank and not _continues(lines, line):
+            blocks.append('\n'.join(lines))
+            lines = []
+        elif blank:
+            lines.extend([''] * blank)
+        blank = 0
+        lines.append(line)
+        match = _fence_re.match(line)
+        if match:
+            fence = match.group(1)
+    if lines:
+        blocks.append('\n'.join(lines))
+    return blocks, definitions
+
+
+def _unique_ids(html):
+    seen = set()
+
+    def unique(match):
+        id = match.group(2)
+        while id in seen:
+            numbered = re.match(r'^(.*)_([0-9]+)$', id)
+            if numbered:
+                id = '%s_%d' % (numbered.group(1), int(numbered.group(2)) + 1)
+            else:
+                id = '%s_1' % id
+        seen.add(id)
+        return match.group(1) + id + match.group(3)
+    return _header_id_re.sub(unique, html)
+
+
+def block_key(block, definitions, options):
+    digest = md5_constructor(smart_str(block))
+    digest.update(smart_str(definitions))
+    digest.update(repr(sorted(options.items())))
+    return 'mumblr:block:%s' % digest.hexdigest()
+
+
+def render(text, **options):
+    """Render ``text`` like :func:`mumblr.entrytypes.markup` (taking the same
+    options), only rendering the blocks that aren't already in the cache.
+    """
+    from mumblr.entrytypes import markup, markup_many, MARKUP_LANGUAGE
+
+    if (MARKUP_LANGUAGE != 'markdown' or '[TOC]' in text or
+        _footnote_re.search(text)):
+        return markup(text, **options)
+
+    blocks, definitions = split_blocks(text)
+    definitions = '\n'.join(definitions)
+    keys = [block_key(block, definitions, options) for block in blocks]
+    rendered = cache.get_many(keys)
+    sources = {}
+    for key, block in zip(keys, blocks):
+        if key not in rendered:
+            sources[key] = ('%s\n\n%s' % (block, definitions) if definitions
+                            else block)
+    if sources:
+        missing = dict(zip(sources.keys(),
+                           markup_many(sources.values(), **options)))
+        rendered.update(missing)
+        cache.set_many(missing, BLOCK_TIMEOUT)
+    return _unique_ids('\n'.join(rendered[key] for key in keys))
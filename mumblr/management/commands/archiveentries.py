@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from optparse import make_option
+
+from mumblr.coldstorage import archive_entries
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=100, help='Number of entries to move at a time'),
+        make_option('--drafts', dest='drafts_days', type='int', default=None,
+                    help='Also archive unpublished entries that have not '
+                    'been modified for this many days'),
+    )
+
+    def handle(self, **kwargs):
+        moved = archive_entries(kwargs.get('batch_size') or 100,
+                                kwargs.get('drafts_days'))
+        print '%d entries moved to cold storage' % moved
@@ -0,0 +1,88 @@
+from django.core.cache.backends.locmem import CacheClass as LocMemCache
+from django.core.management.base import BaseCommand
+
+from multiprocessing import Process, Queue
+from optparse import make_option
+import random
+import shutil
+import tempfile
+import time
+import zlib
+
+from mumblr.mmapcache import CacheClass as MmapCache
+
+
+def _worker(make_cache, options, seed, results):
+    cache = make_cache()
+    rand = random.Random(seed)
+    page = ('<p>%s</p>' % ('x' * 80)) * (options['page_size'] // 88)
+    hits = 0
+    start = time.time()
+    for i in range(options['requests']):
+        # Popular pages are requested far more often than others
+        key = 'page:%d' % int(options['pages'] * rand.random() ** 3)
+        if cache.get(key) is not None:
+            hits += 1
+            continue
+        # Stand in for rendering the page
+        for j in range(options['render_cost']):
+            zlib.compress(page + str(j))
+        cache.set(key, page, 300)
+    results.put((hits, time.time() - start))
+
+
+class Command(BaseCommand):
+
+    help = ('Compare the shared memory-mapped cache with the per-process '
+            'local memory cache, using several worker processes')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=8,
+                    help='Number of worker processes (default 8)'),
+        make_option('--requests', dest='requests', type='int', default=5000,
+                    help='Requests made by each worker'),
+        make_option('--pages', dest='pages', type='int', default=500,
+                    help='Number of distinct pages'),
+        make_option('--page-size', dest='page_size', type='int',
+                    default=20000, help='Size of each page in bytes'),
+        make_option('--render-cost', dest='render_cost', type='int',
+                    default=5, help='Work done to render a page on a miss'),
+        make_option('--cache-size', dest='cache_size', type='int',
+                    default=64, help='Size of the shared cache in megabytes'),
+    )
+
+    def _run(self, make_cache, options):
+        results = Queue()
+        workers = [Process(target=_worker,
+                           args=(make_cache, options, seed, results))
+                   for seed in range(options['workers'])]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        outcomes = [results.get() for worker in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+
+        total = options['requests'] * options['workers']
+        hits = sum(hits for hits, worker_time in outcomes)
+        return total / elapsed, 100.0 * hits / total
+
+    def handle(self, **options):
+        path = tempfile.mkdtemp(prefix='mumblr-bench-')
+        size = options['cache_size']
+        backends = (
+            ('locmem', lambda: LocMemCache('', {'max_entries': 100000})),
+            ('mmap', lambda: MmapCache(path + '/cache', {'size': size})),
+        )
+        try:
+            # Create the shared file before forking the workers
+            MmapCache(path + '/cache', {'size': size}).clear()
+            print '%d workers, %d requests each' % (options['workers'],
+                                                   options['requests'])
+            for name, make_cache in backends:
+                rate, hit_rate = self._run(make_cache, options)
+                print '%-8s %10.0f requests/s %6.1f%% hits' % (name, rate,
+                                                              hit_rate)
+        finally:
+            shutil.rmtree(path)
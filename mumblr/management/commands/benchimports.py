@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from optparse import make_option
+import os
+import subprocess
+import sys
+
+
+DEFAULT_MODULES = ('mumblr', 'mumblr.views.core', 'mumblr.views.admin',
+                   'mumblr.urls')
+
+# Modules that should only be loaded when they are actually needed
+HEAVY_MODULES = ('markdown', 'pygments', 'django.contrib.syndication',
+                 'unittest', 'mumblr.entrytypes.captcha', 'urllib2', 'lzma',
+                 'numpy', 'scipy')
+
+SCRIPT = '''
+import sys, time
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+heavy = [name for name in %r if name in sys.modules]
+print elapsed, len(sys.modules), ','.join(heavy)
+'''
+
+
+class Command(BaseCommand):
+
+    args = '[module ...]'
+    help = ('Measure how long mumblr modules take to import in a fresh '
+            'interpreter, and which heavy modules they load')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', type='int', default=5,
+                    help='Number of times to import each module; the '
+                    'fastest time is reported'),
+    )
+
+    def _measure(self, module):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.Popen(
+            [sys.executable, '-c', SCRIPT % (module, HEAVY_MODULES)],
+            stdout=subprocess.PIPE, env=env).communicate()[0]
+        elapsed, num_modules, heavy = (output.strip().split(' ', 2) +
+                                       [''])[:3]
+        return float(elapsed), int(num_modules), heavy
+
+    def handle(self, *modules, **kwargs):
+        modules = modules or DEFAULT_MODULES
+        print '%-24s %10s %8s  %s' % ('module', 'time (ms)', 'modules',
+                                      'heavy modules loaded')
+        for module in modules:
+            results = [self._measure(module) for i in range(kwargs['repeat'])]
+            elapsed, num_modules, heavy = min(results)
+            print '%-24s %10.1f %8d  %s' % (module, elapsed * 1000,
+                                            num_modules, heavy or '-')
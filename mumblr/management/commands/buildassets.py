@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from mumblr.assets import build_bundles, BUNDLES
+
+
+class Command(BaseCommand):
+
+    args = '[theme ...]'
+    help = 'Build minified, content-hashed CSS and JS bundles for themes'
+
+    def handle(self, *themes, **kwargs):
+        themes = themes or BUNDLES.keys()
+        for theme in themes:
+            manifest = build_bundles(theme)
+            for type, path in manifest.items():
+                print '[%s] %s: %s' % (theme, type, path)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from optparse import make_option
+
+from mumblr.staticsite import build
+
+
+class Command(BaseCommand):
+
+    args = '<output_dir>'
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Render every page, ignoring the build manifest'),
+        make_option('--processes', dest='processes', type='int', default=None,
+                    help='Number of worker processes (defaults to the '
+                    'number of CPUs)'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if len(args) != 1:
+            raise CommandError('Usage: buildstatic %s' % self.args)
+
+        results = build(args[0], kwargs['full'], kwargs['processes'])
+        for url, status_code in results:
+            if status_code != 200:
+                print 'Error %d rendering %s' % (status_code, url)
+        print '%d pages rendered' % len(results)
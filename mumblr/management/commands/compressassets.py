@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+
+import os
+
+import mumblr
+from mumblr.caching import compress_gzip, brotli
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.html', '.txt', '.otf',
+                           '.eot')
+
+
+class Command(BaseCommand):
+
+    args = '[static_dir ...]'
+    help = ('Write precompressed .gz (and .br, if brotli is installed) '
+            'copies of theme assets for the web server to serve directly')
+
+    def _write_variant(self, path, suffix, compress):
+        """Write a compressed copy of a file if it is missing or stale.
+        """
+        target = path + suffix
+        if (os.path.exists(target) and
+            os.path.getmtime(target) >= os.path.getmtime(path)):
+            return False
+        content = open(path, 'rb').read()
+        f = open(target, 'wb')
+        try:
+            f.write(compress(content))
+        finally:
+            f.close()
+        return True
+
+    def handle(self, *args, **kwargs):
+        dirs = args or [os.path.join(os.path.dirname(mumblr.__file__),
+                                     'static', 'mumblr', 'themes')]
+        count = 0
+        for static_dir in dirs:
+            for root, dirnames, filenames in os.walk(static_dir):
+                for name in filenames:
+                    if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                        continue
+                    path = os.path.join(root, name)
+                    count += self._write_variant(path, '.gz', compress_gzip)
+                    if brotli is not None:
+                        count += self._write_variant(path, '.br',
+                                                     brotli.compress)
+        print '%d compressed files written' % count
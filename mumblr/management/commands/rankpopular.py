@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from mumblr.popular import rank_popular
+
+
+class Command(BaseCommand):
+
+    def handle(self, **kwargs):
+        rank_popular()
+        print 'Popular entries ranked'
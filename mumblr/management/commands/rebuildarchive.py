@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from mumblr.archive import rebuild_histogram
+
+
+class Command(BaseCommand):
+
+    def handle(self, **kwargs):
+        rebuild_histogram()
+        print 'Archive histogram rebuilt'
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from optparse import make_option
+
+from mumblr.related import rebuild_related
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--text-weight', dest='text_weight', type='float',
+                    default=None, help='Weight given to text similarity, '
+                    'from 0.0 (tags only) to 1.0 (text only)'),
+    )
+
+    def handle(self, **kwargs):
+        rebuild_related(kwargs.get('text_weight'))
+        print 'Related entries rebuilt'
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from mumblr import caching
+from mumblr.archive import refresh_histogram
+
+
+class Command(BaseCommand):
+
+    help = ('Update the archive histogram for entries that have expired or '
+            'become due since they were saved')
+
+    def handle(self, **kwargs):
+        moved = refresh_histogram()
+        if moved:
+            caching.invalidate()
+        print '%d entries moved in the archive histogram' % moved
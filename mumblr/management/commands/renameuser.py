@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from mongoengine.django.auth import User
+
+from mumblr.entrytypes import update_author_name
+
+
+class Command(BaseCommand):
+
+    def _get_string(self, prompt, reader_func=raw_input):
+        """Helper method to get a non-empty string.
+        """
+        string = ''
+        while not string:
+            string = reader_func(prompt + ': ')
+        return string
+
+    def handle(self, **kwargs):
+        username = self._get_string('Username')
+        user = User.objects(username=username).first()
+        if not user:
+            print 'Error! Could not find user with username "%s"' % username
+            return
+
+        user.first_name = self._get_string('First name')
+        user.last_name = self._get_string('Last name')
+        user.save()
+
+        # Keep the author names stored on entries in sync
+        update_author_name(user)
+        print 'User "%s" renamed to "%s %s"' % (username, user.first_name,
+                                                user.last_name)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from optparse import make_option
+
+import mumblr
+
+
+class Command(BaseCommand):
+
+    help = ('Initialise markup, templates and other lazily loaded parts of '
+            'mumblr, and optionally fill the cache with the top pages')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--pages', dest='pages', type='int', default=0,
+                    help='Render the main pages and this many of the most '
+                    'popular entries into the cache'),
+        make_option('--no-templates', action='store_false', dest='templates',
+                    default=True, help="Don't compile the theme templates"),
+    )
+
+    def handle(self, **kwargs):
+        stats = mumblr.warmup(templates=kwargs['templates'],
+                              pages=kwargs['pages'])
+        print '%d templates compiled' % stats['templates']
+        print '%d pages cached' % len(stats['pages'])
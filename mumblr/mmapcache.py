@@ -0,0 +1,323 @@
+"""A cache backend shared by all processes on a host, stored in a
+memory-mapped file.
+
+Under a pre-forking server each worker otherwise has its own cache, so every
+worker renders every page, and the same pages are held in memory once per
+worker. With this backend all workers use the same cache, without needing a
+separate cache daemon::
+
+    CACHE_BACKEND = 'mumblr.mmapcache:///var/tmp/mumblr-cache?size=64'
+
+where ``size`` is the size of the cache file in megabytes. The size is
+added to the file's name (``/var/tmp/mumblr-cache.64m`` here), so that
+processes configured with a different size - e.g. during a deploy that
+changes it - use a separate file rather than resizing one that others have
+mapped.
+
+The file is divided into slab classes of fixed-size slots (4KB, 16KB, 64KB,
+256KB and 1MB), each class getting an equal share of the file. A value is
+stored in the smallest class it fits in; values over 1MB aren't cached.
+Within a class, slots are grouped into sets of :data:`WAYS` slots, and a key
+may only be stored in the set its hash picks, replacing the least recently
+used slot of the set when it is full.
+
+Writers lock only the set they are writing to (and a stripe lock for the key,
+so that :meth:`CacheClass.add` is atomic), using ``fcntl`` byte-range locks
+between processes. Readers take no locks: each slot has a sequence number
+that writers make odd while they are changing the slot, and a reader retries
+if the sequence number was odd or changed while it was reading.
+"""
+from django.core.cache.backends.base import BaseCache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+import cPickle as pickle
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+MAGIC = 'MUMBLRC1'
+HEADER = struct.Struct('<8sQQ')   # magic, file size, page size
+SLOT_HEADER = struct.Struct('<Q16sddI')   # seq, key hash, expires, used, len
+SLOT_SEQ = struct.Struct('<Q')
+SLOT_FIELDS = struct.Struct('<16sddI')   # the rest of the slot header
+SLOT_HEADER_SIZE = 48
+SLOT_SIZES = (4 << 10, 16 << 10, 64 << 10, 256 << 10, 1 << 20)
+WAYS = 8
+
+# Number of key stripe locks, used to make add() atomic
+STRIPES = 1024
+
+READ_RETRIES = 10
+
+
+class SlabClass(object):
+    """A region of the cache file holding slots of a single size.
+    """
+
+    def __init__(self, offset, slot_size, num_sets, lock_base):
+        self.offset = offset
+        self.slot_size = slot_size
+        self.num_sets = num_sets
+        self.lock_base = lock_base
+
+    @property
+    def capacity(self):
+        return self.slot_size - SLOT_HEADER_SIZE
+
+    @property
+    def size(self):
+        return self.num_sets * WAYS * self.slot_size
+
+    def set_for(self, hash):
+        return struct.unpack('<Q', hash[:8])[0] % self.num_sets
+
+    def slots(self, set_index):
+        start = self.offset + set_index * WAYS * self.slot_size
+        return [start + way * self.slot_size for way in range(WAYS)]
+
+
+class CacheClass(BaseCache):
+
+    def __init__(self, path, params):
+        BaseCache.__init__(self, params)
+        size_mb = int(params.get('size', 64))
+        self._path = '%s.%dm' % (path or '/var/tmp/mumblr-cache', size_mb)
+        size = size_mb << 20
+        self._lock = threading.Lock()
+        self._pid = None
+        self._layout(size)
+        self._open()
+
+    def _layout(self, size):
+        page = mmap.PAGESIZE
+        self._classes = []
+        offset = page
+        share = (size - page) // len(SLOT_SIZES)
+        lock_base = STRIPES
+        for slot_size in SLOT_SIZES:
+            num_sets = max(share // (slot_size * WAYS), 1)
+            slab = SlabClass(offset, slot_size, num_sets, lock_base)
+            self._classes.append(slab)
+            offset += slab.size
+            lock_base += num_sets
+        self._size = offset
+
+    def _open(self):
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            # Only one process may (re)initialise the file
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                file_size = os.fstat(fd).st_size
+                if file_size and file_size != self._size:
+                    # Other processes may have it mapped at its current size,
+                    # and would crash if it were truncated
+                    raise ValueError('Cache file %s is %d bytes, expected %d'
+                                     % (self._path, file_size, self._size))
+                if not file_size:
+                    os.ftruncate(fd, self._size)
+                self._map = mmap.mmap(fd, self._size, mmap.MAP_SHARED,
+                                      mmap.PROT_READ | mmap.PROT_WRITE)
+                header = HEADER.unpack_from(self._map, 0)
+                if header != (MAGIC, self._size, mmap.PAGESIZE):
+                    self._map[:mmap.PAGESIZE] = '\0' * mmap.PAGESIZE
+                    for slab in self._classes:
+                        self._zero(slab)
+                    HEADER.pack_into(self._map, 0, MAGIC, self._size,
+                                     mmap.PAGESIZE)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+        except:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def _zero(self, slab):
+        # Only the slot headers need clearing
+        empty = '\0' * SLOT_HEADER_SIZE
+        for set_index in range(slab.num_sets):
+            for offset in slab.slots(set_index):
+                self._map[offset:offset + SLOT_HEADER_SIZE] = empty
+
+    def _locked(self, start):
+        """Take the lock at ``start`` in the lock space shared between
+        processes. As fcntl locks don't exclude other threads of the same
+        process, callers must also hold the process's own lock.
+        """
+        cache = self
+
+        class Lock(object):
+            def __enter__(self):
+                fcntl.lockf(cache._fd, fcntl.LOCK_EX, 1, start + 1)
+
+            def __exit__(self, *exc_info):
+                fcntl.lockf(cache._fd, fcntl.LOCK_UN, 1, start + 1)
+        return Lock()
+
+    def _hash(self, key):
+        return md5_constructor(smart_str(key)).digest()
+
+    def _read(self, offset, hash):
+        """Read the value in a slot if it holds ``hash``. Returns a tuple of
+        (found, expired, data).
+        """
+        for attempt in range(READ_RETRIES):
+            seq, slot_hash, expires, used, length = \
+                SLOT_HEADER.unpack_from(self._map, offset)
+            if seq & 1:
+                continue
+            if slot_hash != hash or not seq:
+                return False, False, None
+            start = offset + SLOT_HEADER_SIZE
+            data = self._map[start:start + length]
+            if SLOT_HEADER.unpack_from(self._map, offset)[0] != seq:
+                continue
+            return True, expires and expires < time.time(), data
+        return False, False, None
+
+    def _find(self, hash):
+        """Find the slot holding ``hash``, returning its slab class and
+        offset.
+        """
+        for slab in self._classes:
+            for offset in slab.slots(slab.set_for(hash)):
+                if SLOT_HEADER.unpack_from(self._map, offset)[1] == hash:
+                    return slab, offset
+        return None, None
+
+    def _write_slot(self, offset, hash, expires, data):
+        seq = SLOT_SEQ.unpack_from(self._map, offset)[0]
+        if not seq & 1:
+            seq += 1
+        SLOT_SEQ.pack_into(self._map, offset, seq)
+        start = offset + SLOT_HEADER_SIZE
+        self._map[start:start + len(data)] = data
+        # The even sequence number must be the last thing written, so readers
+        # never see it alongside the old hash or length
+        SLOT_FIELDS.pack_into(self._map, offset + SLOT_SEQ.size, hash,
+                              expires, time.time(), len(data))
+        SLOT_SEQ.pack_into(self._map, offset, seq + 1)
+
+    def _clear_slot(self, offset):
+        seq = SLOT_SEQ.unpack_from(self._map, offset)[0] | 1
+        SLOT_SEQ.pack_into(self._map, offset, seq)
+        SLOT_FIELDS.pack_into(self._map, offset + SLOT_SEQ.size, '\0' * 16,
+                              0, 0, 0)
+        SLOT_SEQ.pack_into(self._map, offset, seq + 1)
+
+    def _remove(self, slab, offset, hash):
+        with self._locked(slab.lock_base + slab.set_for(hash)):
+            # The slot may have been reused since it was found
+            if SLOT_HEADER.unpack_from(self._map, offset)[1] == hash:
+                self._clear_slot(offset)
+
+    def _store(self, hash, value, timeout):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        slabs = [s for s in self._classes if s.capacity >= len(data)]
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout
+
+        # Remove any copy in a different slab class
+        slab, offset = self._find(hash)
+        if slab is not None and (not slabs or slab is not slabs[0]):
+            self._remove(slab, offset, hash)
+        if not slabs:
+            return
+
+        slab = slabs[0]
+        set_index = slab.set_for(hash)
+        with self._locked(slab.lock_base + set_index):
+            # Use the key's own slot, an empty or expired slot, or else the
+            # least recently used one
+            now = time.time()
+            best, best_used = None, None
+            for offset in slab.slots(set_index):
+                seq, slot_hash, slot_expires, used, length = \
+                    SLOT_HEADER.unpack_from(self._map, offset)
+                if slot_hash == hash:
+                    best = offset
+                    break
+                if slot_hash == '\0' * 16 or (slot_expires and
+                                                slot_expires < now):
+                    used = 0
+                if best is None or used < best_used:
+                    best, best_used = offset, used
+            self._write_slot(best, hash, expires, data)
+
+    def _check_fork(self):
+        # Locks are per process, but the mapping survives a fork
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def get(self, key, default=None):
+        hash = self._hash(key)
+        for slab in self._classes:
+            for offset in slab.slots(slab.set_for(hash)):
+                found, expired, data = self._read(offset, hash)
+                if not found:
+                    continue
+                if expired:
+                    return default
+                # Updated without locking - an occasional lost update only
+                # makes the LRU order slightly less accurate
+                struct.pack_into('<d', self._map, offset + 32, time.time())
+                try:
+                    return pickle.loads(data)
+                except Exception:
+                    return default
+        return default
+
+    def set(self, key, value, timeout=None):
+        self._check_fork()
+        hash = self._hash(key)
+        stripe = struct.unpack('<I', hash[8:12])[0] % STRIPES
+        with self._lock:
+            with self._locked(stripe):
+                self._store(hash, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        self._check_fork()
+        hash = self._hash(key)
+        stripe = struct.unpack('<I', hash[8:12])[0] % STRIPES
+        with self._lock:
+            with self._locked(stripe):
+                slab, offset = self._find(hash)
+                if slab is not None:
+                    found, expired, data = self._read(offset, hash)
+                    if found and not expired:
+                        return False
+                self._store(hash, value, timeout)
+                return True
+
+    def delete(self, key):
+        self._check_fork()
+        hash = self._hash(key)
+        stripe = struct.unpack('<I', hash[8:12])[0] % STRIPES
+        with self._lock:
+            with self._locked(stripe):
+                slab, offset = self._find(hash)
+                if slab is not None:
+                    self._remove(slab, offset, hash)
+
+    def has_key(self, key):
+        return self.get(key, self) is not self
+
+    def clear(self):
+        self._check_fork()
+        with self._lock:
+            for slab in self._classes:
+                for set_index in range(slab.num_sets):
+                    with self._locked(slab.lock_base + set_index):
+                        for offset in slab.slots(set_index):
+                            self._clear_slot(offset)
+
+    def close(self, **kwargs):
+        pass
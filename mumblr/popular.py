@@ -0,0 +1,284 @@
+"""Counting entry views and ranking the most popular entries.
+
+Writing to the database on every page view would double the write load, so
+hits are counted in memory by each process and flushed periodically by a
+background thread, with one upsert per entry that was viewed. Hits are kept
+in per-day :class:`EntryHits` buckets, from which a ranking is computed for
+each window in :data:`WINDOWS` and stored as a :class:`PopularEntries`
+document - displaying popular entries is then a single lookup.
+
+Hits are counted by permalink (publish date and slug), so pages served from
+the cache are counted without looking the entry up. Counts buffered in a
+process are flushed when it exits; if it dies without exiting cleanly, at
+most ``MUMBLR_HITS_FLUSH_INTERVAL`` seconds of hits are lost.
+"""
+from django.conf import settings
+
+from mongoengine import *
+
+from datetime import datetime, timedelta
+import atexit
+import os
+import threading
+import time
+
+
+# Seconds between flushes of the buffered hit counts
+FLUSH_INTERVAL = getattr(settings, 'MUMBLR_HITS_FLUSH_INTERVAL', 30)
+
+# Seconds between recomputing the rankings
+RANK_INTERVAL = getattr(settings, 'MUMBLR_POPULAR_RANK_INTERVAL', 300)
+
+# Number of entries kept in each ranking
+NUM_POPULAR = getattr(settings, 'MUMBLR_POPULAR_ENTRIES', 30)
+
+# Rolling windows rankings are computed over, in days
+WINDOWS = {
+    'day': 1,
+    'week': 7,
+    'month': 30,
+}
+
+
+class EntryHits(Document):
+    """The number of times an entry was viewed on a given day.
+    """
+    entry = ObjectIdField(required=True)
+    day = DateTimeField(required=True)
+    hits = IntField(default=0)
+
+    meta = {
+        'collection': 'entry_hits',
+        'indexes': [('day', 'entry')],
+    }
+
+
+class PopularEntries(Document):
+    """The most viewed entries over a window, most popular first.
+    """
+    window = StringField(required=True, unique=True)
+    entries = ListField(ObjectIdField())
+    hits = ListField(IntField())
+    computed_date = DateTimeField()
+
+    meta = {
+        'collection': 'popular_entries',
+    }
+
+
+# Whether buffered hits are flushed by a background thread. If not,
+# flush() must be called periodically.
+BACKGROUND_FLUSH = getattr(settings, 'MUMBLR_HITS_BACKGROUND_FLUSH', True)
+
+_lock = threading.Lock()
+_hits = {}
+_pid = None
+_last_ranked = 0
+_flusher = None
+_stopping = None
+
+
+def record_hit(date, slug):
+    """Count a view of the entry with the given permalink date and slug.
+    """
+    global _pid
+    with _lock:
+        if _pid != os.getpid():
+            # Either the first hit, or the process has been forked since the
+            # flusher was started - hits buffered in the parent belong to it
+            if _pid is None:
+                atexit.register(flush, rank=False)
+            _hits.clear()
+            _pid = os.getpid()
+            _start_flusher()
+        key = (date, slug)
+        _hits[key] = _hits.get(key, 0) + 1
+
+
+def pending_hits():
+    """The hits counted by this process that haven't been flushed yet, as a
+    dict mapping (date, slug) to the number of hits.
+    """
+    with _lock:
+        return dict(_hits)
+
+
+def _start_flusher():
+    global _flusher, _stopping
+    if not BACKGROUND_FLUSH:
+        return
+    stopping = _stopping = threading.Event()
+
+    def run():
+        while True:
+            stopping.wait(FLUSH_INTERVAL)
+            if stopping.isSet():
+                return
+            try:
+                flush()
+            except Exception:
+                # Keep counting - the hits will be retried next time
+                pass
+    _flusher = threading.Thread(target=run, name='mumblr-hits')
+    _flusher.daemon = True
+    _flusher.start()
+
+
+def stop_flusher():
+    """Stop the background flusher, waiting for a flush in progress to
+    finish. Hits are still counted, but are only written by :func:`flush`.
+    """
+    global _flusher
+    if _flusher is not None:
+        _stopping.set()
+        _flusher.join()
+        _flusher = None
+
+
+def _resolve_entries(keys):
+    """Look up the ids of the entries with the given (date, slug) permalinks
+    with a single query. Returns a dict mapping permalinks to ids.
+    """
+    from mumblr.entrytypes import EntryType
+
+    days = {}
+    for date, slug in keys:
+        try:
+            days[(datetime.strptime(date, '%Y/%b/%d'), slug)] = (date, slug)
+        except ValueError:
+            continue
+    if not days:
+        return {}
+    start = min(day for day, slug in days)
+    end = max(day for day, slug in days) + timedelta(days=1)
+    slugs = list(set(slug for day, slug in days))
+    entries = EntryType.objects(slug__in=slugs, publish_date__gte=start,
+                                publish_date__lt=end)
+    ids = {}
+    for entry in entries.only('id', 'slug', 'publish_date'):
+        date = entry.publish_date
+        key = days.get((datetime(date.year, date.month, date.day), entry.slug))
+        if key is not None:
+            ids[key] = entry.id
+    return ids
+
+
+def flush(rank=True):
+    """Write the buffered hit counts to the database, and recompute the
+    rankings if ``rank`` is given and they are due. The entries are looked
+    up with one query, and the counts written with one update per distinct
+    count plus one insert for entries without a bucket for today yet.
+    """
+    global _last_ranked
+
+    with _lock:
+        hits = dict(_hits)
+        _hits.clear()
+
+    today = datetime.now()
+    today = datetime(today.year, today.month, today.day)
+    # Permalinks that don't match an entry are dropped
+    resolved = {}
+    written = set()
+    try:
+        if hits:
+            resolved = _resolve_entries(hits.keys())
+        counts = {}
+        for key, id in resolved.items():
+            counts[id] = counts.get(id, 0) + hits[key]
+
+        collection = EntryHits.objects._collection
+        buckets = []
+        if counts:
+            buckets = EntryHits.objects(entry__in=counts.keys(), day=today)
+            buckets = buckets.only('id', 'entry')
+        by_count = {}
+        for bucket in buckets:
+            if bucket.entry in counts:
+                by_count.setdefault(counts.pop(bucket.entry), []).append(
+                    (bucket.entry, bucket.id))
+        for count, pairs in by_count.items():
+            collection.update({'_id': {'$in': [id for e, id in pairs]}},
+                              {'$inc': {'hits': count}}, multi=True,
+                              safe=True)
+            written.update(entry for entry, id in pairs)
+
+        new = [EntryHits(entry=id, day=today, hits=count).to_mongo()
+               for id, count in counts.items()]
+        if new:
+            collection.insert(new, safe=True)
+    except:
+        # Put back the counts that weren't written
+        with _lock:
+            for key, count in hits.items():
+                if resolved and (key not in resolved or
+                                 resolved[key] in written):
+                    continue
+                _hits[key] = _hits.get(key, 0) + count
+        raise
+
+    if rank and time.time() - _last_ranked >= RANK_INTERVAL:
+        rank_popular()
+        _last_ranked = time.time()
+
+
+def rank_popular():
+    """Recompute the ranking for each window from the daily hit counts.
+    """
+    from mumblr.entrytypes import EntryType
+
+    now = datetime.now()
+    today = datetime(now.year, now.month, now.day)
+    for window, days in WINDOWS.items():
+        start = today - timedelta(days=days - 1)
+        totals = {}
+        for bucket in EntryHits.objects(day__gte=start):
+            totals[bucket.entry] = totals.get(bucket.entry, 0) + bucket.hits
+
+        # Only rank entries that can be shown
+        live = EntryType.live_entries(id__in=totals.keys()).only('id')
+        ranked = sorted(((totals[e.id], e.id) for e in live), reverse=True)
+        ranked = ranked[:NUM_POPULAR]
+
+        popular = PopularEntries.objects(window=window).first()
+        if popular is None:
+            popular = PopularEntries(window=window)
+        popular.entries = [id for hits, id in ranked]
+        popular.hits = [hits for hits, id in ranked]
+        popular.computed_date = now
+        popular.save()
+
+
+def popular_entries(window='week', num=None):
+    """Get the most popular entries over a window (see :data:`WINDOWS`),
+    most popular first.
+    """
+    from mumblr.entrytypes import EntryType, entry_views, prefetch_authors
+
+    popular = PopularEntries.objects(window=window).first()
+    if popular is None:
+        return []
+    ids = popular.entries[:num or NUM_POPULAR]
+    entries = entry_views(EntryType.live_entries(id__in=ids))
+    entries = dict((e.id, e) for e in prefetch_authors(entries))
+    return [entries[id] for id in ids if id in entries]
+
+
+# Set in the WSGI environ of requests made by mumblr.warmup. Unlike an HTTP
+# header, clients can't set this themselves
+WARMUP_KEY = 'mumblr.warmup'
+
+
+def count_hits(view):
+    """Decorator for the entry detail view that counts successful views.
+    Requests made by :func:`mumblr.warmup` aren't counted.
+    """
+    def wrapper(request, date, slug):
+        response = view(request, date, slug)
+        if (request.method == 'GET' and response.status_code == 200 and
+            not request.META.get(WARMUP_KEY)):
+            record_hit(date, slug)
+        return response
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
@@ -0,0 +1,331 @@
+"""Precomputed "related entries" lists, based on tag co-occurrence.
+
+Similarity between two entries is the cosine similarity of their tag sets,
+i.e. ``|A & B| / sqrt(|A| * |B|)``. The top :data:`NUM_RELATED` entries for
+each entry are stored in a :class:`RelatedEntries` document, which is updated
+incrementally whenever an entry's tags change, so rendering a "related posts"
+list is a single lookup. Only published entries that haven't expired are
+listed, so entries are also added to or removed from other entries' lists
+when they are published, unpublished or their expiry date changes.
+
+A full rebuild (see :func:`rebuild_related` and the ``rebuildrelated``
+management command) may optionally blend in text similarity, using the term
+weights already stored in the search index as term vectors. When numpy and
+scipy are available the rebuild is done with sparse matrix products;
+otherwise it falls back to walking the tag index.
+"""
+from django.conf import settings
+
+from mongoengine import *
+
+from datetime import datetime
+from math import sqrt
+
+
+NUM_RELATED = getattr(settings, 'MUMBLR_RELATED_ENTRIES', 5)
+
+# How much text similarity contributes to the score in a full rebuild, from
+# 0.0 (tags only) to 1.0 (text only)
+TEXT_WEIGHT = getattr(settings, 'MUMBLR_RELATED_TEXT_WEIGHT', 0.0)
+
+
+class RelatedEntries(Document):
+    """The ids of the entries most closely related to ``entry``, best first.
+    ``tags`` records the entry's tags at the time the list was computed, and
+    ``listed`` whether it could then appear in other entries' lists.
+    """
+    entry = ObjectIdField(required=True)
+    tags = ListField(StringField())
+    listed = BooleanField(default=True)
+    related = ListField(ObjectIdField())
+    scores = ListField(FloatField())
+
+    meta = {
+        'collection': 'related_entries',
+        'indexes': ['entry', 'related'],
+    }
+
+    def pairs(self):
+        return zip(self.related, self.scores)
+
+    def set_pairs(self, pairs):
+        pairs = sorted(pairs, key=lambda (id, score): score, reverse=True)
+        pairs = pairs[:NUM_RELATED]
+        self.related = [id for id, score in pairs]
+        self.scores = [score for id, score in pairs]
+
+
+def _tag_similarity(tags, other_tags):
+    if not tags or not other_tags:
+        return 0.0
+    overlap = len(set(tags) & set(other_tags))
+    return overlap / sqrt(len(tags) * len(other_tags))
+
+
+def _is_listed(entry):
+    """Whether ``entry`` may appear in other entries' related lists.
+    """
+    return bool(entry.published and (entry.expiry_date is None or
+                                     entry.expiry_date > datetime.now()))
+
+
+def _listed(queryset):
+    """Restrict a queryset to the entries that may appear in related lists.
+    """
+    return queryset(Q(expiry_date__gt=datetime.now()) | Q(expiry_date=None),
+                    published=True)
+
+
+def _get_related(entry_id):
+    related = RelatedEntries.objects(entry=entry_id).first()
+    if related is None:
+        related = RelatedEntries(entry=entry_id)
+    return related
+
+
+def update_related(entry, force=False):
+    """Incrementally update the related lists affected by a change to
+    ``entry``'s tags or whether it is listed - its own list, and the lists of
+    entries that either share a tag with it or previously listed it. Unless
+    ``force`` is given, nothing is done if neither has changed.
+    """
+    from mumblr.entrytypes import EntryType
+
+    tags = list(entry.tags)
+    listed = _is_listed(entry)
+    related = _get_related(entry.id)
+    if (related.id and related.tags == tags and related.listed == listed and
+        not force):
+        return
+
+    scores = {}
+    if tags:
+        candidates = _listed(EntryType.objects(tags__in=tags,
+                                               id__ne=entry.id))
+        for candidate in candidates.only('id', 'tags'):
+            score = _tag_similarity(tags, candidate.tags)
+            if score > 0:
+                scores[candidate.id] = score
+
+    related.tags = tags
+    related.listed = listed
+    related.set_pairs(scores.items())
+    related.save()
+
+    # An entry that isn't listed is only removed from other lists
+    if not listed:
+        scores = {}
+
+    # Update the lists of neighbouring entries
+    neighbours = set(scores.keys())
+    affected = RelatedEntries.objects(Q(entry__in=list(neighbours)) |
+                                      Q(related=entry.id))
+    seen = set()
+    for other in affected:
+        seen.add(other.entry)
+        pairs = [(id, s) for id, s in other.pairs() if id != entry.id]
+        if other.entry in scores:
+            pairs.append((entry.id, scores[other.entry]))
+        old = other.related
+        other.set_pairs(pairs)
+        if other.related != old:
+            other.save()
+
+    # Neighbours without a list yet will be picked up when they are next
+    # saved or by a full rebuild; give them a minimal list for now
+    for id in neighbours - seen:
+        other = RelatedEntries(entry=id, related=[entry.id],
+                               scores=[scores[id]])
+        other.save()
+
+
+def update_related_many(entries):
+    """Update the related lists affected by changes to the tags or listing of
+    many entries at once. Every entry sharing a tag with them is loaded with
+    a single query, and each affected list is updated once for the batch.
+    The entries need only have their ``tags``, ``published`` and
+    ``expiry_date`` fields loaded.
+    """
+    from mumblr.entrytypes import EntryType
+
+    entries = list(entries)
+    tags_by_id = dict((entry.id, list(entry.tags)) for entry in entries)
+    if not tags_by_id:
+        return
+    listed = dict((entry.id, _is_listed(entry)) for entry in entries)
+    all_tags = set()
+    for tags in tags_by_id.values():
+        all_tags.update(tags)
+
+    candidates = {}
+    if all_tags:
+        query = _listed(EntryType.objects(tags__in=list(all_tags)))
+        for candidate in query.only('id', 'tags'):
+            candidates[candidate.id] = list(candidate.tags)
+    for id, tags in tags_by_id.iteritems():
+        if listed[id]:
+            candidates[id] = tags
+        else:
+            candidates.pop(id, None)
+    tag_index = {}
+    for id, tags in candidates.iteritems():
+        for tag in tags:
+            tag_index.setdefault(tag, []).append(id)
+
+    # Scores between each changed entry and the entries it shares tags with
+    scores = {}
+    for id, tags in tags_by_id.iteritems():
+        overlaps = {}
+        for tag in tags:
+            # Unlisted entries may have tags no listed entry has
+            for other in tag_index.get(tag, ()):
+                if other != id:
+                    overlaps[other] = overlaps.get(other, 0) + 1
+        scores[id] = dict((other, n / sqrt(len(tags) * len(candidates[other])))
+                          for other, n in overlaps.iteritems())
+
+    changed = set(tags_by_id)
+    neighbours = set()
+    for id, entry_scores in scores.iteritems():
+        if listed[id]:
+            neighbours.update(entry_scores)
+    affected = RelatedEntries.objects(Q(entry__in=list(changed | neighbours)) |
+                                      Q(related__in=list(changed)))
+    existing = dict((related.entry, related) for related in affected)
+
+    for id in changed | neighbours | set(existing):
+        related = existing.get(id)
+        if related is None:
+            related = RelatedEntries(entry=id)
+        if id in changed:
+            related.tags = tags_by_id[id]
+            related.listed = listed[id]
+            related.set_pairs(scores[id].items())
+            related.save()
+            continue
+        pairs = [(other, s) for other, s in related.pairs()
+                 if other not in changed]
+        pairs += [(other, scores[other][id]) for other in changed
+                  if listed[other] and id in scores[other]]
+        old = related.related
+        related.set_pairs(pairs)
+        if related.related != old or related.id is None:
+            related.save()
+
+
+def remove_related(entry):
+    """Remove ``entry`` from all related lists.
+    """
+    remove_many([entry.id])
+
+
+def remove_many(ids):
+    """Remove the entries with the given ids from all related lists.
+    """
+    RelatedEntries.objects(entry__in=ids).delete()
+    for other in RelatedEntries.objects(related__in=ids):
+        other.set_pairs([(id, s) for id, s in other.pairs() if id not in ids])
+        other.save()
+
+
+def _top_pairs_python(entries):
+    """Compute related lists by walking an in-memory tag index. Only entries
+    that actually share a tag are ever compared.
+    """
+    tag_index = {}
+    for id, tags in entries:
+        for tag in tags:
+            tag_index.setdefault(tag, []).append(id)
+
+    tags_by_id = dict(entries)
+    results = {}
+    for id, tags in entries:
+        overlaps = {}
+        for tag in tags:
+            for other in tag_index[tag]:
+                if other != id:
+                    overlaps[other] = overlaps.get(other, 0) + 1
+        results[id] = [(other, n / sqrt(len(tags) * len(tags_by_id[other])))
+                       for other, n in overlaps.iteritems()]
+    return results
+
+
+def _top_pairs_matrix(entries, text_weight):
+    """Compute related lists using sparse matrix products. Each entry becomes
+    a row of L2-normalised tag (and optionally term) weights, so the product
+    of the matrix with its transpose gives all pairwise cosine similarities.
+    """
+    import numpy
+    from scipy import sparse
+    from mumblr.search import SearchPosting
+
+    ids = [id for id, tags in entries]
+    row_of = dict((id, i) for i, id in enumerate(ids))
+    columns = {}
+    def column(key):
+        return columns.setdefault(key, len(columns))
+
+    rows, cols, data = [], [], []
+    def add_block(weights_by_row, scale):
+        norms = {}
+        for (row, col), weight in weights_by_row.iteritems():
+            norms[row] = norms.get(row, 0.0) + weight * weight
+        for (row, col), weight in weights_by_row.iteritems():
+            rows.append(row)
+            cols.append(col)
+            data.append(scale * weight / sqrt(norms[row]))
+
+    tag_weights = {}
+    for id, tags in entries:
+        for tag in tags:
+            tag_weights[(row_of[id], column(('tag', tag)))] = 1.0
+    add_block(tag_weights, sqrt(1.0 - text_weight))
+
+    if text_weight > 0:
+        term_weights = {}
+        for posting in SearchPosting.objects(entry__in=ids):
+            key = (row_of[posting.entry], column(('term', posting.term)))
+            term_weights[key] = posting.weight
+        add_block(term_weights, sqrt(text_weight))
+
+    matrix = sparse.csr_matrix((numpy.array(data, dtype=numpy.float32),
+                                (numpy.array(rows), numpy.array(cols))),
+                               shape=(len(ids), len(columns)))
+    similarity = (matrix * matrix.T).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+
+    results = {}
+    for i, id in enumerate(ids):
+        start, end = similarity.indptr[i], similarity.indptr[i + 1]
+        row_cols = similarity.indices[start:end]
+        row_data = similarity.data[start:end]
+        if len(row_data) > NUM_RELATED:
+            top = numpy.argpartition(-row_data, NUM_RELATED)[:NUM_RELATED]
+            row_cols, row_data = row_cols[top], row_data[top]
+        results[id] = [(ids[j], float(s)) for j, s in zip(row_cols, row_data)]
+    return results
+
+
+def rebuild_related(text_weight=None):
+    """Recompute every listed entry's related list from scratch. Other
+    entries get a list when they are next saved.
+    """
+    from mumblr.entrytypes import EntryType
+
+    if text_weight is None:
+        text_weight = TEXT_WEIGHT
+    entries = [(e.id, list(e.tags))
+               for e in _listed(EntryType.objects).only('id', 'tags')]
+
+    try:
+        results = _top_pairs_matrix(entries, text_weight)
+    except ImportError:
+        results = _top_pairs_python(entries)
+
+    RelatedEntries.objects.delete()
+    tags_by_id = dict(entries)
+    for id, pairs in results.iteritems():
+        related = RelatedEntries(entry=id, tags=tags_by_id[id])
+        related.set_pairs(pairs)
+        related.save()
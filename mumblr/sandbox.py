@@ -0,0 +1,185 @@
+"""Rendering markup from untrusted users (i.e. comments) safely.
+
+Markdown is mostly regular expressions, some of which can take a very long
+time on carefully crafted or simply huge input. Rendered in the request
+thread, such a comment ties up a worker until it finishes. With
+``MUMBLR_RENDER_WORKERS`` set, :func:`render_untrusted` instead hands the
+text to one of a pool of worker processes, each limited to
+``MUMBLR_RENDER_TIME_LIMIT`` seconds of CPU time per comment. A worker that
+runs over is killed and replaced, and the comment is shown as escaped plain
+text instead.
+
+Comments longer than ``MUMBLR_MAX_COMMENT_LENGTH`` characters are rejected
+by the comment form, and are never rendered as markup.
+"""
+from django.conf import settings
+from django.utils.html import linebreaks
+
+from multiprocessing import Pipe, Process
+import os
+import Queue
+import threading
+
+
+# Number of worker processes; with none, comments are rendered in-process
+WORKERS = getattr(settings, 'MUMBLR_RENDER_WORKERS', 0)
+
+# Seconds of CPU time a worker may spend on one comment
+TIME_LIMIT = getattr(settings, 'MUMBLR_RENDER_TIME_LIMIT', 2)
+
+MAX_LENGTH = getattr(settings, 'MUMBLR_MAX_COMMENT_LENGTH', 10000)
+
+
+class RenderTimeout(Exception):
+    """Raised when rendering didn't finish within the time limit.
+    """
+    pass
+
+
+def plain_text(text):
+    """The fallback used for text that can't be rendered as markup.
+    """
+    return linebreaks(text, autoescape=True)
+
+
+def _serve(conn, time_limit):
+    import resource
+    from mumblr.entrytypes import markup
+    from mumblr.utils import reset_connection
+
+    reset_connection()
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    while True:
+        try:
+            text, options = conn.recv()
+        except EOFError:
+            return
+        # The limit is on the process's total CPU time, so move it on for
+        # each job. Running over kills the process with SIGXCPU.
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = int(usage.ru_utime + usage.ru_stime)
+        limit = used + int(time_limit) + 1
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+        try:
+            conn.send((True, markup(text, **options)))
+        except Exception, e:
+            conn.send((False, repr(e)))
+
+
+class RenderWorker(object):
+    """A process that renders markup sent to it over a pipe.
+    """
+
+    def __init__(self, time_limit):
+        self.conn, child_conn = Pipe()
+        try:
+            self.process = Process(target=_serve,
+                                   args=(child_conn, time_limit))
+            self.process.daemon = True
+            self.process.start()
+        except Exception:
+            self.conn.close()
+            raise
+        finally:
+            child_conn.close()
+
+    def render(self, text, options, timeout):
+        self.conn.send((text, options))
+        if not self.conn.poll(timeout):
+            raise RenderTimeout
+        # Raises EOFError if the process was killed for using too much CPU
+        ok, result = self.conn.recv()
+        if not ok:
+            raise ValueError(result)
+        return result
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class RenderPool(object):
+    """A pool of :class:`RenderWorker` processes, started when first used.
+    """
+
+    def __init__(self, size, time_limit, timeout=None):
+        self.size = size
+        self.time_limit = time_limit
+        # Allow for waiting to be scheduled as well as the CPU time itself
+        self.timeout = timeout or time_limit * 2 + 1
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _check_fork(self):
+        # Workers belong to the process that started them
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = Queue.Queue()
+                for i in range(self.size):
+                    self._idle.put(None)
+                self._pid = os.getpid()
+
+    def render(self, text, **options):
+        """Render ``text`` with :func:`mumblr.entrytypes.markup` in a worker,
+        falling back to escaped plain text if it takes too long or fails.
+        """
+        self._check_fork()
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            # Every worker is busy with slow comments
+            return plain_text(text)
+        try:
+            if worker is None:
+                worker = RenderWorker(self.time_limit)
+            html = worker.render(text, options, self.timeout)
+        except ValueError:
+            # Markup failed to render, but the worker is fine
+            self._idle.put(worker)
+            return plain_text(text)
+        except (RenderTimeout, EOFError, IOError, OSError):
+            # The worker may have failed to start
+            if worker is not None:
+                worker.kill()
+            # Replaced with a new worker the next time it's needed
+            self._idle.put(None)
+            return plain_text(text)
+        except Exception:
+            if worker is not None:
+                worker.kill()
+            self._idle.put(None)
+            raise
+        self._idle.put(worker)
+        return html
+
+    def close(self):
+        self._check_fork()
+        for i in range(self.size):
+            worker = self._idle.get()
+            if worker is not None:
+                worker.kill()
+            self._idle.put(None)
+
+
+_pool = None
+
+
+def render_untrusted(text, **options):
+    """Render markup from an untrusted user, escaping any HTML in it. Long
+    text is never rendered as markup, and if ``MUMBLR_RENDER_WORKERS`` is
+    set, rendering is done by a worker process with a time limit.
+    """
+    global _pool
+    if len(text) > MAX_LENGTH:
+        return plain_text(text)
+    options['escape'] = True
+    if not WORKERS:
+        from mumblr.entrytypes import markup
+        return markup(text, **options)
+    if _pool is None:
+        _pool = RenderPool(WORKERS, TIME_LIMIT)
+    return _pool.render(text, **options)
@@ -0,0 +1,245 @@
+"""A simple full-text search engine for entries, backed by an inverted index
+stored in MongoDB.
+
+Each entry is broken down into stemmed terms when it is saved, and a
+:class:`SearchPosting` is stored for each (term, entry) pair along with a
+weight reflecting where and how often the term appeared. Queries then only
+need to look up the postings for their terms, which are indexed on
+``(term, -weight)``, rather than scanning entries.
+"""
+from django.conf import settings
+
+from mongoengine import *
+
+import re
+from math import log
+
+
+# Relative importance of the places a term may appear in an entry
+FIELD_WEIGHTS = (
+    ('title', 3.0),
+    ('tags', 2.0),
+    ('content', 1.0),
+    ('description', 1.0),
+)
+COMMENT_WEIGHT = 0.5
+
+INDEX_COMMENTS = getattr(settings, 'MUMBLR_SEARCH_INDEX_COMMENTS', False)
+
+# Upper bound on the number of postings considered per query term
+MAX_POSTINGS = getattr(settings, 'MUMBLR_SEARCH_MAX_POSTINGS', 1000)
+
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in',
+    'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the',
+    'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was', 'will',
+    'with',
+))
+
+_word_re = re.compile(r'[a-z0-9]+')
+_tag_re = re.compile(r'<[^>]*>')
+
+# Suffixes stripped by the stemmer, longest first. Each maps to the string it
+# should be replaced with.
+_suffixes = (
+    ('ational', 'ate'), ('ization', 'ize'), ('fulness', 'ful'),
+    ('iveness', 'ive'), ('ousness', 'ous'), ('alities', 'al'),
+    ('ations', 'ate'), ('ation', 'ate'), ('ities', ''), ('ingly', ''),
+    ('ness', ''), ('ment', ''), ('sses', 'ss'), ('ies', 'y'), ('ing', ''),
+    ('edly', ''), ('ed', ''), ('ly', ''), ('ity', ''), ('er', ''),
+    ('es', ''), ('s', ''),
+)
+
+
+def stem(word):
+    """Reduce a word to an approximate stem by stripping common English
+    suffixes. This is deliberately much simpler than a full Porter stemmer;
+    it only needs to be consistent between indexing and querying.
+    """
+    if len(word) <= 3 or word.isdigit():
+        return word
+    for suffix, replacement in _suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)] + replacement
+            break
+    # Collapse doubled consonants left behind by e.g. 'running' -> 'runn'
+    if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'aeiouls':
+        word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Split text (which may contain HTML) into a list of stemmed terms.
+    """
+    if not text:
+        return []
+    text = _tag_re.sub(' ', text).lower()
+    return [stem(word) for word in _word_re.findall(text)
+            if word not in STOP_WORDS]
+
+
+class SearchPosting(Document):
+    """A single entry in the inverted index - records that ``term`` appears
+    in ``entry`` with the given ``weight``.
+    """
+    term = StringField(required=True)
+    entry = ObjectIdField(required=True)
+    weight = FloatField(required=True)
+
+    meta = {
+        'collection': 'search_posting',
+        'indexes': [('term', '-weight'), 'entry'],
+    }
+
+
+def _entry_term_weights(entry):
+    """Work out the weighted term frequencies for an entry.
+    """
+    weights = {}
+    def add(text, weight):
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0.0) + weight
+
+    for field, weight in FIELD_WEIGHTS:
+        value = getattr(entry, field, None)
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(value)
+        if value:
+            add(value, weight)
+
+    if INDEX_COMMENTS:
+        for comment in entry.comments:
+            add(comment.body, COMMENT_WEIGHT)
+
+    # Dampen repeated terms so that long entries don't dominate results
+    for term, weight in weights.items():
+        if weight > 1.0:
+            weights[term] = 1.0 + log(weight)
+    return weights
+
+
+def index_entry(entry):
+    """Update the index for a single entry. Only postings whose terms or
+    weights have changed are written.
+    """
+    index_many([entry])
+
+
+def indexed_fields():
+    """The fields an entry must have loaded for :func:`index_many`.
+    """
+    fields = ['id'] + [field for field, weight in FIELD_WEIGHTS]
+    if INDEX_COMMENTS:
+        fields.append('comments')
+    return fields
+
+
+def index_many(entries):
+    """Update the index for many entries at once. Their existing postings
+    are fetched with a single query, and the changes are written in batches
+    rather than a posting at a time.
+    """
+    entries = list(entries)
+    if not entries:
+        return
+    existing = {}
+    for posting in SearchPosting.objects(entry__in=[e.id for e in entries]):
+        existing[(posting.entry, posting.term)] = posting
+
+    new, reweighted = [], {}
+    for entry in entries:
+        for term, weight in _entry_term_weights(entry).iteritems():
+            posting = existing.pop((entry.id, term), None)
+            if posting is None:
+                posting = SearchPosting(term=term, entry=entry.id,
+                                        weight=weight)
+                new.append(posting.to_mongo())
+            elif abs(posting.weight - weight) > 1e-6:
+                reweighted.setdefault(weight, []).append(posting.id)
+
+    collection = SearchPosting.objects._collection
+    # Whatever is left over is no longer in the entries
+    stale = [posting.id for posting in existing.values()]
+    if stale:
+        collection.remove({'_id': {'$in': stale}}, safe=True)
+    if new:
+        collection.insert(new, safe=True)
+    for weight, ids in reweighted.items():
+        collection.update({'_id': {'$in': ids}},
+                          {'$set': {'weight': weight}}, multi=True, safe=True)
+
+
+def unindex_entry(entry):
+    """Remove an entry from the index.
+    """
+    SearchPosting.objects(entry=entry.id).delete()
+
+
+def rebuild_index():
+    """Rebuild the entire index from scratch.
+    """
+    from mumblr.entrytypes import EntryType
+    SearchPosting.objects.delete()
+    index_many(EntryType.objects)
+
+
+class SearchResults(object):
+    """A lazily-loaded, ranked list of entries matching a query. Only the ids
+    are held in memory; entries are fetched when a slice is requested, so
+    this may be passed straight to a :class:`~django.core.paginator.Paginator`.
+    """
+
+    def __init__(self, entry_ids):
+        self.entry_ids = entry_ids
+
+    def count(self):
+        return len(self.entry_ids)
+
+    def __len__(self):
+        return len(self.entry_ids)
+
+    def __getitem__(self, key):
+        from mumblr.entrytypes import EntryType, prefetch_authors
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        ids = self.entry_ids[key]
+        entries = prefetch_authors(EntryType.objects(id__in=ids))
+        entries = dict((e.id, e) for e in entries)
+        return [entries[id] for id in ids if id in entries]
+
+
+def search(query):
+    """Search live entries for the given query, returning a
+    :class:`SearchResults` ordered by relevance. Every term in the query must
+    match for an entry to be included.
+    """
+    from mumblr.entrytypes import EntryType
+
+    terms = set(tokenize(query))
+    if not terms:
+        return SearchResults([])
+
+    # Start from the rarest term, so that as few matches as possible are
+    # cut off by MAX_POSTINGS. The other terms' postings are then only
+    # looked up for the entries that matched it.
+    terms = sorted(terms,
+                   key=lambda term: SearchPosting.objects(term=term).count())
+    postings = SearchPosting.objects(term=terms[0]).order_by('-weight')
+    scores = dict((p.entry, p.weight) for p in postings[:MAX_POSTINGS])
+    for term in terms[1:]:
+        if not scores:
+            return SearchResults([])
+        postings = SearchPosting.objects(term=term, entry__in=scores.keys())
+        term_scores = dict((p.entry, p.weight) for p in postings)
+        scores = dict((id, score + term_scores[id])
+                      for id, score in scores.iteritems()
+                      if id in term_scores)
+    if not scores:
+        return SearchResults([])
+
+    # Drop unpublished and expired entries
+    live = EntryType.live_entries(id__in=scores.keys()).only('id')
+    live_ids = set(entry.id for entry in live)
+
+    ranked = sorted(live_ids, key=lambda id: scores[id], reverse=True)
+    return SearchResults(ranked)
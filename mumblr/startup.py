@@ -0,0 +1,136 @@
+"""Initialising everything expensive ahead of the first request.
+
+Markdown and its extensions, pygments, the typography filters' regular
+expressions, the URL resolver and the compiled templates are otherwise all
+set up lazily by each worker process when it handles its first requests.
+Calling :func:`warmup` (available as ``mumblr.warmup()``) in the master
+process of a pre-forking server, before it forks, does this work once and
+lets the workers share the memory copy-on-write. For example, in a WSGI
+script loaded with gunicorn's ``--preload``::
+
+    import mumblr
+    mumblr.warmup()
+
+Compiled templates are only kept if :class:`mumblr.template_loader.Loader`
+is used. If pages are pre-rendered into the cache, the database connection used to
+do so is dropped afterwards so that workers don't share it.
+"""
+from django.conf import settings
+
+import os
+
+
+SAMPLE_TEXT = u'''Warming up "mumblr" -- it's fast & light...
+
+* A list item with `code`
+
+    :::python
+    def warmup():
+        return True
+'''
+
+
+def _template_names():
+    """The names of all mumblr templates, including every theme's.
+    """
+    from django.template.loaders.app_directories import app_template_dirs
+
+    names = set()
+    template_dirs = list(settings.TEMPLATE_DIRS) + list(app_template_dirs)
+    for template_dir in template_dirs:
+        root = os.path.join(template_dir, 'mumblr')
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith('.html'):
+                    path = os.path.join(dirpath, filename)
+                    names.add(os.path.relpath(path, template_dir))
+    return sorted(names)
+
+
+def warm_markup():
+    """Import and exercise the markup and typography code.
+    """
+    from mumblr.entrytypes import markup
+    from mumblr.templatetags import typogrify
+    markup(SAMPLE_TEXT)
+    markup(SAMPLE_TEXT, small_headings=True, escape=True)
+    typogrify.typogrify(markup(SAMPLE_TEXT))
+    try:
+        # Load the lexers and formatter used for code blocks
+        from pygments.formatters import HtmlFormatter
+        from pygments.lexers import guess_lexer
+        guess_lexer('def f(): pass')
+        HtmlFormatter().get_style_defs()
+    except ImportError:
+        pass
+
+
+def warm_entry_types():
+    """Register the entry types and fill the lookups built from them.
+    """
+    from mumblr.entrytypes import EntryType, EntryView
+    EntryView._get_class(None)
+    for entry_type in EntryType._types.values():
+        entry_type.AdminForm()
+
+
+def warm_urls():
+    from django.core.urlresolvers import get_resolver, reverse
+    get_resolver(None)._populate()
+    reverse('recent-entries')
+
+
+def warm_templates():
+    """Compile every mumblr template. Returns the number compiled.
+    """
+    from django.template import TemplateDoesNotExist, TemplateSyntaxError
+    from django.template.loader import get_template
+
+    count = 0
+    for name in _template_names():
+        try:
+            get_template(name)
+            count += 1
+        except (TemplateDoesNotExist, TemplateSyntaxError):
+            pass
+    return count
+
+
+def warm_pages(num_entries):
+    """Render the main listing pages and the ``num_entries`` most popular
+    entries into the cache. Returns the URLs requested.
+    """
+    from django.core.urlresolvers import reverse
+    from django.test.client import Client
+    from mumblr.popular import popular_entries, WARMUP_KEY
+    from mumblr.utils import reset_connection
+
+    urls = [reverse('recent-entries'), reverse('archive'),
+            reverse('tag-cloud'), reverse('feeds', args=['rss'])]
+    try:
+        entries = popular_entries('week', num_entries)
+        urls += [entry.get_absolute_url() for entry in entries]
+        client = Client()
+        for url in urls:
+            # Not counted as views of the entries
+            client.get(url, **{WARMUP_KEY: True})
+    finally:
+        reset_connection()
+    return urls
+
+
+def warmup(templates=True, pages=0):
+    """Initialise everything expensive now rather than on first use. Theme
+    templates are compiled unless ``templates`` is False, and if ``pages`` is
+    given, the main pages and that many of the most popular entries are
+    rendered into the cache.
+    """
+    warm_entry_types()
+    warm_markup()
+    warm_urls()
+    stats = {'templates': 0, 'pages': []}
+    if templates:
+        stats['templates'] = warm_templates()
+    if pages:
+        stats['pages'] = warm_pages(pages)
+    return stats
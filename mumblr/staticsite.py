@@ -0,0 +1,230 @@
+"""Export the public parts of the site as a tree of static files.
+
+Pages are rendered by requesting them through Django's test client, so the
+normal views and themes are used. A manifest recording the modification date,
+tags and publish date of every live entry is written alongside the output;
+on the next build only the pages affected by entries that have since been
+added, changed or removed are re-rendered. The related entries shown on each
+entry's page and the popular entries lists are recorded too, so that the
+pages showing them are re-rendered when they change - entry pages for
+related entries, and the site-wide listings (where the default theme shows
+popular entries) for popular ones.
+"""
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
+
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+import os
+import shutil
+
+from mumblr.utils import reset_connection
+
+
+MANIFEST_NAME = '.mumblr-manifest.json'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _num_pages(count):
+    num = getattr(settings, 'MUMBLR_NUM_ENTRIES_PER_PAGE', 10)
+    return max(1, (count + num - 1) // num)
+
+
+def _paginated(url_name, count, *args):
+    urls = [reverse(url_name, args=args)]
+    for page in range(2, _num_pages(count) + 1):
+        urls.append(reverse(url_name, args=args + (page,)))
+    return urls
+
+
+def _entry_state(entry):
+    modified = entry.modified_date
+    return {
+        'url': entry.get_absolute_url(),
+        'modified': modified.strftime(DATE_FORMAT) if modified else None,
+        'tags': list(entry.tags),
+        'date': entry.publish_date.strftime('%Y/%b/%d').lower(),
+    }
+
+
+def _related_state(entry_ids):
+    """The ids of the related entries shown on each live entry's page.
+    """
+    from mumblr.related import RelatedEntries, NUM_RELATED
+
+    live = set(entry_ids)
+    lists = RelatedEntries.objects(entry__in=list(entry_ids))
+    state = {}
+    for related in lists.only('entry', 'related'):
+        # The related lists are filtered when they are rendered
+        ids = [str(id) for id in related.related[:NUM_RELATED]]
+        state[str(related.entry)] = [id for id in ids if id in live]
+    return state
+
+
+def _popular_state():
+    from mumblr.popular import PopularEntries, NUM_POPULAR
+    return dict((popular.window,
+                 [str(id) for id in popular.entries[:NUM_POPULAR]])
+                for popular in PopularEntries.objects.only('window',
+                                                           'entries'))
+
+
+def _date_urls(date):
+    from mumblr.entrytypes import EntryType
+
+    year, month, day = date.split('/')
+    day_start = datetime.strptime(date, '%Y/%b/%d')
+    month_start = day_start.replace(day=1)
+    year_start = month_start.replace(month=1)
+    if month_start.month == 12:
+        month_end = month_start.replace(year=month_start.year + 1, month=1)
+    else:
+        month_end = month_start.replace(month=month_start.month + 1)
+    archives = (
+        ('archive-year', (year,), year_start,
+         year_start.replace(year=year_start.year + 1)),
+        ('archive-month', (year, month), month_start, month_end),
+        ('archive-day', (year, month, day), day_start,
+         day_start + timedelta(days=1)),
+    )
+    urls = []
+    for url_name, args, start, end in archives:
+        count = EntryType.live_entries(publish_date__gte=start,
+                                       publish_date__lt=end).count()
+        urls += _paginated(url_name, count, *args)
+    return urls
+
+
+def _global_urls():
+    """Pages that list entries from the whole site, and so are affected by
+    any change.
+    """
+    from mumblr.entrytypes import EntryType
+
+    urls = _paginated('recent-entries', EntryType.live_entries.count())
+    urls += _paginated('archive', EntryType.live_entries.count())
+    for name, entry_type in EntryType._types.items():
+        count = entry_type.live_entries.count()
+        urls += _paginated('archive', count, name)
+    urls.append(reverse('tag-cloud'))
+    urls.append(reverse('feeds', args=['rss']))
+    urls.append(reverse('feeds', args=['atom']))
+    return urls
+
+
+def _tag_urls(tag):
+    from mumblr.entrytypes import EntryType
+    count = EntryType.live_entries(tags=tag).count()
+    return _paginated('tagged-entries', count, tag)
+
+
+def _output_path(output_dir, url):
+    return os.path.join(output_dir, url.strip('/'), 'index.html')
+
+
+def _render(args):
+    """Render a single page - runs in a worker process.
+    """
+    from django.test.client import Client
+
+    output_dir, url = args
+    response = Client().get(url)
+    if response.status_code != 200:
+        return url, response.status_code
+
+    path = _output_path(output_dir, url)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, 'wb')
+    try:
+        f.write(response.content)
+    finally:
+        f.close()
+    return url, response.status_code
+
+
+def build(output_dir, full=False, processes=None):
+    """Render the site into ``output_dir``. Unless ``full`` is True, only
+    pages affected by changes since the last build are rendered. Returns a
+    list of (url, status_code) pairs for the pages rendered.
+    """
+    from mumblr.entrytypes import EntryType
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    old_manifest = {}
+    if not full and os.path.exists(manifest_path):
+        old_manifest = simplejson.load(open(manifest_path))
+    old_entries = old_manifest.get('entries', {})
+
+    new_entries = {}
+    entry_ids = []
+    entries = EntryType.live_entries.only('id', 'slug', 'publish_date',
+                                          'modified_date', 'tags')
+    for entry in entries:
+        new_entries[str(entry.id)] = _entry_state(entry)
+        entry_ids.append(entry.id)
+    new_related = _related_state(entry_ids)
+    new_popular = _popular_state()
+
+    changed = [id for id, state in new_entries.items()
+               if full or old_entries.get(id) != state]
+    removed = [id for id in old_entries if id not in new_entries]
+
+    urls, tags, dates = set(), set(), set()
+    for id in changed:
+        urls.add(new_entries[id]['url'])
+    # Entry pages whose related entries have changed, or show an entry that
+    # has changed
+    old_related = old_manifest.get('related', {})
+    affected = set(changed + removed)
+    for id, state in new_entries.items():
+        related_ids = new_related.get(id)
+        if (old_related.get(id) != related_ids or
+            affected.intersection(related_ids or [])):
+            urls.add(state['url'])
+    for id in changed + removed:
+        for states in (old_entries, new_entries):
+            if id in states:
+                tags.update(states[id]['tags'])
+                dates.add(states[id]['date'])
+
+    # Remove pages for entries that are no longer live, or have moved
+    for id in changed + removed:
+        if id in old_entries:
+            old_url = old_entries[id]['url']
+            if id not in new_entries or new_entries[id]['url'] != old_url:
+                old_dir = os.path.dirname(_output_path(output_dir, old_url))
+                if os.path.isdir(old_dir):
+                    shutil.rmtree(old_dir)
+
+    if changed or removed or old_manifest.get('popular') != new_popular:
+        urls.update(_global_urls())
+    if changed or removed:
+        for tag in tags:
+            urls.update(_tag_urls(tag))
+        for date in dates:
+            urls.update(_date_urls(date))
+
+    urls = sorted(urls)
+    if urls:
+        pool = Pool(processes, initializer=reset_connection)
+        try:
+            results = pool.map(_render, [(output_dir, url) for url in urls])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    manifest = {
+        'built': datetime.now().strftime(DATE_FORMAT),
+        'entries': new_entries,
+        'related': new_related,
+        'popular': new_popular,
+    }
+    simplejson.dump(manifest, open(manifest_path, 'w'))
+    return results
@@ -0,0 +1,113 @@
+"""Renaming and merging tags across all entries.
+
+Tags are stored inline on each entry, so rather than loading and saving every
+entry that carries a tag, :func:`rename_tag` rewrites them in place with a
+few multi-document updates. The old name is recorded as a :class:`TagAlias`
+so that links to ``/tag/<old>/`` keep working by redirecting to the new tag.
+"""
+from django import forms
+
+from mongoengine import *
+
+from datetime import datetime
+
+
+class TagAlias(Document):
+    """A tag name that has been renamed to (or merged into) ``tag``.
+    """
+    alias = StringField(required=True, unique=True)
+    tag = StringField(required=True)
+
+    meta = {
+        'collection': 'tag_alias',
+        'indexes': ['tag'],
+    }
+
+
+class RenameTagForm(forms.Form):
+    old_tags = forms.CharField(label='Tags',
+        help_text='Separate several tags with commas to merge them')
+    new_tag = forms.CharField(label='Rename to')
+
+    def clean_old_tags(self):
+        return [tag for tag in self.cleaned_data['old_tags'].split(',')
+                if tag.strip()]
+
+
+def resolve_alias(tag):
+    """Get the tag that ``tag`` has been renamed to, or None.
+    """
+    alias = TagAlias.objects(alias=tag).first()
+    return alias.tag if alias else None
+
+
+def _rename_in(collection, old, new, extra=None):
+    """Rename tag ``old`` to ``new`` in the ``tags`` lists of a collection,
+    keeping each tag's position. Returns the ids of documents that had both
+    tags, which now have one fewer.
+    """
+    extra = extra or {}
+    # Documents that already have the new tag just lose the old one
+    merged = [doc['_id'] for doc in
+              collection.find({'tags': {'$all': [old, new]}}, ['_id'])]
+    if merged:
+        update = {'$pull': {'tags': old}}
+        update.update(extra)
+        collection.update({'_id': {'$in': merged}}, update, multi=True,
+                          safe=True)
+    # Rename the old tag in place everywhere else
+    update = {'$set': {'tags.$': new}}
+    for key, value in extra.items():
+        update.setdefault(key, {}).update(value)
+    collection.update({'tags': old}, update, multi=True, safe=True)
+    return merged
+
+
+def rename_tag(old_tags, new_tag):
+    """Rename a tag, or merge several tags into one, on all entries. Returns
+    the number of entries changed.
+    """
+    from mumblr.entrytypes import EntryType, normalize_tag
+    from mumblr import caching, related, search
+
+    if isinstance(old_tags, basestring):
+        old_tags = [old_tags]
+    new_tag = normalize_tag(new_tag)
+    old_tags = [normalize_tag(tag) for tag in old_tags]
+    old_tags = [tag for tag in old_tags if tag and tag != new_tag]
+    if not new_tag or not old_tags:
+        return 0
+
+    entries = EntryType.objects._collection
+    ids = [doc['_id'] for doc in
+           entries.find({'tags': {'$in': old_tags}}, ['_id'])]
+
+    merged = set()
+    extra = {
+        '$set': {'modified_date': datetime.now()},
+        '$inc': {'version': 1},
+    }
+    for old in old_tags:
+        merged.update(_rename_in(entries, old, new_tag, extra))
+        # Keep the tags recorded against related lists in step, so entries
+        # whose tags were only renamed aren't needlessly recomputed. Merged
+        # entries' scores have changed, so they are recomputed below
+        _rename_in(related.RelatedEntries.objects._collection, old, new_tag)
+
+        # Old links now point at the new tag, as do links to anything that
+        # had previously been renamed to the old tag
+        TagAlias.objects(tag=old).update(set__tag=new_tag)
+        TagAlias.objects(alias=old).delete()
+        TagAlias(alias=old, tag=new_tag).save()
+    # The new tag is a real tag again, so it mustn't redirect
+    TagAlias.objects(alias=new_tag).delete()
+
+    # Load only what indexing and the related lists need
+    changed = list(EntryType.objects(id__in=ids).only(
+        'published', 'expiry_date', *search.indexed_fields()))
+    search.index_many(changed)
+    related.update_related_many([e for e in changed if e.id in merged])
+
+    caching.invalidate()
+    return len(ids)
+
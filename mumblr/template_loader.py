@@ -0,0 +1,110 @@
+"""A caching template loader that understands mumblr themes.
+
+Templates requested from a custom theme (``mumblr/themes/<theme>/...``) fall
+back to the default theme's version when the theme doesn't provide one, so
+themes only need to override the templates they change. Compiled templates
+are cached in memory, per name, for the life of the process. When ``DEBUG``
+is on, a cached template is recompiled if its source file has been modified.
+
+To use it, wrap the usual loaders in ``settings.py``::
+
+    TEMPLATE_LOADERS = (
+        ('mumblr.template_loader.Loader', (
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        )),
+    )
+"""
+from django.conf import settings
+from django.template import TemplateDoesNotExist
+from django.template.loader import (BaseLoader, find_template_loader,
+                                    get_template_from_string, make_origin)
+
+import os
+
+
+THEME_PREFIX = 'mumblr/themes/'
+DEFAULT_THEME = 'default'
+
+DEFAULT_LOADERS = (
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+)
+
+
+def fallback_names(template_name):
+    """The names to try, in order, when loading a template - a custom theme's
+    templates fall back to the default theme's.
+    """
+    names = [template_name]
+    if template_name.startswith(THEME_PREFIX):
+        theme, sep, rest = template_name[len(THEME_PREFIX):].partition('/')
+        if rest and theme != DEFAULT_THEME:
+            names.append('%s%s/%s' % (THEME_PREFIX, DEFAULT_THEME, rest))
+    return names
+
+
+class Loader(BaseLoader):
+    is_usable = True
+
+    def __init__(self, loaders=DEFAULT_LOADERS):
+        self.template_cache = {}
+        self._loaders = loaders
+        self._cached_loaders = []
+
+    @property
+    def loaders(self):
+        # Resolve the loaders lazily to avoid circular imports
+        if not self._cached_loaders:
+            for loader in self._loaders:
+                self._cached_loaders.append(find_template_loader(loader))
+        return self._cached_loaders
+
+    def find_template(self, name, dirs=None):
+        for candidate in fallback_names(name):
+            for loader in self.loaders:
+                # Load the source rather than the compiled template, as only
+                # the source comes with the path of the file it was read from
+                load_source = getattr(loader, 'load_template_source', loader)
+                try:
+                    source, display_name = load_source(candidate, dirs)
+                except TemplateDoesNotExist:
+                    continue
+                origin = make_origin(display_name, loader, candidate, dirs)
+                return source, origin, display_name
+        raise TemplateDoesNotExist(name)
+
+    def _is_stale(self, template_name):
+        if not settings.DEBUG:
+            return False
+        template, path, mtime = self.template_cache[template_name]
+        if path and os.path.exists(path):
+            return os.path.getmtime(path) != mtime
+        return False
+
+    def load_template(self, template_name, template_dirs=None):
+        key = template_name
+        if template_dirs:
+            key = '%s:%s' % (template_name, ':'.join(template_dirs))
+
+        if key not in self.template_cache or self._is_stale(key):
+            template, origin, path = self.find_template(template_name,
+                                                        template_dirs)
+            if not hasattr(template, 'render'):
+                try:
+                    template = get_template_from_string(template, origin,
+                                                        template_name)
+                except TemplateDoesNotExist:
+                    # The template extends a template that can't be found -
+                    # return the source so Django can report the error
+                    return template, origin
+            mtime = None
+            if path and os.path.exists(path):
+                mtime = os.path.getmtime(path)
+            self.template_cache[key] = (template, path, mtime)
+        return self.template_cache[key][0], None
+
+    def reset(self):
+        """Empty the template cache.
+        """
+        self.template_cache.clear()
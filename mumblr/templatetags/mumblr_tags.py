@@ -1,8 +1,9 @@
-from django.template import Library, Node, TemplateSyntaxError
+from django.conf import settings
+from django.template import Library, Node, TemplateSyntaxError, Variable
 
 import re
 
-from mumblr.entrytypes import EntryType
+from mumblr.entrytypes import EntryType, prefetch_authors
 
 register = Library()
 
@@ -14,7 +15,8 @@ class LatestEntriesNode(Node):
         self.var_name = var_name
 
     def render(self, context):
-        context[self.var_name] = list(EntryType.live_entries()[:self.num])
+        entries = EntryType.live_entries()[:self.num]
+        context[self.var_name] = prefetch_authors(entries)
         return ''
 
 
@@ -33,3 +35,143 @@ def get_latest_entries(parser, token):
 
     num, var_name = match.groups()
     return LatestEntriesNode(num, var_name)
+
+
+class RelatedEntriesNode(Node):
+
+    def __init__(self, entry, num, var_name):
+        self.entry = Variable(entry)
+        self.num = int(num) if num else None
+        self.var_name = var_name
+
+    def render(self, context):
+        from mumblr.related import RelatedEntries, NUM_RELATED
+        entry = self.entry.resolve(context)
+        related = RelatedEntries.objects(entry=entry.id).first()
+        ids = related.related[:self.num or NUM_RELATED] if related else []
+
+        # Unpublished and expired entries are filtered out at render time,
+        # so the precomputed lists don't need updating when they change
+        entries = EntryType.live_entries(id__in=ids)
+        entries = dict((e.id, e) for e in prefetch_authors(entries))
+        context[self.var_name] = [entries[id] for id in ids if id in entries]
+        return ''
+
+
+@register.tag
+def get_related_entries(parser, token):
+    # Usage:
+    #   {% get_related_entries entry as related %} (default 5 entries)
+    #   (or {% get_related_entries entry 3 as related %} for 3 entries)
+    #   {% for entry in related %}
+    #       <li>{{ entry.title }}</li>
+    #   {% endfor %}
+    tag_name, contents = token.contents.split(None, 1)
+    match = re.search(r'([A-z_][A-z0-9_.]*)\s+(\d+\s+)?as\s+([A-z_][A-z0-9_]+)',
+                      contents)
+    if not match:
+        raise TemplateSyntaxError("%r tag syntax error" % tag_name)
+
+    entry, num, var_name = match.groups()
+    return RelatedEntriesNode(entry, num, var_name)
+
+
+class PopularEntriesNode(Node):
+
+    def __init__(self, num, window, var_name):
+        self.num = int(num) if num else None
+        self.window = window or 'week'
+        self.var_name = var_name
+
+    def render(self, context):
+        from mumblr.popular import popular_entries
+        context[self.var_name] = popular_entries(self.window, self.num)
+        return ''
+
+
+@register.tag
+def get_popular_entries(parser, token):
+    # Usage:
+    #   {% get_popular_entries as popular %} (this week's most read)
+    #   (or {% get_popular_entries 5 month as popular %} for the 5 most read
+    #   this month - windows are day, week and month)
+    #   {% for entry in popular %}
+    #       <li>{{ entry.title }}</li>
+    #   {% endfor %}
+    tag_name, contents = token.contents.split(None, 1)
+    match = re.search(r'(\d+\s+)?(day\s+|week\s+|month\s+)?'
+                      r'as\s+([A-z_][A-z0-9_]+)', contents)
+    if not match:
+        raise TemplateSyntaxError("%r tag syntax error" % tag_name)
+
+    num, window, var_name = match.groups()
+    return PopularEntriesNode(num, window and window.strip(), var_name)
+
+
+class ArchiveMonthsNode(Node):
+
+    def __init__(self, var_name):
+        self.var_name = var_name
+
+    def render(self, context):
+        from mumblr.archive import get_months
+        context[self.var_name] = get_months()
+        return ''
+
+
+@register.tag
+def get_archive_months(parser, token):
+    # Usage:
+    #   {% get_archive_months as months %}
+    #   {% for month in months %}
+    #       <li>{{ month.date|date:"F Y" }} ({{ month.count }})</li>
+    #   {% endfor %}
+    tag_name, contents = token.contents.split(None, 1)
+    match = re.search(r'as\s+([A-z_][A-z0-9_]+)', contents)
+    if not match:
+        raise TemplateSyntaxError("%r tag syntax error" % tag_name)
+
+    return ArchiveMonthsNode(match.groups()[0])
+
+
+_asset_tags = {
+    'css': '<link rel="stylesheet" type="text/css" href="%s" />',
+    'js': '<script type="text/javascript" src="%s"></script>',
+}
+
+@register.simple_tag
+def theme_assets(type, theme=None):
+    # Usage:
+    #   {% theme_assets "css" %} (for the current theme)
+    #   {% theme_assets "js" "default" %} (for a specific theme)
+    from mumblr.assets import asset_urls
+    theme = theme or getattr(settings, 'MUMBLR_THEME', 'default')
+    tag = _asset_tags[type]
+    return '\n'.join(tag % url for url in asset_urls(theme, type))
+
+
+class LateNode(Node):
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def render(self, context):
+        from mumblr.fragments import make_marker, render_fragment
+        args = [arg.resolve(context) for arg in self.args]
+        if context.get('mumblr_shared'):
+            return make_marker(self.name, args)
+        return render_fragment(self.name, args, context)
+
+
+@register.tag
+def late(parser, token):
+    # Usage:
+    #   {% late "comment_form" %}
+    #   {% late "entry_admin" entry.id %}
+    bits = token.split_contents()
+    if len(bits) < 2 or bits[1][0] not in '"\'' or bits[1][-1] != bits[1][0]:
+        raise TemplateSyntaxError("%r tag syntax error" % bits[0])
+
+    args = [parser.compile_filter(arg) for arg in bits[2:]]
+    return LateNode(bits[1][1:-1], args)
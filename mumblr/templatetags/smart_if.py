@@ -7,7 +7,6 @@ greater than and less than operators. Some common case examples::
     {% if articles|length >= 5 %}...{% endif %}
     {% if "ifnotequal tag" != "beautiful" %}...{% endif %}
 """
-import unittest
 from django import template
 
 
@@ -72,151 +71,6 @@ class In(BaseCalc):
         return var1 in var2
 
 
-#==============================================================================
-# Tests
-#==============================================================================
-
-class TestVar(object):
-    """
-    A basic self-resolvable object similar to a Django template variable. Used
-    to assist with tests.
-    """
-    def __init__(self, value):
-        self.value = value
-
-    def resolve(self, context):
-        return self.value
-
-
-class SmartIfTests(unittest.TestCase):
-    def setUp(self):
-        self.true = TestVar(True)
-        self.false = TestVar(False)
-        self.high = TestVar(9000)
-        self.low = TestVar(1)
-
-    def assertCalc(self, calc, context=None):
-        """
-        Test a calculation is True, also checking the inverse "negate" case.
-        """
-        context = context or {}
-        self.assert_(calc.resolve(context))
-        calc.negate = not calc.negate
-        self.assertFalse(calc.resolve(context))
-
-    def assertCalcFalse(self, calc, context=None):
-        """
-        Test a calculation is False, also checking the inverse "negate" case.
-        """
-        context = context or {}
-        self.assertFalse(calc.resolve(context))
-        calc.negate = not calc.negate
-        self.assert_(calc.resolve(context))
-
-    def test_or(self):
-        self.assertCalc(Or(self.true))
-        self.assertCalcFalse(Or(self.false))
-        self.assertCalc(Or(self.true, self.true))
-        self.assertCalc(Or(self.true, self.false))
-        self.assertCalc(Or(self.false, self.true))
-        self.assertCalcFalse(Or(self.false, self.false))
-
-    def test_and(self):
-        self.assertCalc(And(self.true, self.true))
-        self.assertCalcFalse(And(self.true, self.false))
-        self.assertCalcFalse(And(self.false, self.true))
-        self.assertCalcFalse(And(self.false, self.false))
-
-    def test_equals(self):
-        self.assertCalc(Equals(self.low, self.low))
-        self.assertCalcFalse(Equals(self.low, self.high))
-
-    def test_greater(self):
-        self.assertCalc(Greater(self.high, self.low))
-        self.assertCalcFalse(Greater(self.low, self.low))
-        self.assertCalcFalse(Greater(self.low, self.high))
-
-    def test_greater_or_equal(self):
-        self.assertCalc(GreaterOrEqual(self.high, self.low))
-        self.assertCalc(GreaterOrEqual(self.low, self.low))
-        self.assertCalcFalse(GreaterOrEqual(self.low, self.high))
-
-    def test_in(self):
-        list_ = TestVar([1,2,3])
-        invalid_list = TestVar(None)
-        self.assertCalc(In(self.low, list_))
-        self.assertCalcFalse(In(self.low, invalid_list))
-
-    def test_parse_bits(self):
-        var = IfParser([True]).parse()
-        self.assert_(var.resolve({}))
-        var = IfParser([False]).parse()
-        self.assertFalse(var.resolve({}))
-
-        var = IfParser([False, 'or', True]).parse()
-        self.assert_(var.resolve({}))
-
-        var = IfParser([False, 'and', True]).parse()
-        self.assertFalse(var.resolve({}))
-
-        var = IfParser(['not', False, 'and', 'not', False]).parse()
-        self.assert_(var.resolve({}))
-
-        var = IfParser(['not', 'not', True]).parse()
-        self.assert_(var.resolve({}))
-
-        var = IfParser([1, '=', 1]).parse()
-        self.assert_(var.resolve({}))
-
-        var = IfParser([1, 'not', '=', 1]).parse()
-        self.assertFalse(var.resolve({}))
-
-        var = IfParser([1, 'not', 'not', '=', 1]).parse()
-        self.assert_(var.resolve({}))
-
-        var = IfParser([1, '!=', 1]).parse()
-        self.assertFalse(var.resolve({}))
-
-        var = IfParser([3, '>', 2]).parse()
-        self.assert_(var.resolve({}))
-
-        var = IfParser([1, '<', 2]).parse()
-        self.assert_(var.resolve({}))
-
-        var = IfParser([2, 'not', 'in', [2, 3]]).parse()
-        self.assertFalse(var.resolve({}))
-
-        var = IfParser([1, 'or', 1, '=', 2]).parse()
-        self.assert_(var.resolve({}))
-
-    def test_boolean(self):
-        var = IfParser([True, 'and', True, 'and', True]).parse()
-        self.assert_(var.resolve({}))
-        var = IfParser([False, 'or', False, 'or', True]).parse()
-        self.assert_(var.resolve({}))
-        var = IfParser([True, 'and', False, 'or', True]).parse()
-        self.assert_(var.resolve({}))
-        var = IfParser([False, 'or', True, 'and', True]).parse()
-        self.assert_(var.resolve({}))
-
-        var = IfParser([True, 'and', True, 'and', False]).parse()
-        self.assertFalse(var.resolve({}))
-        var = IfParser([False, 'or', False, 'or', False]).parse()
-        self.assertFalse(var.resolve({}))
-        var = IfParser([False, 'or', True, 'and', False]).parse()
-        self.assertFalse(var.resolve({}))
-        var = IfParser([False, 'and', True, 'or', False]).parse()
-        self.assertFalse(var.resolve({}))
-
-    def test_invalid(self):
-        self.assertRaises(ValueError, IfParser(['not']).parse)
-        self.assertRaises(ValueError, IfParser(['==']).parse)
-        self.assertRaises(ValueError, IfParser([1, 'in']).parse)
-        self.assertRaises(ValueError, IfParser([1, '>', 'in']).parse)
-        self.assertRaises(ValueError, IfParser([1, '==', 'not', 'not']).parse)
-        self.assertRaises(ValueError, IfParser([1, 2]).parse)
-
-
 OPERATORS = {
     '=': (Equals, True),
     '==': (Equals, True),
@@ -396,6 +250,3 @@ def smart_if(parser, token):
         nodelist_false = None
     return SmartIfNode(var, nodelist_true, nodelist_false)
 
-
-if __name__ == '__main__':
-    unittest.main()
@@ -1,13 +1,47 @@
 from django.test import TestCase
+from django.test.client import Client
+from django.contrib import auth
 from django.conf import settings
+from django.template import Context, TemplateDoesNotExist
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
 
 import mongoengine
+import mumblr
+from pymongo.binary import Binary
 from mongoengine.django.auth import User
+from mongoengine.django.sessions import SessionStore
 
+import gzip
+import os
 import re
+import shutil
+import tempfile
+import time
+import unittest
+from cStringIO import StringIO
 from datetime import datetime
 
+from mumblr.entrytypes import (EntryType, EntryView, EntryViews, EntryConflict,
+                               entry_views, prefetch_authors,
+                               update_author_name, markup, markup_many)
 from mumblr.entrytypes.core import TextEntry, HtmlComment, LinkEntry
+from mumblr.entrytypes import fields
+from mumblr.templatetags.smart_if import (Or, And, Equals, Greater,
+                                          GreaterOrEqual, In, IfParser)
+from mumblr.search import SearchPosting
+from mumblr.related import RelatedEntries, rebuild_related
+from mumblr.archive import (ArchiveMonth, rebuild_histogram, get_months,
+                            refresh_histogram)
+from mumblr.bulk import select_entries, apply_action
+from mumblr.tags import TagAlias, rename_tag
+from mumblr.coldstorage import ArchivedPermalink
+from mumblr import coldstorage
+from mumblr.popular import EntryHits, PopularEntries
+from mumblr import popular
+from mumblr import (staticsite, assets, mmapcache, highlight, sandbox, caching,
+                    incremental, search)
+from mumblr.template_loader import Loader, fallback_names
 
 mongoengine.connect('mumblr-unit-tests')
 
@@ -85,6 +119,610 @@ class MumblrTest(TestCase):
         self.assertNotContains(response, self.text_entry.rendered_content, 
                                status_code=200)
 
+    def test_search(self):
+        """Ensure that entries may be found by searching.
+        """
+        response = self.client.get('/search/', {'q': 'test entries'})
+        self.assertContains(response, self.text_entry.get_absolute_url(),
+                            status_code=200)
+
+        response = self.client.get('/search/', {'q': 'programming'})
+        self.assertNotContains(response, self.text_entry.get_absolute_url(),
+                               status_code=200)
+
+        # Updating an entry should update the index
+        self.text_entry.title = 'Programming'
+        self.text_entry.save()
+        response = self.client.get('/search/', {'q': 'programming'})
+        self.assertContains(response, self.text_entry.get_absolute_url(),
+                            status_code=200)
+
+        # Entries matching every term are found even if they rank below the
+        # cutoff for a common term
+        other = TextEntry(title='Test Test Test', slug='other',
+                          content='test test', published=True)
+        other.tags = ['tests']
+        other.save()
+        max_postings = search.MAX_POSTINGS
+        search.MAX_POSTINGS = 1
+        try:
+            results = search.search('test content')
+            self.assertEqual(results.entry_ids, [self.text_entry.id])
+        finally:
+            search.MAX_POSTINGS = max_postings
+            other.delete()
+
+    def test_related_entries(self):
+        """Ensure that related entries are kept up to date as tags change.
+        """
+        other = TextEntry(title='Other', slug='other', content='other')
+        other.tags = ['tests', 'other']
+        other.save()
+
+        # Drafts aren't listed until they are published
+        related = RelatedEntries.objects(entry=self.text_entry.id).first()
+        self.assertEqual(related.related, [])
+        other.published = True
+        other.save()
+
+        related = RelatedEntries.objects(entry=self.text_entry.id).first()
+        self.assertEqual(related.related, [other.id])
+        response = self.client.get(self.text_entry.get_absolute_url())
+        self.assertContains(response, other.get_absolute_url())
+
+        # Nor are expired entries
+        apply_action(TextEntry.objects(id=other.id), 'set_expiry',
+                     expiry_date=datetime(2000, 1, 1))
+        related = RelatedEntries.objects(entry=self.text_entry.id).first()
+        self.assertEqual(related.related, [])
+        apply_action(TextEntry.objects(id=other.id), 'clear_expiry')
+        related = RelatedEntries.objects(entry=self.text_entry.id).first()
+        self.assertEqual(related.related, [other.id])
+
+        other.reload()
+        other.tags = ['other']
+        other.save()
+        related = RelatedEntries.objects(entry=self.text_entry.id).first()
+        self.assertEqual(related.related, [])
+
+        rebuild_related()
+        related = RelatedEntries.objects(entry=other.id).first()
+        self.assertEqual(related.related, [])
+
+    def test_date_archives(self):
+        """Ensure that the year, month and day archives and the month
+        histogram work properly.
+        """
+        date = self.text_entry.publish_date
+        for format in ('/archive/%Y/', '/archive/%Y/%b/',
+                       '/archive/%Y/%b/%d/'):
+            response = self.client.get(date.strftime(format).lower())
+            self.assertContains(response, self.text_entry.get_absolute_url(),
+                                status_code=200)
+
+        month = ArchiveMonth.objects(year=date.year, month=date.month).first()
+        self.assertEqual(month.count, 1)
+
+        # Unpublishing should remove the entry from the histogram
+        self.text_entry.published = False
+        self.text_entry.save()
+        month.reload()
+        self.assertEqual(month.count, 0)
+
+        self.text_entry.published = True
+        self.text_entry.save()
+        rebuild_histogram()
+        month = ArchiveMonth.objects(year=date.year, month=date.month).first()
+        self.assertEqual(month.count, 1)
+
+        # A save that fails leaves the histogram alone
+        self.text_entry.published = False
+        self.text_entry.title = None
+        self.assertRaises(Exception, self.text_entry.save)
+        month.reload()
+        self.assertEqual(month.count, 1)
+        self.text_entry.reload()
+
+        # Long lists are paginated
+        other = TextEntry(title='Other', slug='other', content='other',
+                          published=True, publish_date=date)
+        other.save()
+        num_entries = getattr(settings, 'MUMBLR_NUM_ENTRIES_PER_PAGE', 10)
+        settings.MUMBLR_NUM_ENTRIES_PER_PAGE = 1
+        caching.invalidate()
+        try:
+            response = self.client.get(date.strftime('/archive/%Y/'))
+            self.assertContains(response,
+                                date.strftime('/archive/%Y/page/2/'))
+            response = self.client.get(date.strftime('/archive/%Y/page/2/'))
+            self.assertContains(response, date.strftime('/archive/%Y/"'))
+        finally:
+            settings.MUMBLR_NUM_ENTRIES_PER_PAGE = num_entries
+            caching.invalidate()
+        other.delete()
+
+        # Four digit page numbers aren't taken for years
+        response = self.client.get('/1000/')
+        self.assertContains(response, self.text_entry.rendered_content)
+
+        # Expired entries are taken out of the histogram by the periodic
+        # refresh, as their pages don't show them
+        self.assertEqual([m.count for m in get_months()], [1])
+        loaded = TextEntry.objects.with_id(self.text_entry.id)
+        EntryType.objects(id=self.text_entry.id).update_one(
+            set__expiry_date=datetime(2000, 1, 1))
+        self.assertEqual(refresh_histogram(), 1)
+        self.assertEqual(get_months(), [])
+
+        # Saving a copy loaded before the refresh doesn't move it again
+        loaded.expiry_date = datetime(2000, 1, 1)
+        loaded.save()
+        month.reload()
+        self.assertEqual(month.count, 0)
+
+    def test_build_static(self):
+        """Ensure that the static export renders pages and only re-renders
+        those affected by changes.
+        """
+        output_dir = tempfile.mkdtemp()
+        try:
+            results = staticsite.build(output_dir, processes=1)
+            urls = [url for url, status_code in results]
+            self.assertTrue(self.text_entry.get_absolute_url() in urls)
+            self.assertTrue('/tag/tests/' in urls)
+
+            path = os.path.join(output_dir, 'index.html')
+            self.assertTrue(self.text_entry.rendered_content in
+                            open(path).read())
+
+            # Nothing has changed, so nothing should be rendered
+            self.assertEqual(staticsite.build(output_dir, processes=1), [])
+
+            # Pages showing related or popular entries that have changed
+            # are rendered again
+            other = TextEntry(title='Other', slug='other', content='other',
+                              published=True)
+            other.tags = ['tests']
+            other.save()
+            urls = [url for url, status_code
+                    in staticsite.build(output_dir, processes=1)]
+            self.assertTrue(self.text_entry.get_absolute_url() in urls)
+
+            PopularEntries(window='week', entries=[self.text_entry.id],
+                           hits=[1]).save()
+            urls = [url for url, status_code
+                    in staticsite.build(output_dir, processes=1)]
+            self.assertTrue('/archive/' in urls)
+            self.assertFalse(self.text_entry.get_absolute_url() in urls)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_compressed_cache(self):
+        """Ensure that cached pages are served compressed when the client
+        accepts it.
+        """
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gzip.GzipFile(fileobj=StringIO(response.content)).read()
+        self.assertTrue(self.text_entry.rendered_content in content)
+
+        response = self.client.get('/')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertContains(response, self.text_entry.rendered_content)
+
+        # Changes to entries should invalidate the cache
+        self.text_entry.rendered_content = 'cache-invalidated'
+        self.text_entry.content = 'cache-invalidated'
+        self.text_entry.save()
+        response = self.client.get('/')
+        self.assertContains(response, 'cache-invalidated')
+
+    def test_stale_while_revalidate(self):
+        """Ensure that only one request renders a page at a time, with the
+        others given the stale copy, and that expired pages are refreshed
+        in the background.
+        """
+        key = 'mumblr:shared:%s' % md5_constructor('/').hexdigest()
+        lock = key + ':lock'
+        self.client.get('/')
+        self.text_entry.rendered_content = 'stale-replaced'
+        self.text_entry.content = 'stale-replaced'
+        self.text_entry.save()
+
+        # While another request holds the lock, the old page is served
+        cache.add(lock, 1)
+        try:
+            response = self.client.get('/')
+            self.assertNotContains(response, 'stale-replaced')
+        finally:
+            cache.delete(lock)
+        response = self.client.get('/')
+        self.assertContains(response, 'stale-replaced')
+
+        shared = cache.get(key)
+        shared['expires'] = 0
+        shared['content'] = 'expired-copy'
+        cache.set(key, shared)
+        cache.delete(key.replace(':shared:', ':anonymous:'))
+        response = self.client.get('/')
+        self.assertContains(response, 'expired-copy')
+
+        for i in range(100):
+            if cache.get(lock) is None:
+                break
+            time.sleep(0.05)
+        response = self.client.get('/')
+        self.assertContains(response, 'stale-replaced')
+
+        # The background render gets its own anonymous copy of the request
+        from django.core.handlers.wsgi import WSGIRequest
+        request = WSGIRequest({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/',
+                               'HTTP_COOKIE': 'sessionid=abc',
+                               'wsgi.input': StringIO('')})
+        detached = caching._detached_request(request)
+        self.assertEqual(detached.method, 'GET')
+        self.assertEqual(detached.COOKIES, {})
+        self.assertEqual(detached.path, '/')
+        detached.META['CSRF_COOKIE_USED'] = True
+        self.assertFalse('CSRF_COOKIE_USED' in request.META)
+
+    def test_mmap_cache(self):
+        """Ensure that the memory-mapped cache is shared between cache
+        instances using the same file.
+        """
+        path = tempfile.mkdtemp()
+        try:
+            first = mmapcache.CacheClass(path + '/cache', {'size': 8})
+            second = mmapcache.CacheClass(path + '/cache', {'size': 8})
+            first.set('page', {'content': 'x' * 10000})
+            self.assertEqual(second.get('page'), {'content': 'x' * 10000})
+            self.assertFalse(second.add('page', 'other'))
+            self.assertTrue(second.add('lock', 1))
+
+            # Values move between slab classes as their size changes
+            second.set('page', 'small')
+            self.assertEqual(first.get('page'), 'small')
+            first.delete('page')
+            self.assertEqual(second.get('page'), None)
+
+            first.set('expired', 1, -1)
+            self.assertEqual(second.get('expired'), None)
+            self.assertTrue(second.add('expired', 2))
+
+            # A different size uses its own file rather than resizing the
+            # one mapped by the others
+            third = mmapcache.CacheClass(path + '/cache', {'size': 4})
+            self.assertEqual(third.get('lock'), None)
+            self.assertEqual(first.get('lock'), 1)
+            self.assertEqual(sorted(os.listdir(path)),
+                             ['cache.4m', 'cache.8m'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_warmup(self):
+        """Ensure that warming up compiles templates and fills the cache
+        without counting entry views.
+        """
+        popular.stop_flusher()
+        popular.flush(rank=False)
+        stats = mumblr.warmup(pages=5)
+        self.assertTrue(stats['templates'] > 0)
+        self.assertTrue('/' in stats['pages'])
+        self.assertEqual(popular.pending_hits(), {})
+
+        key = 'mumblr:shared:%s' % md5_constructor('/').hexdigest()
+        self.assertTrue(cache.get(key) is not None)
+
+        # Clients can't avoid being counted by claiming to be the warmup
+        self.client.get(self.text_entry.get_absolute_url(),
+                        HTTP_X_MUMBLR_WARMUP='1')
+        self.assertNotEqual(popular.pending_hits(), {})
+
+    def test_highlight_cache(self):
+        """Ensure that highlighted code blocks are cached and evicted.
+        """
+        highlight.clear()
+        key = highlight.highlight_key(':::python\nx = 1', {'linenos': False})
+        self.assertNotEqual(key, highlight.highlight_key(':::python\nx = 1',
+                                                         {'linenos': True}))
+        self.assertEqual(highlight.get(key), None)
+        highlight.put(key, '<pre>x = 1</pre>')
+        self.assertEqual(highlight.get(key), '<pre>x = 1</pre>')
+
+        # The least recently used blocks are evicted first
+        highlight.clear()
+        size = highlight.CACHE_SIZE
+        highlight.CACHE_SIZE = 110
+        try:
+            highlight.put('a', 'a' * 40)
+            highlight.put('b', 'b' * 40)
+            highlight.get('a')
+            highlight.put('c', 'c' * 40)
+            self.assertEqual(highlight.get('a'), 'a' * 40)
+            self.assertEqual(highlight.get('b'), None)
+        finally:
+            highlight.CACHE_SIZE = size
+            highlight.clear()
+
+        try:
+            import pygments
+        except ImportError:
+            return
+        text = '    :::python\n    def f():\n        return 1\n'
+        html = markup(text)
+        self.assertEqual(highlight.stats['misses'], 1)
+        self.assertEqual(markup(text), html)
+        self.assertEqual(highlight.stats['hits'], 1)
+
+    def test_untrusted_rendering(self):
+        """Ensure that untrusted markup is escaped, and falls back to plain
+        text when it is too long or takes too long to render.
+        """
+        html = sandbox.render_untrusted('*hi* <script>')
+        self.assertTrue('<em>hi</em>' in html)
+        self.assertFalse('<script>' in html)
+
+        text = '<b>' + 'x' * sandbox.MAX_LENGTH
+        self.assertEqual(sandbox.render_untrusted(text),
+                         sandbox.plain_text(text))
+
+        pool = sandbox.RenderPool(1, 2)
+        try:
+            self.assertEqual(pool.render('*hi*', escape=True),
+                             markup('*hi*', escape=True))
+            # Too slow to finish in time
+            pool.timeout = 0.001
+            text = '*hi* ' * 20000
+            self.assertEqual(pool.render(text), sandbox.plain_text(text))
+            # The worker is replaced
+            pool.timeout = 5
+            self.assertEqual(pool.render('*hi*'), markup('*hi*'))
+        finally:
+            pool.close()
+
+        # Workers that can't be started fall back to plain text too, and
+        # don't use up the pool
+        def fail(time_limit):
+            raise IOError
+        render_worker = sandbox.RenderWorker
+        sandbox.RenderWorker = fail
+        pool = sandbox.RenderPool(1, 2)
+        try:
+            for i in range(2):
+                self.assertEqual(pool.render('*hi*'),
+                                 sandbox.plain_text('*hi*'))
+        finally:
+            sandbox.RenderWorker = render_worker
+            pool.close()
+
+    def test_incremental_markup(self):
+        """Ensure that rendering a block at a time matches rendering the
+        whole document, and that unchanged blocks aren't rendered again.
+        """
+        text = ('# Intro\n\nSee [the docs][docs].\n\n* one\n\n* two\n\n'
+                '    code\n\n\n    more code\n\n# Intro\n\n'
+                '[docs]: http://example.com/\n')
+        blocks, definitions = incremental.split_blocks(text)
+        self.assertEqual(len(blocks), 4)
+        self.assertEqual(definitions, ['[docs]: http://example.com/'])
+
+        html = incremental.render(text)
+        self.assertTrue('href="http://example.com/"' in html)
+        self.assertEqual(re.sub('\s', '', html), re.sub('\s', '', markup(text)))
+
+        # Only the changed block is passed to markdown
+        key = incremental.block_key(blocks[1], definitions[0], {})
+        cache.set(key, '<p>cached</p>')
+        self.assertTrue('<p>cached</p>' in incremental.render(text))
+
+        # Blocks rendered together come out as if rendered separately
+        texts = ['# Intro', '# Intro\n\n*one*', '[link](http://example.com/)']
+        self.assertEqual(markup_many(texts), [markup(t) for t in texts])
+
+        self.login()
+        response = self.client.post('/admin/preview/', {
+            'content': '*preview*',
+            'csrfmiddlewaretoken': self.get_csrf_token(),
+        })
+        self.assertContains(response, '<em>preview</em>')
+
+    def test_theme_assets(self):
+        """Ensure that theme assets are minified and linked properly.
+        """
+        css = '/* comment */\na  {\n    color: red;\n}\n'
+        self.assertEqual(assets.minify_css(css), 'a{color:red}')
+
+        # Without a bundle the source files should be used
+        assets._manifests['default'] = {}
+        urls = assets.asset_urls('default', 'css')
+        self.assertEqual(len(urls), len(assets.BUNDLES['default']['css']))
+
+        assets._manifests['default'] = {'css': 'css/bundle-123.css'}
+        urls = assets.asset_urls('default', 'css')
+        self.assertEqual(len(urls), 1)
+        self.assertTrue(urls[0].endswith('css/bundle-123.css'))
+        del assets._manifests['default']
+
+        # Building keeps the previous bundles, which may still be linked to,
+        # and running processes notice the new manifest
+        static_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(static_dir, 'css'))
+        open(os.path.join(static_dir, 'css', 'a.css'), 'w').write('a {}')
+        bundles = assets.BUNDLES
+        assets.BUNDLES = {'test': {'css': ['css/a.css']}}
+        assets._theme_dirs['test'] = static_dir
+        try:
+            first = assets.build_bundles('test')['css']
+            self.assertEqual(assets.load_manifest('test'), {'css': first})
+            for content in ('b {}', 'c {}'):
+                open(os.path.join(static_dir, 'css', 'a.css'),
+                     'w').write(content)
+                previous = assets.load_manifest('test')['css']
+                current = assets.build_bundles('test')['css']
+                self.assertTrue(os.path.exists(os.path.join(static_dir,
+                                                            previous)))
+            self.assertFalse(os.path.exists(os.path.join(static_dir, first)))
+
+            # Another process rebuilding is noticed through the mtime
+            assets._manifests['test'] = {'css': first}
+            assets._manifest_mtimes['test'] = 0
+            self.assertEqual(assets.load_manifest('test'), {'css': current})
+        finally:
+            assets.BUNDLES = bundles
+            del assets._theme_dirs['test']
+            assets._manifests.pop('test', None)
+            shutil.rmtree(static_dir)
+
+    def test_theme_template_loader(self):
+        """Ensure that the theme loader falls back to the default theme and
+        caches compiled templates.
+        """
+        names = fallback_names('mumblr/themes/mytheme/search.html')
+        self.assertEqual(names, ['mumblr/themes/mytheme/search.html',
+                                 'mumblr/themes/default/search.html'])
+        self.assertEqual(fallback_names('mumblr/admin/dashboard.html'),
+                         ['mumblr/admin/dashboard.html'])
+        self.assertEqual(fallback_names('mumblr/themes/mytheme'),
+                         ['mumblr/themes/mytheme'])
+
+        loader = Loader()
+        self.assertRaises(TemplateDoesNotExist, loader.load_template,
+                          'mumblr/themes/mytheme')
+        template, origin = loader.load_template(
+            'mumblr/themes/no-such-theme/tag_cloud.html')
+        self.assertTrue(hasattr(template, 'render'))
+        cached, origin = loader.load_template(
+            'mumblr/themes/no-such-theme/tag_cloud.html')
+        self.assertTrue(cached is template)
+
+        # With DEBUG on, edited templates are reloaded
+        template_dir = tempfile.mkdtemp()
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            path = os.path.join(template_dir, 'edited.html')
+            open(path, 'w').write('before')
+            template, origin = loader.load_template('edited.html',
+                                                    [template_dir])
+            self.assertEqual(template.render(Context()), 'before')
+            open(path, 'w').write('after')
+            mtime = os.path.getmtime(path) + 10
+            os.utime(path, (mtime, mtime))
+            template, origin = loader.load_template('edited.html',
+                                                    [template_dir])
+            self.assertEqual(template.render(Context()), 'after')
+        finally:
+            settings.DEBUG = debug
+            shutil.rmtree(template_dir)
+
+    def test_shared_page_fragments(self):
+        """Ensure that cached pages are shared between users, with per-user
+        fragments filled in for each request.
+        """
+        edit_url = '/admin/edit/%s/' % self.text_entry.id
+        url = self.text_entry.get_absolute_url()
+
+        response = self.client.get(url)
+        self.assertNotContains(response, edit_url, status_code=200)
+        self.assertContains(response, 'name="body"')
+        self.assertNotContains(response, '<!--mumblr:late')
+
+        self.login()
+        response = self.client.get(url)
+        self.assertContains(response, edit_url, status_code=200)
+        self.assertContains(response, self.text_entry.rendered_content)
+        self.assertNotContains(response, '<!--mumblr:late')
+
+        response = self.client.get('/')
+        self.assertContains(response, edit_url, status_code=200)
+
+    def test_anonymous_skips_session(self):
+        """Ensure that anonymous visitors without a session cookie don't
+        cause any session or user lookups.
+        """
+        lookups = []
+        original_load = SessionStore.load
+        original_get_user = auth.get_user
+        def load(store):
+            lookups.append('session')
+            return original_load(store)
+        def get_user(request):
+            lookups.append('user')
+            return original_get_user(request)
+
+        SessionStore.load = load
+        auth.get_user = get_user
+        try:
+            client = Client()
+            for url in ('/', self.text_entry.get_absolute_url(), '/tags/'):
+                response = client.get(url)
+                self.assertEqual(response.status_code, 200)
+        finally:
+            SessionStore.load = original_load
+            auth.get_user = original_get_user
+        self.assertEqual(lookups, [])
+
+    def test_prefetch_authors(self):
+        """Ensure that entry authors are dereferenced in bulk and that
+        author names are kept in sync.
+        """
+        self.user.first_name = 'Test'
+        self.user.last_name = 'User'
+        self.user.save()
+        self.text_entry.author = self.user
+        self.text_entry.save()
+        self.assertEqual(self.text_entry.author_name, 'Test User')
+
+        entries = prefetch_authors(TextEntry.objects)
+        self.assertTrue(isinstance(entries[0]._data['author'], User))
+        self.assertEqual(entries[0].author.username, self.user.username)
+
+        self.user.first_name = 'Renamed'
+        self.user.save()
+        update_author_name(self.user)
+        self.text_entry.reload()
+        self.assertEqual(self.text_entry.author_name, 'Renamed User')
+
+    def test_entry_views(self):
+        """Ensure that lightweight entry views expose the same data as the
+        full documents.
+        """
+        link_entry = LinkEntry(title='Link', slug='link',
+                               link_url='http://example.com/')
+        link_entry.save()
+
+        views = dict((view.id, view) for view in entry_views(EntryType.objects))
+        view = views[self.text_entry.id]
+        self.assertTrue(isinstance(view, EntryView))
+        self.assertEqual(view.title, self.text_entry.title)
+        self.assertEqual(view.tags, self.text_entry.tags)
+        self.assertEqual(view.num_comments, 1)
+        self.assertEqual(view.get_absolute_url(),
+                         self.text_entry.get_absolute_url())
+        self.assertEqual(view.rendered_content(),
+                         self.text_entry.rendered_content)
+        # Comments aren't fetched for lists, only counted
+        self.assertTrue(view._document is None)
+        self.assertEqual(view.comments[0].body,
+                         self.text_entry.comments[0].body)
+
+        # Only the requested slice of views is fetched, newest first
+        ordered = EntryType.objects.order_by('-publish_date')
+        page = EntryViews(EntryType.objects)[1:2]
+        self.assertEqual([view.id for view in page],
+                         [entry.id for entry in ordered][1:2])
+        self.assertEqual(len(EntryViews(EntryType.objects)), 2)
+
+        view = views[link_entry.id]
+        self.assertEqual(view.rendered_content(), link_entry.rendered_content())
+        self.assertEqual(view.type, 'Link')
+
+        # Other attributes should fall back to the full document
+        self.assertEqual(view.creation_date.replace(microsecond=0),
+                         link_entry.creation_date.replace(microsecond=0))
+        link_entry.delete()
+
     def test_tag_cloud(self):
         """Ensure that the 'tag cloud' page works properly.
         """
@@ -264,6 +902,295 @@ class MumblrTest(TestCase):
         self.text_entry.reload()
         self.assertEqual(len(self.text_entry.comments), 0)
 
+    def test_partial_save(self):
+        """Ensure that saving an entry only writes changed fields, so that
+        comments added since it was loaded aren't lost.
+        """
+        entry = TextEntry.objects.with_id(self.text_entry.id)
+
+        comment = HtmlComment(author='Mr Test 3', body='concurrent',
+                              rendered_content='<p>concurrent</p>')
+        TextEntry.objects(id=entry.id).update(push__comments=comment)
+
+        entry.title = 'Changed title'
+        entry.save()
+
+        self.text_entry.reload()
+        self.assertEqual(self.text_entry.title, 'Changed title')
+        self.assertEqual(len(self.text_entry.comments), 2)
+
+    def test_concurrent_edits(self):
+        """Ensure that concurrent changes to different fields are merged,
+        and that conflicting changes are detected.
+        """
+        first = TextEntry.objects.with_id(self.text_entry.id)
+        second = TextEntry.objects.with_id(self.text_entry.id)
+
+        first.title = 'First title'
+        first.save()
+        second.content = 'Second content'
+        second.save()
+
+        self.text_entry.reload()
+        self.assertEqual(self.text_entry.title, 'First title')
+        self.assertEqual(self.text_entry.content, 'Second content')
+
+        third = TextEntry.objects.with_id(self.text_entry.id)
+        self.text_entry.title = 'Another title'
+        self.text_entry.save()
+        third.title = 'Conflicting title'
+        self.assertRaises(EntryConflict, third.save)
+
+        # Concurrent unpublishes agree, so both succeed, but only take the
+        # entry out of the histogram once
+        date = self.text_entry.publish_date
+        self.text_entry.reload()
+        first = TextEntry.objects.with_id(self.text_entry.id)
+        second = TextEntry.objects.with_id(self.text_entry.id)
+        first.published = second.published = False
+        first.save()
+        second.save()
+        month = ArchiveMonth.objects(year=date.year, month=date.month).first()
+        self.assertEqual(month.count, 0)
+        self.text_entry.reload()
+
+        # Editing from a stale form should be rejected
+        self.login()
+        response = self.client.post('/admin/edit/%s/' % self.text_entry.id, {
+            'version': 0,
+            'title': 'Stale title',
+            'slug': self.text_entry.slug,
+            'published': 'true',
+            'publish_date_year': datetime.now().year,
+            'publish_date_month': datetime.now().month,
+            'publish_date_day': datetime.now().day,
+            'publish_time': datetime.now().strftime('%H:%M:%S'),
+            'content': 'stale content',
+            'csrfmiddlewaretoken': self.get_csrf_token(),
+        })
+        self.assertContains(response, 'changed by someone else')
+
+        # Edits from a stale form are merged with changes to other fields
+        response = self.client.get('/admin/edit/%s/' % self.text_entry.id)
+        original = re.search(r'name="original" value="([^"]*)"',
+                             response.content).group(1)
+        original = original.replace('&quot;', '"')
+        publish_date = self.text_entry.publish_date
+        data = {
+            'version': self.text_entry.version,
+            'original': original,
+            'title': self.text_entry.title,
+            'slug': self.text_entry.slug,
+            'tags': ', '.join(self.text_entry.tags),
+            'publish_date_year': publish_date.year,
+            'publish_date_month': publish_date.month,
+            'publish_date_day': publish_date.day,
+            'publish_time': publish_date.strftime('%H:%M:%S'),
+            'comments_enabled': 'on',
+            'content': 'merged content',
+            'csrfmiddlewaretoken': self.get_csrf_token(),
+        }
+        other = TextEntry.objects.with_id(self.text_entry.id)
+        other.title = 'Other title'
+        other.save()
+        response = self.client.post('/admin/edit/%s/' % self.text_entry.id,
+                                    data)
+        self.assertEqual(response.status_code, 302)
+        self.text_entry.reload()
+        self.assertEqual(self.text_entry.title, 'Other title')
+        self.assertEqual(self.text_entry.content, 'merged content')
+
+        # but fields changed on both sides are flagged
+        data['title'] = 'My title'
+        response = self.client.post('/admin/edit/%s/' % self.text_entry.id,
+                                    data)
+        self.assertContains(response, 'Changed by someone else')
+
+    def test_bulk_actions(self):
+        """Ensure that bulk actions apply to selected entries and to entries
+        matching a query.
+        """
+        other = TextEntry(title='Other', slug='other', content='other')
+        other.published = True
+        other.save()
+
+        self.login()
+        response = self.client.post('/admin/bulk/', {
+            'action': 'add_tag',
+            'tag_value': 'Bulk',
+            'entry_ids': [str(self.text_entry.id), str(other.id)],
+            'csrfmiddlewaretoken': self.get_csrf_token(),
+        })
+        self.assertEqual(response.status_code, 302)
+        self.text_entry.reload()
+        other.reload()
+        self.assertEqual(self.text_entry.tags, ['tests', 'bulk'])
+        self.assertEqual(other.tags, ['bulk'])
+        self.assertEqual(other.version, 1)
+
+        date = self.text_entry.publish_date
+        apply_action(select_entries(tag='tests'), 'unpublish')
+        self.text_entry.reload()
+        other.reload()
+        self.assertFalse(self.text_entry.published)
+        self.assertTrue(other.published)
+        month = ArchiveMonth.objects(year=date.year, month=date.month).first()
+        self.assertEqual(month.count, 1)
+
+        # Tags are normalised as they are when entries are saved
+        apply_action(select_entries(tag='Tests'), 'add_tag', tag='Django Tips')
+        self.text_entry.reload()
+        self.assertEqual(self.text_entry.tags, ['tests', 'bulk', 'django-tips'])
+        self.assertEqual(SearchPosting.objects(entry=self.text_entry.id,
+                                               term='tip').count(), 1)
+        related = RelatedEntries.objects(entry=other.id).first()
+        self.assertEqual(related.related, [self.text_entry.id])
+        response = self.client.get(self.text_entry.get_absolute_url())
+        self.assertContains(response, '/tag/django-tips/')
+        apply_action(select_entries(tag='Django Tips'), 'remove_tag',
+                     tag='django tips')
+        self.text_entry.reload()
+        self.assertEqual(self.text_entry.tags, ['tests', 'bulk'])
+
+        response = self.client.post('/admin/bulk/', {
+            'action': 'publish',
+            'entry_ids': ['not-an-id'],
+            'csrfmiddlewaretoken': self.get_csrf_token(),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'mumblr/admin/dashboard.html')
+
+        apply_action(select_entries(tag='bulk'), 'delete')
+        self.assertEqual(EntryType.objects.count(), 0)
+        self.assertEqual(SearchPosting.objects.count(), 0)
+        month.reload()
+        self.assertEqual(month.count, 0)
+
+    def test_rename_tags(self):
+        """Ensure that tags may be renamed and merged, and that old tag
+        URLs redirect.
+        """
+        other = TextEntry(title='Other', slug='other', content='other')
+        other.tags = ['python', 'tests']
+        other.published = True
+        other.save()
+
+        self.assertEqual(rename_tag('Tests', 'testing'), 2)
+        self.text_entry.reload()
+        other.reload()
+        self.assertEqual(self.text_entry.tags, ['testing'])
+        self.assertEqual(other.tags, ['python', 'testing'])
+
+        # Merging keeps each tag only once
+        self.assertEqual(rename_tag(['testing', 'python'], 'python'), 2)
+        other.reload()
+        self.assertEqual(other.tags, ['python'])
+
+        response = self.client.get('/tag/tests/')
+        self.assertEqual(response.status_code, 301)
+        self.assertTrue(response['Location'].endswith('/tag/python/'))
+        response = self.client.get('/tag/python/')
+        self.assertContains(response, self.text_entry.get_absolute_url())
+
+    def test_cold_storage(self):
+        """Ensure that expired entries are moved to cold storage, that their
+        permalinks still work and that they may be restored.
+        """
+        url = self.text_entry.get_absolute_url()
+        self.assertEqual(coldstorage.archive_entries(), 0)
+
+        self.text_entry.expiry_date = datetime(2000, 1, 1)
+        self.text_entry.save()
+        self.assertEqual(coldstorage.archive_entries(batch_size=1), 1)
+        self.assertEqual(TextEntry.objects.count(), 0)
+        self.assertEqual(SearchPosting.objects.count(), 0)
+
+        response = self.client.get(url)
+        self.assertContains(response, self.text_entry.rendered_content)
+        self.assertContains(response, 'This entry has been archived')
+
+        entry = coldstorage.restore_entry(str(self.text_entry.id))
+        self.assertEqual(entry.title, self.text_entry.title)
+        self.assertEqual(entry.expiry_date, None)
+        self.assertEqual(ArchivedPermalink.objects.count(), 0)
+        self.assertEqual(coldstorage.archived_entries(), [])
+        self.assertNotEqual(SearchPosting.objects.count(), 0)
+
+    def test_compressed_fields(self):
+        """Ensure that large text fields are stored compressed and only
+        decompressed when used.
+        """
+        threshold = fields.COMPRESS_THRESHOLD
+        fields.COMPRESS_THRESHOLD = 100
+        try:
+            content = 'A long entry. ' * 100
+            entry = TextEntry(title='Long', slug='long', content=content)
+            entry.published = True
+            entry.save()
+        finally:
+            fields.COMPRESS_THRESHOLD = threshold
+
+        raw = TextEntry.objects._collection.find_one({'_id': entry.id})
+        self.assertTrue(isinstance(raw['content'], Binary))
+        self.assertTrue(len(raw['content']) < len(content))
+        raw = TextEntry.objects._collection.find_one(
+            {'_id': self.text_entry.id})
+        self.assertEqual(raw['content'], self.text_entry.content)
+
+        entry = TextEntry.objects.with_id(entry.id)
+        self.assertTrue(isinstance(entry._data['content'],
+                                   fields.Compressed))
+        self.assertEqual(entry.content, content)
+
+        view = entry_views(TextEntry.objects(id=entry.id))[0]
+        self.assertTrue(content.strip() in view.rendered_content())
+
+        # Unchanged compressed fields aren't rewritten
+        entry = TextEntry.objects.with_id(entry.id)
+        entry.title = 'Longer'
+        # The loaded values are only converted when they are needed
+        self.assertEqual(entry._original, None)
+        self.assertEqual(entry._changes().keys(), ['title'])
+
+    def test_popular_entries(self):
+        """Ensure that entry views are counted and ranked.
+        """
+        other = TextEntry(title='Other', slug='other', content='other')
+        other.published = True
+        other.save()
+
+        # Stop the background flusher, and write out hits counted by other
+        # tests before starting
+        popular.stop_flusher()
+        popular.flush(rank=False)
+        EntryHits.objects.delete()
+        for i in range(2):
+            self.client.get(self.text_entry.get_absolute_url())
+        self.client.get(other.get_absolute_url())
+        self.client.get('/2000/jan/01/missing/')
+        # Nothing is written until the counts are flushed
+        self.assertEqual(EntryHits.objects.count(), 0)
+
+        popular.flush(rank=False)
+        hits = EntryHits.objects(entry=self.text_entry.id).first()
+        self.assertEqual(hits.hits, 2)
+        self.assertEqual(EntryHits.objects.count(), 2)
+
+        # Existing buckets are added to
+        self.client.get(self.text_entry.get_absolute_url())
+        popular.flush(rank=False)
+        hits.reload()
+        self.assertEqual(hits.hits, 3)
+        self.assertEqual(EntryHits.objects.count(), 2)
+
+        popular.rank_popular()
+        entries = popular.popular_entries('day')
+        self.assertEqual([e.id for e in entries],
+                         [self.text_entry.id, other.id])
+
+        response = self.client.get('/feeds/popular/')
+        self.assertContains(response, self.text_entry.title)
+
     def test_login_logout(self):
         """Ensure that users may log in and out.
         """
@@ -278,8 +1205,9 @@ class MumblrTest(TestCase):
         self.assertRedirects(response, settings.LOGIN_REDIRECT_URL, 
                              target_status_code=200)
 
-        # User logged in
-        response = self.client.get('/')
+        # User logged in - public pages are rendered without the user, so
+        # check an admin page
+        response = self.client.get('/admin/')
         self.assertTrue(isinstance(response.context['user'], User))
 
         response = self.client.get('/admin/logout/')
@@ -311,3 +1239,152 @@ class MumblrTest(TestCase):
     def tearDown(self):
         self.user.delete()
         TextEntry.objects.delete()
+        SearchPosting.objects.delete()
+        RelatedEntries.objects.delete()
+        ArchiveMonth.objects.delete()
+        TagAlias.objects.delete()
+        ArchivedPermalink.objects.delete()
+        EntryHits.objects.delete()
+        PopularEntries.objects.delete()
+        coldstorage._archive().remove()
+
+
+class TestVar(object):
+    """
+    A basic self-resolvable object similar to a Django template variable. Used
+    to assist with tests.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def resolve(self, context):
+        return self.value
+
+
+class SmartIfTests(unittest.TestCase):
+    def setUp(self):
+        self.true = TestVar(True)
+        self.false = TestVar(False)
+        self.high = TestVar(9000)
+        self.low = TestVar(1)
+
+    def assertCalc(self, calc, context=None):
+        """
+        Test a calculation is True, also checking the inverse "negate" case.
+        """
+        context = context or {}
+        self.assert_(calc.resolve(context))
+        calc.negate = not calc.negate
+        self.assertFalse(calc.resolve(context))
+
+    def assertCalcFalse(self, calc, context=None):
+        """
+        Test a calculation is False, also checking the inverse "negate" case.
+        """
+        context = context or {}
+        self.assertFalse(calc.resolve(context))
+        calc.negate = not calc.negate
+        self.assert_(calc.resolve(context))
+
+    def test_or(self):
+        self.assertCalc(Or(self.true))
+        self.assertCalcFalse(Or(self.false))
+        self.assertCalc(Or(self.true, self.true))
+        self.assertCalc(Or(self.true, self.false))
+        self.assertCalc(Or(self.false, self.true))
+        self.assertCalcFalse(Or(self.false, self.false))
+
+    def test_and(self):
+        self.assertCalc(And(self.true, self.true))
+        self.assertCalcFalse(And(self.true, self.false))
+        self.assertCalcFalse(And(self.false, self.true))
+        self.assertCalcFalse(And(self.false, self.false))
+
+    def test_equals(self):
+        self.assertCalc(Equals(self.low, self.low))
+        self.assertCalcFalse(Equals(self.low, self.high))
+
+    def test_greater(self):
+        self.assertCalc(Greater(self.high, self.low))
+        self.assertCalcFalse(Greater(self.low, self.low))
+        self.assertCalcFalse(Greater(self.low, self.high))
+
+    def test_greater_or_equal(self):
+        self.assertCalc(GreaterOrEqual(self.high, self.low))
+        self.assertCalc(GreaterOrEqual(self.low, self.low))
+        self.assertCalcFalse(GreaterOrEqual(self.low, self.high))
+
+    def test_in(self):
+        list_ = TestVar([1,2,3])
+        invalid_list = TestVar(None)
+        self.assertCalc(In(self.low, list_))
+        self.assertCalcFalse(In(self.low, invalid_list))
+
+    def test_parse_bits(self):
+        var = IfParser([True]).parse()
+        self.assert_(var.resolve({}))
+        var = IfParser([False]).parse()
+        self.assertFalse(var.resolve({}))
+
+        var = IfParser([False, 'or', True]).parse()
+        self.assert_(var.resolve({}))
+
+        var = IfParser([False, 'and', True]).parse()
+        self.assertFalse(var.resolve({}))
+
+        var = IfParser(['not', False, 'and', 'not', False]).parse()
+        self.assert_(var.resolve({}))
+
+        var = IfParser(['not', 'not', True]).parse()
+        self.assert_(var.resolve({}))
+
+        var = IfParser([1, '=', 1]).parse()
+        self.assert_(var.resolve({}))
+
+        var = IfParser([1, 'not', '=', 1]).parse()
+        self.assertFalse(var.resolve({}))
+
+        var = IfParser([1, 'not', 'not', '=', 1]).parse()
+        self.assert_(var.resolve({}))
+
+        var = IfParser([1, '!=', 1]).parse()
+        self.assertFalse(var.resolve({}))
+
+        var = IfParser([3, '>', 2]).parse()
+        self.assert_(var.resolve({}))
+
+        var = IfParser([1, '<', 2]).parse()
+        self.assert_(var.resolve({}))
+
+        var = IfParser([2, 'not', 'in', [2, 3]]).parse()
+        self.assertFalse(var.resolve({}))
+
+        var = IfParser([1, 'or', 1, '=', 2]).parse()
+        self.assert_(var.resolve({}))
+
+    def test_boolean(self):
+        var = IfParser([True, 'and', True, 'and', True]).parse()
+        self.assert_(var.resolve({}))
+        var = IfParser([False, 'or', False, 'or', True]).parse()
+        self.assert_(var.resolve({}))
+        var = IfParser([True, 'and', False, 'or', True]).parse()
+        self.assert_(var.resolve({}))
+        var = IfParser([False, 'or', True, 'and', True]).parse()
+        self.assert_(var.resolve({}))
+
+        var = IfParser([True, 'and', True, 'and', False]).parse()
+        self.assertFalse(var.resolve({}))
+        var = IfParser([False, 'or', False, 'or', False]).parse()
+        self.assertFalse(var.resolve({}))
+        var = IfParser([False, 'or', True, 'and', False]).parse()
+        self.assertFalse(var.resolve({}))
+        var = IfParser([False, 'and', True, 'or', False]).parse()
+        self.assertFalse(var.resolve({}))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, IfParser(['not']).parse)
+        self.assertRaises(ValueError, IfParser(['==']).parse)
+        self.assertRaises(ValueError, IfParser([1, 'in']).parse)
+        self.assertRaises(ValueError, IfParser([1, '>', 'in']).parse)
+        self.assertRaises(ValueError, IfParser([1, '==', 'not', 'not']).parse)
+        self.assertRaises(ValueError, IfParser([1, 2]).parse)
@@ -2,14 +2,12 @@ from django.conf.urls.defaults import *
 from django.contrib.auth.views import login, logout
 
 from mumblr.views.core import (recent_entries, tagged_entries, entry_detail, 
-                               tag_cloud, archive, RssFeed, AtomFeed)
+                               tag_cloud, archive, archive_year,
+                               archive_month, archive_day, search, feed)
 from mumblr.views.admin import (dashboard, delete_entry, add_entry, edit_entry,
-                                delete_comment)
-
-feeds = {
-    'rss': RssFeed,
-    'atom': AtomFeed,
-}
+                                delete_comment, preview_entry, bulk_action,
+                                manage_tags, cold_storage,
+                                restore_archived_entry)
 
 urlpatterns = patterns('',
     url('^$', recent_entries, name='recent-entries'),
@@ -18,20 +16,38 @@ urlpatterns = patterns('',
     url('^tag/(?P<tag>[a-z0-9_-]+)/$', tagged_entries, name='tagged-entries'),
     url('^tag/(?P<tag>[a-z0-9_-]+)/(?P<page_number>\d+)/$', tagged_entries, 
         name='tagged-entries'),
+    # Date archives come before the archives by entry type, whose names
+    # can't be years
+    url('^archive/(\d{4})/$', archive_year, name='archive-year'),
+    url('^archive/(\d{4})/page/(\d+)/$', archive_year, name='archive-year'),
+    url('^archive/(\d{4})/([a-z]{3})/$', archive_month, name='archive-month'),
+    url('^archive/(\d{4})/([a-z]{3})/page/(\d+)/$', archive_month,
+        name='archive-month'),
+    url('^archive/(\d{4})/([a-z]{3})/(\d{2})/$', archive_day,
+        name='archive-day'),
+    url('^archive/(\d{4})/([a-z]{3})/(\d{2})/page/(\d+)/$', archive_day,
+        name='archive-day'),
     url('^archive/$', archive, name='archive'),
     url('^archive/(?P<page_number>\d+)/$', archive, name='archive'),
     url('^archive/(?P<entry_type>[a-z0-9_-]+)/$', archive, name='archive'),
     url('^archive/(?P<entry_type>[a-z0-9_-]+)/(?P<page_number>\d+)/$',
         archive, name='archive'),
     url('^tags/$', tag_cloud, name='tag-cloud'),
+    url('^search/$', search, name='search'),
+    url('^search/(?P<page_number>\d+)/$', search, name='search'),
     url('^admin/$', dashboard, name='admin'),
     url('^admin/add/(\w+)/$', add_entry, name='add-entry'),
     url('^admin/edit/(\w+)/$', edit_entry, name='edit-entry'),
     url('^admin/delete/$', delete_entry, name='delete-entry'),
     url('^admin/delete-comment/$', delete_comment, name='delete-comment'),
+    url('^admin/preview/$', preview_entry, name='preview-entry'),
+    url('^admin/bulk/$', bulk_action, name='bulk-action'),
+    url('^admin/tags/$', manage_tags, name='manage-tags'),
+    url('^admin/archived/$', cold_storage, name='cold-storage'),
+    url('^admin/archived/restore/$', restore_archived_entry,
+        name='restore-entry'),
     url('^admin/login/$', login, {'template_name': 'mumblr/admin/login.html'}, 
         name='log-in'),
     url('^admin/logout/$', logout, {'next_page': '/'}, name='log-out'),
-    url('^feeds/(?P<url>.*)/$', 'django.contrib.syndication.views.feed',
-        {'feed_dict': feeds}, name='feeds'),
+    url('^feeds/(?P<url>.*)/$', feed, name='feeds'),
 )
@@ -0,0 +1,28 @@
+from django.conf import settings
+
+
+def has_session(request):
+    """Whether the request came with a session cookie. Visitors without one
+    can't be logged in, so there's no need to look up their session or user.
+    """
+    return settings.SESSION_COOKIE_NAME in request.COOKIES
+
+
+def get_user(request):
+    """Get the user making a request, without touching the session or the
+    database for visitors that have no session.
+    """
+    if has_session(request) and hasattr(request, 'user'):
+        return request.user
+    from django.contrib.auth.models import AnonymousUser
+    return AnonymousUser()
+
+
+def reset_connection():
+    """Close the database connection so that it is reopened on first use.
+    This must be called in processes forked from one that has connected, as
+    the connection's sockets can't be shared. Every document's collection
+    belongs to the same connection, so they all stay usable.
+    """
+    from mumblr.entrytypes import EntryType
+    EntryType.objects._collection.database.connection.disconnect()
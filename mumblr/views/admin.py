@@ -1,21 +1,20 @@
-from django.http import HttpResponse, Http404, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.forms import AuthenticationForm
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.conf import settings
-from django.contrib.syndication.feeds import Feed
-from django.utils.feedgenerator import Atom1Feed
 from django.template import defaultfilters
+from django.utils import simplejson
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
 
 from datetime import datetime, time
-from mongoengine.django.auth import REDIRECT_FIELD_NAME
-from pymongo.son import SON
-import string
 
-from mumblr.entrytypes import markup, EntryType
+from mumblr import caching, search, incremental
+from mumblr.bulk import BulkActionForm, select_entries, apply_action
+from mumblr.tags import TagAlias, RenameTagForm, rename_tag
+from mumblr.coldstorage import archived_entries, restore_entry
+from mumblr.entrytypes import EntryType, EntryConflict, prefetch_authors
 
 def _lookup_template(name):
     return 'mumblr/admin/%s.html' % name
@@ -26,18 +25,67 @@ def dashboard(request):
     """
     entry_types = [e.type for e in EntryType._types.values()]
     entries = EntryType.objects.order_by('-publish_date')[:10]
+    entries = prefetch_authors(entries)
 
     context = {
         'entry_types': entry_types,
         'entries': entries,
         'datenow': datetime.now(),
+        'bulk_form': BulkActionForm(),
     }
     return render_to_response(_lookup_template('dashboard'), context,
                               context_instance=RequestContext(request))
 
+def _form_hashes(entry, form):
+    """A hash of each of the entry's fields in a valid admin form, used to
+    tell which fields were edited since the form was opened.
+    """
+    hashes = {}
+    for name, value in form.cleaned_data.items():
+        if name in entry._fields and name != 'version':
+            if isinstance(value, datetime):
+                # Times are only edited to the second
+                value = value.replace(microsecond=0)
+            hashes[name] = md5_constructor(smart_str(repr(value))).hexdigest()
+    return hashes
+
+def _entry_form(entry):
+    """An admin form filled in with the entry's current values, along with
+    the hashes of those values.
+    """
+    fields = entry._fields.keys()
+    field_dict = dict([(name, entry[name]) for name in fields])
+
+    # tags are stored as a list in the db, convert them back to a string
+    field_dict['tags'] = ', '.join(field_dict['tags'])
+
+    # publish_time and expiry_time are not initialised as they
+    # don't have a field in the DB
+    field_dict['publish_time'] = time(
+        hour=entry.publish_date.hour,
+        minute=entry.publish_date.minute,
+        second=entry.publish_date.second,
+    )
+    if field_dict['expiry_date']:
+        field_dict['expiry_time'] = time(
+            hour=entry.expiry_date.hour,
+            minute=entry.expiry_date.minute,
+            second=entry.expiry_date.second,
+        )
+
+    hashes = {}
+    form = entry.AdminForm(field_dict)
+    if form.is_valid():
+        hashes = _form_hashes(entry, form)
+        field_dict['original'] = simplejson.dumps(hashes)
+        form = entry.AdminForm(field_dict)
+    return form, hashes
+
 @login_required
 def edit_entry(request, entry_id):
-    """Edit an existing entry.
+    """Edit an existing entry. If someone else saved the entry while the form
+    was open, only the fields edited in the form are saved, unless the other
+    save changed them too.
     """
     entry = EntryType.objects.with_id(entry_id)
     if not entry:
@@ -49,33 +97,55 @@ def edit_entry(request, entry_id):
     if request.method == 'POST':
         form = form_class(request.POST)
         if form.is_valid():
-            # Get necessary post data from the form
-            for field, value in form.cleaned_data.items():
-                if field in entry._fields.keys():
-                    entry[field] = value
-            entry.save()
-            return HttpResponseRedirect(entry.get_absolute_url())
+            version = form.cleaned_data.pop('version')
+            try:
+                original = simplejson.loads(form.cleaned_data.pop('original'))
+            except ValueError:
+                original = None
+            fields = [f for f in form.cleaned_data if f in entry._fields]
+            conflicts = []
+            if version is not None and version != (entry.version or 0):
+                # The entry was saved by someone else while this form was
+                # open, so only save the fields edited in the form
+                current = _entry_form(entry)[1]
+                if isinstance(original, dict) and original:
+                    mine = _form_hashes(entry, form)
+                    fields = [f for f in fields
+                              if mine.get(f) != original.get(f)]
+                    conflicts = [f for f in fields
+                                 if current.get(f) != original.get(f)
+                                 and current.get(f) != mine.get(f)]
+                else:
+                    conflicts = fields
+
+            if conflicts:
+                # Submitting the form again will overwrite their changes
+                data = request.POST.copy()
+                data['version'] = entry.version or 0
+                data['original'] = simplejson.dumps(current)
+                form = form_class(data)
+                form.is_valid()
+                for name in conflicts:
+                    if name in form.fields:
+                        form._errors[name] = form.error_class([
+                            'Changed by someone else.'
+                        ])
+                form._errors['__all__'] = form.error_class([
+                    'This entry has been changed by someone else since you '
+                    'started editing it. Save again to overwrite their '
+                    'changes.'
+                ])
+            else:
+                # Get necessary post data from the form
+                for field in fields:
+                    entry[field] = form.cleaned_data[field]
+                try:
+                    entry.save()
+                    return HttpResponseRedirect(entry.get_absolute_url())
+                except EntryConflict, e:
+                    form._errors['__all__'] = form.error_class([str(e)])
     else:
-        fields = entry._fields.keys()
-        field_dict = dict([(name, entry[name]) for name in fields])
-
-        # tags are stored as a list in the db, convert them back to a string
-        field_dict['tags'] = ', '.join(field_dict['tags'])
-
-        # publish_time and expiry_time are not initialised as they
-        # don't have a field in the DB
-        field_dict['publish_time'] = time(
-            hour=entry.publish_date.hour,
-            minute=entry.publish_date.minute,
-            second=entry.publish_date.second,
-        )
-        if field_dict['expiry_date']:
-            field_dict['expiry_time'] = time(
-                hour=entry.expiry_date.hour,
-                minute=entry.expiry_date.minute,
-                second=entry.expiry_date.second,
-            )
-        form = form_class(field_dict)
+        form = _entry_form(entry)[0]
 
     link_url = reverse('add-entry', args=['Link'])
     video_url = reverse('add-entry', args=['Video'])
@@ -106,7 +176,9 @@ def add_entry(request, type):
     if request.method == 'POST':
         form = form_class(request.POST)
         if form.is_valid():
+            form.cleaned_data.pop('version', None)
             entry = entry_type(**form.cleaned_data)
+            entry.author = request.user
 
             # Save the entry to the DB
             entry.save()
@@ -139,6 +211,16 @@ def add_entry(request, type):
     return render_to_response(_lookup_template('add_entry'), context,
                               context_instance=RequestContext(request))
 
+@login_required
+def preview_entry(request):
+    """Render the markup posted as ``content`` for the live preview on the
+    entry forms.
+    """
+    if request.method != 'POST':
+        return HttpResponseRedirect(reverse('admin'))
+    html = incremental.render(request.POST.get('content', ''))
+    return HttpResponse(html)
+
 @login_required
 def delete_entry(request):
     """Delete an entry from the database.
@@ -154,11 +236,94 @@ def delete_comment(request):
     """
     comment_id = request.POST.get('comment_id', None)
     if request.method == 'POST' and comment_id:
-        # Delete matching comment from entry
-        entry = EntryType.objects(comments__id=comment_id).first()
+        # Atomically pull the matching comment from its entry, so that other
+        # changes to the entry can't be lost
+        entry = EntryType.objects(comments__id=comment_id)
+        entry = entry.only('slug', 'publish_date').first()
         if entry:
-            entry.comments = [c for c in entry.comments if c.id != comment_id]
-            entry.save()
-        return HttpResponseRedirect(entry.get_absolute_url()+'#comments')
+            EntryType.objects._collection.update(
+                {'comments.id': comment_id},
+                {'$pull': {'comments': {'id': comment_id}},
+                 '$set': {'modified_date': datetime.now()}},
+                safe=True)
+            caching.invalidate()
+            if search.INDEX_COMMENTS:
+                search.index_entry(EntryType.objects.with_id(entry.id))
+            return HttpResponseRedirect(entry.get_absolute_url()+'#comments')
     return HttpResponseRedirect(reverse('recent-entries'))
 
+
+@login_required
+def bulk_action(request):
+    """Apply an action to many entries at once, chosen either individually
+    or by tag, type and publish date.
+    """
+    if request.method == 'POST':
+        form = BulkActionForm(request.POST)
+        if form.is_valid():
+            data = form.cleaned_data
+            entries = select_entries(data['entry_ids'], data['tag'],
+                                     data['entry_type'], data['start_date'],
+                                     data['end_date'])
+            apply_action(entries, data['action'], tag=data['tag_value'],
+                         expiry_date=data['expiry_date'])
+            return HttpResponseRedirect(reverse('admin'))
+
+        entry_types = [e.type for e in EntryType._types.values()]
+        entries = EntryType.objects.order_by('-publish_date')[:10]
+        context = {
+            'entry_types': entry_types,
+            'entries': prefetch_authors(entries),
+            'datenow': datetime.now(),
+            'bulk_form': form,
+        }
+        return render_to_response(_lookup_template('dashboard'), context,
+                                  context_instance=RequestContext(request))
+    return HttpResponseRedirect(reverse('admin'))
+
+@login_required
+def manage_tags(request):
+    """List the tags in use, and rename or merge them.
+    """
+    if request.method == 'POST':
+        form = RenameTagForm(request.POST)
+        if form.is_valid():
+            rename_tag(form.cleaned_data['old_tags'],
+                       form.cleaned_data['new_tag'])
+            return HttpResponseRedirect(reverse('manage-tags'))
+    else:
+        form = RenameTagForm()
+
+    tags = EntryType.objects.item_frequencies('tags')
+    tags = sorted(tags.iteritems(), key=lambda (k,v):(-v,k))
+    context = {
+        'title': 'Tags',
+        'tags': tags,
+        'aliases': TagAlias.objects.order_by('alias'),
+        'form': form,
+    }
+    return render_to_response(_lookup_template('tags'), context,
+                              context_instance=RequestContext(request))
+
+@login_required
+def cold_storage(request):
+    """List the entries that have been moved to cold storage.
+    """
+    context = {
+        'title': 'Archived Entries',
+        'entries': archived_entries(limit=50),
+    }
+    return render_to_response(_lookup_template('cold_storage'), context,
+                              context_instance=RequestContext(request))
+
+@login_required
+def restore_archived_entry(request):
+    """Move an entry back from cold storage.
+    """
+    entry_id = request.POST.get('entry_id', None)
+    if request.method == 'POST' and entry_id:
+        entry = restore_entry(entry_id)
+        if entry:
+            return HttpResponseRedirect(reverse('edit-entry',
+                                                args=[entry.id]))
+    return HttpResponseRedirect(reverse('cold-storage'))
@@ -1,17 +1,20 @@
-from django.http import Http404, HttpResponseRedirect
+from django.http import (Http404, HttpResponseRedirect,
+                         HttpResponsePermanentRedirect)
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.conf import settings
-from django.contrib.syndication.feeds import Feed
-from django.utils.feedgenerator import Atom1Feed
-from django.utils.functional import lazy
 
 from datetime import datetime, timedelta
 
-from mumblr.entrytypes import markup, EntryType, Comment
+from mumblr.caching import cached_page, render_shared
+from mumblr.popular import count_hits
+from mumblr.entrytypes import (EntryType, EntryViews, Comment,
+                               prefetch_authors)
 from mumblr.entrytypes.core import HtmlComment
+from mumblr.sandbox import render_untrusted
+from mumblr.utils import get_user
 
 NO_ENTRIES_MESSAGES = (
     ('Have <a href="http://icanhazcheezburger.com">some kittens</a> instead.'),
@@ -20,10 +23,22 @@ NO_ENTRIES_MESSAGES = (
      'a song</a> instead.'),
 )
 
+THEME = getattr(settings, 'MUMBLR_THEME', 'default')
+
+_template_names = {}
+
 def _lookup_template(name):
-    theme = getattr(settings, 'MUMBLR_THEME', 'default')
-    return 'mumblr/themes/%s/%s.html' % (theme, name)
+    """Get the template names to try for a page, falling back to the default
+    theme if the current theme doesn't provide the template.
+    """
+    if name not in _template_names:
+        names = ['mumblr/themes/%s/%s.html' % (THEME, name)]
+        if THEME != 'default':
+            names.append('mumblr/themes/default/%s.html' % name)
+        _template_names[name] = names
+    return _template_names[name]
 
+@cached_page
 def archive(request, entry_type=None, page_number=1):
     """Display an archive of posts.
     """
@@ -36,11 +51,12 @@ def archive(request, entry_type=None, page_number=1):
         entry_class = EntryType._types[entry_type.lower()]
         type = entry_class.type
 
-    paginator = Paginator(entry_class.live_entries(), num)
+    paginator = Paginator(EntryViews(entry_class.live_entries()), num)
     try:
         entries = paginator.page(page_number)
     except (EmptyPage, InvalidPage):
         entries = paginator.page(paginator.num_pages)
+    entries.object_list = prefetch_authors(entries.object_list)
 
     context = {
         'entry_types': entry_types,
@@ -48,27 +64,96 @@ def archive(request, entry_type=None, page_number=1):
         'num_entries': entry_class.live_entries().count(),
         'entry_type': type,
     }
-    return render_to_response(_lookup_template('archive'), context,
-                              context_instance=RequestContext(request))
+    return render_shared(request, _lookup_template('archive'), context)
+
+def _date_archive(request, title, start, end, page_number, url_name, args):
+    num = getattr(settings, 'MUMBLR_NUM_ENTRIES_PER_PAGE', 10)
+    entry_list = EntryType.live_entries(publish_date__gte=start,
+                                        publish_date__lt=end)
+    paginator = Paginator(EntryViews(entry_list), num)
+    try:
+        entries = paginator.page(page_number)
+    except (EmptyPage, InvalidPage):
+        entries = paginator.page(paginator.num_pages)
+    entries.object_list = prefetch_authors(entries.object_list)
+
+    def page_url(number):
+        if number == 1:
+            return reverse(url_name, args=args)
+        return reverse(url_name, args=list(args) + [number])
+
+    previous_url = next_url = None
+    if entries.has_previous():
+        previous_url = page_url(entries.previous_page_number())
+    if entries.has_next():
+        next_url = page_url(entries.next_page_number())
+
+    context = {
+        'title': title,
+        'entries': entries,
+        'num_entries': paginator.count,
+        'previous_url': previous_url,
+        'next_url': next_url,
+    }
+    return render_shared(request, _lookup_template('date_archive'), context)
+
+def _parse_date(date, format):
+    try:
+        return datetime.strptime(date, format)
+    except ValueError:
+        raise Http404
+
+@cached_page
+def archive_year(request, year, page_number=1):
+    """Display the entries published in a year.
+    """
+    start = _parse_date(year, '%Y')
+    end = start.replace(year=start.year + 1)
+    return _date_archive(request, start.strftime('%Y'), start, end,
+                         page_number, 'archive-year', [year])
+
+@cached_page
+def archive_month(request, year, month, page_number=1):
+    """Display the entries published in a month.
+    """
+    start = _parse_date('%s/%s' % (year, month), '%Y/%b')
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return _date_archive(request, start.strftime('%B %Y'), start, end,
+                         page_number, 'archive-month', [year, month])
+
+@cached_page
+def archive_day(request, year, month, day, page_number=1):
+    """Display the entries published on a day.
+    """
+    start = _parse_date('%s/%s/%s' % (year, month, day), '%Y/%b/%d')
+    end = start + timedelta(days=1)
+    return _date_archive(request, start.strftime('%B %d, %Y'), start, end,
+                         page_number, 'archive-day', [year, month, day])
 
+@cached_page
 def recent_entries(request, page_number=1):
     """Show the [n] most recent entries.
     """
     num = getattr(settings, 'MUMBLR_NUM_ENTRIES_PER_PAGE', 10)
     entry_list = EntryType.live_entries()
-    paginator = Paginator(entry_list, num)
+    paginator = Paginator(EntryViews(entry_list), num)
     try:
         entries = paginator.page(page_number)
     except (EmptyPage, InvalidPage):
         entries = paginator.page(paginator.num_pages)
+    entries.object_list = prefetch_authors(entries.object_list)
     context = {
         'title': 'Recent Entries',
         'entries': entries,
         'no_entries_messages': NO_ENTRIES_MESSAGES,
     }
-    return render_to_response(_lookup_template('list_entries'), context,
-                              context_instance=RequestContext(request))
+    return render_shared(request, _lookup_template('list_entries'), context)
 
+@count_hits
+@cached_page
 def entry_detail(request, date, slug):
     """Display one entry with the given slug and date.
     """
@@ -82,27 +167,39 @@ def entry_detail(request, date, slug):
         entry = EntryType.objects(publish_date__gte=today, 
                                   publish_date__lt=tomorrow, slug=slug)[0]
     except IndexError:
-        raise Http404
+        # Entries moved to cold storage are still shown, read-only
+        from mumblr.coldstorage import get_archived_entry
+        entry = get_archived_entry(today, slug)
+        if entry is None:
+            raise Http404
+        entry.comments_enabled = False
+        context = {'entry': entry, 'archived': True}
+        return render_shared(request, _lookup_template('entry_detail'),
+                             context)
 
     # Select correct form for entry type
     form_class = Comment.CommentForm
 
     if request.method == 'POST':
-        form = form_class(request.user, request.POST)
+        user = get_user(request)
+        form = form_class(user, request.POST)
         if form.is_valid():
             # Get necessary post data from the form
             comment = HtmlComment(**form.cleaned_data)
-            if request.user.is_authenticated():
+            if user.is_authenticated():
                 comment.is_admin = True
             # Update entry with comment
             q = EntryType.objects(id=entry.id)
-            comment.rendered_content = markup(comment.body, escape=True,
-                                              small_headings=True)
-            q.update(push__comments=comment)
+            comment.rendered_content = render_untrusted(comment.body,
+                                                        small_headings=True)
+            q.update(push__comments=comment, set__modified_date=datetime.now())
+
+            from mumblr import search, caching
+            caching.invalidate()
+            if search.INDEX_COMMENTS:
+                search.index_entry(q.first())
 
             return HttpResponseRedirect(entry.get_absolute_url()+'#comments')
-    else:
-        form = form_class(request.user)
 
     # Check for comment expiry
     comments_expired = False
@@ -112,31 +209,68 @@ def entry_detail(request, date, slug):
 
     context = {
         'entry': entry,
-        'form': form,
         'comments_expired': comments_expired,
     }
-    return render_to_response(_lookup_template('entry_detail'), context,
-                              context_instance=RequestContext(request))
+    if request.method == 'POST':
+        # Show the form's errors
+        context['form'] = form
+        return render_to_response(_lookup_template('entry_detail'), context,
+                                  context_instance=RequestContext(request))
+
+    # The comment form is filled in per-user as a late-bound fragment
+    return render_shared(request, _lookup_template('entry_detail'), context)
 
+@cached_page
 def tagged_entries(request, tag=None, page_number=1):
     """Show a list of all entries with the given tag.
     """
     tag = tag.strip().lower()
     num = getattr(settings, 'MUMBLR_NUM_ENTRIES_PER_PAGE', 10)
     entry_list = EntryType.live_entries(tags=tag)
-    paginator = Paginator(entry_list, num)
+    if not entry_list.count():
+        # The tag may have been renamed
+        from mumblr.tags import resolve_alias
+        new_tag = resolve_alias(tag)
+        if new_tag:
+            url = reverse('tagged-entries', args=[new_tag])
+            return HttpResponsePermanentRedirect(url)
+    paginator = Paginator(EntryViews(entry_list), num)
     try:
         entries = paginator.page(page_number)
     except (EmptyPage, InvalidPage):
         entries = paginator.page(paginator.num_pages)
+    entries.object_list = prefetch_authors(entries.object_list)
     context = {
         'title': 'Entries Tagged "%s"' % tag,
         'entries': entries,
         'no_entries_messages': NO_ENTRIES_MESSAGES,
     }
-    return render_to_response(_lookup_template('list_entries'), context,
+    return render_shared(request, _lookup_template('list_entries'), context)
+
+def search(request, page_number=1):
+    """Show entries matching the search query given in the 'q' parameter,
+    ordered by relevance.
+    """
+    from mumblr.search import search as search_entries
+
+    query = request.GET.get('q', '').strip()
+    num = getattr(settings, 'MUMBLR_NUM_ENTRIES_PER_PAGE', 10)
+    paginator = Paginator(search_entries(query), num)
+    try:
+        entries = paginator.page(page_number)
+    except (EmptyPage, InvalidPage):
+        entries = paginator.page(paginator.num_pages)
+    entries.object_list = prefetch_authors(entries.object_list)
+    context = {
+        'title': 'Search Results for "%s"' % query,
+        'query': query,
+        'entries': entries,
+        'num_entries': paginator.count,
+    }
+    return render_to_response(_lookup_template('search'), context,
                               context_instance=RequestContext(request))
 
+@cached_page
 def tag_cloud(request):
     """A page containing a 'tag-cloud' of the tags present on entries.
     """
@@ -149,28 +283,13 @@ def tag_cloud(request):
     context = {
         'tag_cloud': freqs,
     }
-    return render_to_response(_lookup_template('tag_cloud'), context,
-                              context_instance=RequestContext(request))
-
+    return render_shared(request, _lookup_template('tag_cloud'), context)
 
-_lazy_reverse = lazy(reverse, str)
-
-class RssFeed(Feed):
-    title = getattr(settings, 'SITE_INFO_TITLE', 'Mumblr Recent Entries')
-    link = _lazy_reverse('recent-entries')
-    description = ""
-    title_template = 'mumblr/feeds/rss_title.html'
-    description_template = 'mumblr/feeds/rss_description.html'
-
-    def items(self):
-        return EntryType.live_entries[:30]
-
-    def item_pubdate(self, item):
-        return item.publish_date
-
-
-class AtomFeed(RssFeed):
-    feed_type = Atom1Feed
-    subtitle = RssFeed.description
-    title_template = 'mumblr/feeds/atom_title.html'
-    description_template = 'mumblr/feeds/atom_description.html'
+@cached_page
+def feed(request, url):
+    """Render one of the feeds in :mod:`mumblr.feeds`.
+    """
+    # The syndication framework is only loaded when a feed is requested
+    from django.contrib.syndication.views import feed as syndication_feed
+    from mumblr.feeds import FEEDS
+    return syndication_feed(request, url, FEEDS)